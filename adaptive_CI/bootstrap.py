@@ -0,0 +1,124 @@
+"""
+This script contains a batched multiplier bootstrap of adaptively weighted AIPW estimates.
+
+Each replicate b reweights the observations with i.i.d. multipliers xi[b, t] of mean one,
+theta*[b, k] = sum_t xi[b, t] h[t, k] score[t, k] / sum_t xi[b, t] h[t, k], so all B replicates are
+obtained from the two matrix products Xi @ (h * score) and Xi @ h. The [B, T] multipliers are drawn in
+blocks of rows bounded by `block_elements`, and only [B, K] running sums are kept.
+
+Gaussian multipliers can be negative, and their denominators Xi @ h can come close to zero at small T,
+so the Gaussian (wild) bootstrap perturbs the linearized estimator instead,
+theta*[b, k] = theta[k] + sum_t (xi[b, t] - 1) h[t, k] (score[t, k] - theta[k]) / sum_t h[t, k].
+Poisson multipliers can all be zero on the observations of an arm; those replicates are dropped.
+"""
+
+import numpy as np
+
+from adaptive_CI.inference import AIPWScores, get_statistics
+from adaptive_CI.profiling import profiled
+
+__all__ = [
+    "aipw_bootstrap",
+    "evaluate_aipw_bootstrap_stats",
+    "MULTIPLIERS",
+]
+
+
+def _exponential(rng, size):
+    return rng.standard_exponential(size)
+
+
+def _poisson(rng, size):
+    return rng.poisson(1., size).astype(float)
+
+
+def _gaussian(rng, size):
+    return 1. + rng.standard_normal(size)
+
+
+# multiplier distributions, all with mean and variance one
+MULTIPLIERS = dict(
+    exponential=_exponential,  # Bayesian bootstrap
+    poisson=_poisson,  # approximates the resampling bootstrap; replicates with an empty arm are dropped
+    gaussian=_gaussian,  # wild bootstrap of the linearized estimator
+)
+
+
+def _rows(score, start, end):
+    return score.rows(start, end) if isinstance(score, AIPWScores) else score[start:end]
+
+
+def _weighted_estimate(score, evalwts):
+    if isinstance(score, AIPWScores):
+        return score.weighted_sum(evalwts) / np.sum(evalwts, 0)
+    return np.sum(evalwts * score, 0) / np.sum(evalwts, 0)
+
+
+@profiled
+def aipw_bootstrap(score, evalwts, num_replicates=1000, multipliers="exponential", block_elements=2 ** 22, seed=None):
+    """
+    Multiplier bootstrap replicates of weighted AIPW arm value estimates.
+
+    INPUT:
+        - score: AIPW scores of shape [T, K] (array or AIPWScores)
+        - evalwts: evaluation weights of shape [T, K]
+        - num_replicates: number of bootstrap replicates B
+        - multipliers: distribution of the multipliers, one of MULTIPLIERS
+        - block_elements: maximal number of multipliers drawn at once (B x rows)
+        - seed: seed of the random generator
+
+    OUTPUT:
+        - replicates: bootstrap estimates of arm values of shape [B, K] (fewer rows with Poisson
+          multipliers if some replicates leave an arm without weight)
+    """
+    draw = MULTIPLIERS[multipliers]
+    linearized = multipliers == "gaussian"
+    rng = np.random.default_rng(seed)
+    T, K = evalwts.shape
+    estimate = _weighted_estimate(score, evalwts) if linearized else None
+    numerator = np.zeros((num_replicates, K))
+    denominator = np.zeros((num_replicates, K))
+    step = max(1, block_elements // num_replicates)
+    for start in range(0, T, step):
+        end = min(start + step, T)
+        xi = draw(rng, (num_replicates, end - start))
+        h = evalwts[start:end]
+        if linearized:
+            numerator += (xi - 1) @ (h * (_rows(score, start, end) - estimate))
+        else:
+            numerator += xi @ (h * _rows(score, start, end))
+            denominator += xi @ h
+    if linearized:
+        return estimate + numerator / np.sum(evalwts, 0)
+    keep = np.all(denominator > 0, axis=1)
+    return numerator[keep] / denominator[keep]
+
+
+@profiled
+def evaluate_aipw_bootstrap_stats(score, evalwts, truth, alpha=.1, contrasts=None, num_replicates=1000,
+                                  multipliers="exponential", block_elements=2 ** 22, seed=None):
+    """
+    Compute statistics of arm value (or contrast) estimates with percentile bootstrap intervals.
+
+    INPUT:
+        - score: AIPW scores of shape [T, K] (array or AIPWScores)
+        - evalwts: evaluation weights of shape [T, K]
+        - truth: true arm values of shape [K]
+        - alpha: significance level
+        - contrasts: contrast matrix of shape [J, K] (see contrast_matrix); arm values if None
+        - num_replicates, multipliers, block_elements, seed: see aipw_bootstrap
+
+    OUTPUT:
+        - statistics of shape [8, K] (or [8, J]) as returned by evaluate_aipw_stats, with the bootstrap
+          standard error, coverage of the percentile interval and its half width as CI_width
+    """
+    estimate = _weighted_estimate(score, evalwts)
+    replicates = aipw_bootstrap(score, evalwts, num_replicates, multipliers, block_elements, seed)
+    truth = np.asarray(truth, dtype=float)
+    if contrasts is not None:
+        estimate, replicates, truth = contrasts @ estimate, replicates @ contrasts.T, contrasts @ truth
+    lower, upper = np.quantile(replicates, [alpha / 2, 1 - alpha / 2], axis=0)
+    stderr = replicates.std(0, ddof=1)
+    stats = get_statistics(estimate, stderr, truth, (upper - lower) / 2)
+    stats[3] = (lower <= truth) & (truth <= upper)  # the percentile interval is not symmetric around the estimate
+    return stats
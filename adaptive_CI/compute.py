@@ -3,6 +3,8 @@ This script includes helper functions to speed up computation.
 """
 
 import numpy as np
+from adaptive_CI.profiling import profiled
+from adaptive_CI.kernels import register, get_kernel
 
 __all__ = ["groupsum",
            "collect",
@@ -23,10 +25,7 @@ def collect(arr, idx):
     OUTPUT:
         - out: collected values of shape [T]
     """
-    out = np.empty(len(idx), dtype=arr.dtype)
-    for i, j in enumerate(idx):
-        out[i] = arr[i, j]
-    return out
+    return arr[np.arange(len(idx)), idx]
 
 
 def expand(values, idx, num_cols):
@@ -42,8 +41,7 @@ def expand(values, idx, num_cols):
         - out: expanded values of shape [T, K]
     """
     out = np.zeros((len(idx), num_cols), dtype=values.dtype)
-    for i, (j, v) in enumerate(zip(idx, values)):
-        out[i, j] = v
+    out[np.arange(len(idx)), idx] = values
     return out
 
 
@@ -60,8 +58,7 @@ def groupsum(array, group, K):
         - out: sums within groups of shape [K]
     """
     out = np.zeros(K, dtype=array.dtype)
-    for a, g in zip(array, group):
-        out[g] += a
+    np.add.at(out, group, array)
     return out
 
 
@@ -74,35 +71,51 @@ def draw(p):
 
 def apply_floor(a, amin):
     """
-    Apply assignment probability floor.
+    Apply assignment probability floor. Works on a single probability vector
+    or on a batch of them.
 
     INPUT:
-        - a: assignmented probabilities of shape [K]
-        - amin: assignment probability floor
+        - a: assignmented probabilities of shape [K] or [S, K]
+        - amin: assignment probability floor, scalar or of shape [S]
 
     OUTPUT:
-        - assignmented probabilities of shape [K] after applying floor 
+        - assignmented probabilities of shape [K] or [S, K] after applying floor
     """
+    a = np.asarray(a, dtype=float)
+    amin = np.asarray(amin, dtype=float)
+    if amin.ndim > 0:
+        amin = amin[..., np.newaxis]
     new = np.maximum(a, amin)
-    total_slack = np.sum(new) - 1
+    total_slack = np.sum(new, axis=-1, keepdims=True) - 1
     individual_slack = new - amin
-    c = total_slack / np.sum(individual_slack)
+    slack_sum = np.sum(individual_slack, axis=-1, keepdims=True)
+    # when every arm sits at the floor there is no slack to redistribute
+    c = np.divide(total_slack, slack_sum,
+                  out=np.zeros_like(slack_sum), where=slack_sum > 0)
     return new - c * individual_slack
 
 
-def stick_breaking(Z):
+@profiled
+def stick_breaking(Z, initial_sum=None, backend=None):
     """
     Stick breaking algorithm in stable-var weights calculation
 
     Input:
         - Z: input array of shape [T, K]
+        - initial_sum: sum of the weights of earlier rows, of shape [K], when processing in chunks
+        - backend: kernel backend, see kernels.py
 
     Output:
         - weights: stick_breaking weights of shape [T, K]
     """
+    weight_sum = np.zeros(Z.shape[1]) if initial_sum is None else np.array(initial_sum, dtype=float)
+    return get_kernel("stick_breaking", backend)(Z, weight_sum)
+
+
+@register("stick_breaking", "numpy")
+def _stick_breaking_numpy(Z, weight_sum):
     T, K = Z.shape
     weights = np.zeros((T, K))
-    weight_sum = np.zeros(K)
     for t in range(T):
         weights[t] = Z[t] * (1 - weight_sum)
         weight_sum += weights[t]
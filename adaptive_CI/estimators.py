@@ -0,0 +1,73 @@
+"""
+This script contains a registry of estimators evaluated on the same simulated data, which can be run concurrently in a thread pool.
+
+The evaluators of one simulation do not depend on each other, and most of their time is spent in NumPy
+reductions and scipy root finding that release the GIL, so running them in threads lowers the latency
+of a simulation on machines with more cores than simulations.
+"""
+
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+__all__ = [
+    "EstimatorRegistry",
+    "thread_pool",
+    "default_num_threads",
+]
+
+
+def default_num_threads():
+    """ Number of threads from the environment variable ADAPTIVE_CI_THREADS (1, i.e. sequential, if unset). """
+    return max(1, int(os.environ.get("ADAPTIVE_CI_THREADS", 1)))
+
+
+@lru_cache(maxsize=None)
+def thread_pool(num_threads):
+    """
+    Thread pool shared by all calls with the same number of threads, or None if num_threads <= 1.
+    The pool lives until the interpreter exits.
+    """
+    if num_threads <= 1:
+        return None
+    return ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="estimator")
+
+
+class EstimatorRegistry:
+    """
+    Ordered collection of estimator calls, e.g.
+
+        estimators = EstimatorRegistry()
+        estimators.add("two_point", evaluate_aipw_stats, scores, wts_twopoint, truth)
+        estimators.add("sample_mean_naive", evaluate_sample_mean_naive_stats, rewards, arms, truth, K)
+        stats = estimators.run(thread_pool(4))
+    """
+
+    def __init__(self):
+        self.tasks = OrderedDict()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, name, func, *args, **kwargs):
+        """ Register the call func(*args, **kwargs) under name. """
+        if name in self.tasks:
+            raise ValueError(f"Estimator {name} is already registered.")
+        self.tasks[name] = (func, args, kwargs)
+
+    def run(self, executor=None):
+        """
+        Run every registered estimator.
+
+        INPUT:
+            - executor: concurrent.futures executor to run the estimators in, sequential if None
+
+        OUTPUT:
+            - results: dictionary name -> result, in registration order
+        """
+        if executor is None:
+            return OrderedDict((name, func(*args, **kwargs)) for name, (func, args, kwargs) in self.tasks.items())
+        futures = OrderedDict((name, executor.submit(func, *args, **kwargs))
+                              for name, (func, args, kwargs) in self.tasks.items())
+        return OrderedDict((name, future.result()) for name, future in futures.items())
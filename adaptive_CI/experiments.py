@@ -3,7 +3,162 @@ This script includes helper functions to generate data, including agents, enviro
 """
 
 import numpy as np
-from adaptive_CI.compute import apply_floor, draw, expand
+from collections.abc import Mapping
+from adaptive_CI.compute import apply_floor
+from adaptive_CI.profiling import profiled
+from adaptive_CI.kernels import register, get_kernel
+
+
+def _dense(obj):
+    """ Decompress the RunLengthProbs in (nested tuples, lists and dictionaries of) arguments. """
+    if isinstance(obj, RunLengthProbs):
+        return np.asarray(obj)
+    if isinstance(obj, (tuple, list)):
+        return type(obj)(_dense(x) for x in obj)
+    if isinstance(obj, dict):
+        return {key: _dense(value) for key, value in obj.items()}
+    return obj
+
+
+class RunLengthProbs(np.lib.mixins.NDArrayOperatorsMixin):
+    """
+    Run-length compressed assignment probabilities of shape [T, K].
+
+    Consecutive identical rows (e.g. the initial pure-exploration batch, or
+    stretches where the agent is pinned at the floor) are stored once. The
+    object behaves like a read-only array: it supports `shape`, `len`,
+    integer/slice/fancy indexing, arithmetic and NumPy functions (which are
+    applied to the decompressed array) and `np.asarray` for full decompression.
+    Callers that use the probabilities many times should decompress them once.
+
+    INPUT:
+        - starts: row index where each run begins, shape [R], starts[0] == 0
+        - values: assignment probabilities of each run, shape [R, K]
+        - T: total number of rows
+    """
+
+    def __init__(self, starts, values, T):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.T = T
+
+    @classmethod
+    def from_array(cls, probs):
+        """ Compress a dense array of shape [T, K]. """
+        probs = np.asarray(probs)
+        new_run = np.ones(len(probs), dtype=bool)
+        new_run[1:] = np.any(probs[1:] != probs[:-1], axis=1)
+        starts = np.flatnonzero(new_run)
+        return cls(starts, probs[starts], len(probs))
+
+    @property
+    def shape(self):
+        return (self.T, self.values.shape[1])
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self.values.nbytes
+
+    def __len__(self):
+        return self.T
+
+    def _runs(self, rows):
+        """ Run index of each row in `rows`. """
+        return np.searchsorted(self.starts, rows, side="right") - 1
+
+    def __getitem__(self, key):
+        rows, cols = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(rows, (int, np.integer, slice)):
+            rows = range(self.T)[rows]
+            if isinstance(rows, range):
+                rows = np.asarray(rows)
+        else:
+            rows = np.arange(self.T)[rows]
+        out = self.values[self._runs(rows)]
+        if len(cols) == 0 or np.ndim(rows) == 0:
+            return out[cols]
+        if isinstance(key[0], (slice, range)) or isinstance(cols[0], slice) or np.ndim(cols[0]) == 0:
+            # e.g. probs[:, [0, 2]], probs[10:20, 1] or probs[arms, :]
+            return out[(slice(None),) + cols]
+        # paired fancy indexing, e.g. probs[np.arange(T), arms]
+        return out[np.arange(len(out)), cols[0]]
+
+    def __array__(self, dtype=None, copy=None):
+        if copy is False:
+            raise ValueError("RunLengthProbs cannot be converted to an array without a copy.")
+        lengths = np.diff(np.append(self.starts, self.T))
+        out = np.repeat(self.values, lengths, axis=0)
+        return out if dtype is None else out.astype(dtype)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        return getattr(ufunc, method)(*_dense(inputs), **_dense(kwargs))
+
+    def __array_function__(self, func, types, args, kwargs):
+        return func(*_dense(args), **_dense(kwargs))
+
+    def __repr__(self):
+        return f"RunLengthProbs(shape={self.shape}, runs={len(self.starts)})"
+
+
+class MabData(Mapping):
+    """
+    Lightweight record of a multi-armed bandit experiment.
+
+    Stores integer `arms`, `rewards` and run-length compressed `probs`.
+    The cumulative draw counts `ndraws` are recovered from `arms` on first
+    access as an int32 array and cached. Supports dictionary-style access
+    (data['probs'], data.keys(), ...) so it can be used in place of the
+    dictionary previously returned by `run_mab_experiment`.
+    """
+
+    _keys = ("arms", "rewards", "ndraws", "probs")
+
+    def __init__(self, arms, rewards, probs, init_neff=None):
+        self.arms = arms
+        self.rewards = rewards
+        self.probs = probs
+        self.init_neff = init_neff
+        self._ndraws = None
+
+    @property
+    def K(self):
+        return self.probs.shape[1]
+
+    @property
+    def ndraws(self):
+        if self._ndraws is None:
+            T, K = len(self.arms), self.K
+            ndraws = np.zeros((T, K), dtype=np.int32)
+            ndraws[np.arange(T), self.arms] = 1
+            np.cumsum(ndraws, axis=0, out=ndraws)
+            if self.init_neff is not None:
+                ndraws += np.asarray(self.init_neff, dtype=np.int32)
+            self._ndraws = ndraws
+        return self._ndraws
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def nbytes(self):
+        """ Memory footprint in bytes, excluding the lazily computed ndraws. """
+        return self.arms.nbytes + self.rewards.nbytes + self.probs.nbytes
 
 
 def ts_mab_probs(sum, sum2, neff, prev_t, floor_start=0.005, floor_decay=0.0, num_mc=20):
@@ -43,7 +198,7 @@ def ts_mab_probs(sum, sum2, neff, prev_t, floor_start=0.005, floor_decay=0.0, nu
     posterior_mean = neff / (var + neff) * mu
 
     idx = np.argmax(Z * np.sqrt(posterior_var) + posterior_mean, axis=1)
-    w_mc = np.array([np.sum(idx == k) for k in range(K)])
+    w_mc = np.bincount(idx, minlength=K)
     p_mc = w_mc / num_mc
 
     # -------------------------------------------------------
@@ -63,28 +218,21 @@ def random_mab_probs(K):
 def epsgreedy_mab_probs(sum, neff, epsilon=0.1):
     """
     Return arm assignment probabilities of epsilon-greedy agent.
+    Arms that have not been pulled yet have empirical mean 0.
 
     INPUT:
-        - sum: summation of arm rewards of shape K (number of arms)
-        - neff: number of observations on each arm, shape K (number of arms)
+        - sum: summation of arm rewards of shape K (number of arms), or [S, K] for a batch of S agents
+        - neff: number of observations on each arm, same shape as sum
         - epsilon: epsilon parameter.
 
     OUTPUT:
-        - probs: arm assignment probabilities of epsilon-greedy agent, shape K
+        - probs: arm assignment probabilities of epsilon-greedy agent, same shape as sum
     """
-    K = len(sum)
-    mean = sum / neff
-    amax = np.amax(mean)
-
-    argmax = np.where(mean == amax)[0]
-    probs = np.zeros(K)
-    for i in range(K):
-        if i in argmax:
-            probs[i] = (1 - epsilon) / len(argmax) + epsilon / K
-        else:
-            probs[i] = epsilon / K
-
-    return probs
+    K = np.shape(sum)[-1]
+    mean = sum / np.maximum(neff, 1)
+    is_max = mean == np.amax(mean, axis=-1, keepdims=True)
+    num_max = np.sum(is_max, axis=-1, keepdims=True)
+    return epsilon / K + (1 - epsilon) * is_max / num_max
 
 
 def generate_y(truth, dgp, T, K):
@@ -119,13 +267,15 @@ def generate_y(truth, dgp, T, K):
             "Only implemented centered normal/uniform/exponential/lognormal noises.")
 
 
+@profiled
 def run_mab_experiment(ys,
                        initial=0,
                        floor_start=0.005,
                        floor_decay=0.0,
                        exploration='TS',
                        init_sum=None, init_sum2=None,
-                       init_neff=None):
+                       init_neff=None,
+                       backend=None):
     """
     Run multi-arm bandits experiment.
 
@@ -139,26 +289,38 @@ def run_mab_experiment(ys,
         - init_sum: prior summation of rewards of each arm, shape [K]
         - init_sum2: prior summation of squared rewards of each arm, shape [K]
         - init_neff: prior number of observations of each arm, shape [K]
+        - backend: kernel backend of the step loop, see kernels.py
 
     OUTPUT:
-        - a dictionary describing generated samples:
+        - a MabData object describing generated samples, with dictionary-style access:
             - arms: indices of pulled arms of shape [T]
             - rewards: rewards of shape [T]
-            - ndraws: number of samples on each arm up to time t, shape [T, K]
-            - probs: assignment probabilities of shape [T, K]
+            - ndraws: number of samples on each arm up to time t, shape [T, K] (int32, computed lazily)
+            - probs: assignment probabilities of shape [T, K] (run-length compressed, see RunLengthProbs)
     """
 
     T, K = ys.shape
     T0 = initial * K
-    arms = np.empty(T, dtype=np.int_)
-    rewards = np.empty(T)
-    probs = np.empty((T, K))
 
     # Initialize if at the middle of an experiment
+    init_draws = None if init_neff is None else np.array(init_neff)
     sum = np.zeros(K) if init_sum is None else init_sum
     sum2 = np.zeros(K) if init_sum2 is None else init_sum2
     neff = np.zeros(K) if init_neff is None else init_neff
-    ndraws = np.zeros((T, K))
+
+    arms, rewards, run_starts, run_values = get_kernel("mab_steps", backend)(
+        ys, T0, floor_start, floor_decay, exploration, sum, sum2, neff)
+    probs = RunLengthProbs(run_starts, np.reshape(run_values, (-1, K)), T)
+    return MabData(arms, rewards, probs, init_neff=init_draws)
+
+
+@register("mab_steps", "numpy")
+def _mab_steps_numpy(ys, T0, floor_start, floor_decay, exploration, sum, sum2, neff):
+    T, K = ys.shape
+    arms = np.empty(T, dtype=np.int_)
+    rewards = np.empty(T)
+    run_starts = []
+    run_values = []
 
     for c, t in enumerate(range(T)):
 
@@ -193,11 +355,8 @@ def run_mab_experiment(ys,
 
         arms[t] = w
         rewards[t] = ys[t, w]
-        probs[t] = p
-        ndraws[t] = neff
-
-    data = {"arms": arms,
-            "rewards": rewards,
-            "ndraws": ndraws,
-            "probs": probs}
-    return data
+        if not run_values or not np.array_equal(p, run_values[-1]):
+            run_starts.append(t)
+            run_values.append(p)
+
+    return arms, rewards, run_starts, run_values
@@ -0,0 +1,112 @@
+"""
+This script contains cached design constants that only depend on the experiment configuration (T, K, floor decay) and not on the data.
+
+Each quantity is computed once per configuration and kept in a bounded LRU cache. Cached arrays are
+returned read-only, so that they can be shared between calls (and, after a fork, between worker
+processes) without being copied; callers must not modify them in place.
+"""
+
+from functools import lru_cache
+import numpy as np
+
+__all__ = [
+    "twopoint_lambdas",
+    "twopoint_lambdas_range",
+    "power_sum",
+    "t_opt",
+]
+
+# number of configurations kept per cached quantity
+CACHE_SIZE = 32
+
+# power sums up to this many terms are summed exactly
+_EXACT_TERMS = 64
+
+
+def _read_only(arr):
+    arr.setflags(write=False)
+    return arr
+
+
+def twopoint_lambdas_range(T, alpha, start, stop):
+    """
+    Allocation rates of the bad and good arms in two-point allocation rate weights at times start+1, ..., stop
+    of an experiment of horizon T (uncached, for processing long experiments in chunks).
+
+    OUTPUT:
+        - bad_lambda, good_lambda: arrays of shape [stop - start, 1]
+    """
+    t = np.arange(start + 1, stop + 1)[:, np.newaxis]
+
+    # bad arm, e small
+    # this rearranging of the formula in the paper seems to be slightly more
+    # numerically accurate. the exact formula in the paper occasionally produces
+    # weights that are just a little over 1 (which is impossible).
+    bad_lambda = (1 - alpha) / ((1 - alpha) + T*(t/T)**alpha - t)
+
+    # good arm, e large
+    good_lambda = 1 / (1 + T - t)
+
+    assert np.all(bad_lambda + 1e-7 >= good_lambda) # the 1e-7 is for numerical issues
+    return bad_lambda, good_lambda
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def twopoint_lambdas(T, alpha):
+    """
+    Allocation rates of the bad and good arms in two-point allocation rate weights.
+
+    INPUT:
+        - T: experiment horizon
+        - alpha: assignment probability floor decaying rate
+
+    OUTPUT:
+        - bad_lambda, good_lambda: read-only arrays of shape [T, 1]
+    """
+    bad_lambda, good_lambda = twopoint_lambdas_range(T, alpha, 0, T)
+    return _read_only(bad_lambda), _read_only(good_lambda)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def power_sum(T, a):
+    """
+    Compute sum_{t=1}^T t^{-a} without allocating T terms. The first terms are summed exactly and
+    the tail is approximated with the Euler-Maclaurin formula, accurate to double precision.
+
+    INPUT:
+        - T: number of terms
+        - a: exponent
+
+    OUTPUT:
+        - sum: float
+    """
+    if T <= _EXACT_TERMS:
+        return float(np.sum(np.arange(1, T + 1, dtype=float) ** -a))
+    N = _EXACT_TERMS
+    head = float(np.sum(np.arange(1, N, dtype=float) ** -a))
+
+    def f(t, order=0):
+        # order-th derivative of t^{-a}
+        coef = 1.0
+        for i in range(order):
+            coef *= -(a + i)
+        return coef * t ** (-a - order)
+
+    if a == 1:
+        integral = np.log(T) - np.log(N)
+    else:
+        integral = (T ** (1 - a) - N ** (1 - a)) / (1 - a)
+    tail = (integral + (f(N) + f(T)) / 2
+            + (f(T, 1) - f(N, 1)) / 12
+            - (f(T, 3) - f(N, 3)) / 720
+            + (f(T, 5) - f(N, 5)) / 30240)
+    return head + tail
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def t_opt(T, K, decay_rate):
+    """
+    Time at which the confidence sequences of Howard et al are tightest, in the beta-Bernoulli
+    and gamma-exponential evaluators: int((1/K) * sum_{t=1}^T t^{-decay_rate}).
+    """
+    return int((1/K) * power_sum(T, decay_rate))
@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.optimize import root_scalar
 from warnings import catch_warnings, simplefilter
 
 __all__ = [
@@ -35,6 +34,7 @@ def get_bennett_radius(M, v_sum, delta):
     
     Reference: Wainwright textbook, exercise 2.7, page 51.
     """
+    from scipy.optimize import root_scalar
     xstar = root_scalar(lambda x: bennett_rhs(x, M, v_sum) - delta,
                         method="brentq",
                         bracket=[0, 1 / M])  # TODO
@@ -64,6 +64,7 @@ def get_hoeffding_radius(n, M, v_sum, delta):
     v: proxy for sum of conditional variances sum[i to n] E[X[i]^2|F[i-1]]
     delta: significance level
     """
+    from scipy.optimize import root_scalar
     with catch_warnings() as w:
         simplefilter("ignore", RuntimeWarning)
         xstar = root_scalar(lambda x: hoeffding_rhs(x, n, M, v_sum) - delta, 
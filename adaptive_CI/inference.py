@@ -3,53 +3,228 @@ This script contains helper functions to do inference including computing scores
 """
 
 import numpy as np
-from scipy.stats import norm
-from confseq import boundaries
-from adaptive_CI.compute import *
-from adaptive_CI.inequalities import *
+from adaptive_CI.compute import expand
+from adaptive_CI.quantiles import normal_quantile, normal_ci_radius
+from adaptive_CI.profiling import profiled
+from adaptive_CI.horizons import t_opt as cached_t_opt
+from adaptive_CI.kernels import register, get_kernel
 
 
+# confseq is slow to import and only needed by some estimators,
+# so it is loaded on first use rather than when this module is imported.
 
-def aw_scores(rewards, arms, assignment_probs, muhat=None):
+def _boundaries():
+    from confseq import boundaries
+    return boundaries
+
+
+@profiled
+def aw_scores(rewards, arms, assignment_probs, muhat=None, out=None):
     """
     Compute AIPW scores. Return IPW scores if muhat is None.
     e[t] and mu[t, w] are functions of the history up to t-1.
 
+    The scores equal muhat except at the T observed entries (t, arms[t]), so muhat is
+    copied into the output once and only the observed entries are corrected.
+
     INPUT
         - rewards: observed rewards of shape [T]
         - arms: pulled arms of shape [T]
         - assignment_probs: probability of pulling arms of shape [T, K]
         - muhat: plug-in estimator for arms of shape [T, K]
+        - out: optional preallocated array of shape [T, K] the scores are written to (may be muhat itself)
 
     OUTPUT
         - scores: AIPW scores of shape [T, K]
     """
     T, K = assignment_probs.shape
-    balwts = 1 / collect(assignment_probs, arms)
-    scores = expand(balwts * rewards, arms, K)  # Y[t]*W[t]/e[t] term
-    if muhat is not None:  # (1 - W[t]/e[t])mu[t,w] term
-        scores += (1 - expand(balwts, arms, K)) * muhat
-    return scores
-    
+    rows = np.arange(T)
+    balwts = 1 / assignment_probs[rows, arms]
+    if out is None:
+        out = np.empty((T, K))
+    if muhat is None:  # IPW: Y[t]*W[t]/e[t]
+        out[...] = 0
+        out[rows, arms] = balwts * rewards
+        return out
+    observed = muhat[rows, arms]
+    if out is not muhat:
+        out[...] = muhat
+    # Y[t]*W[t]/e[t] + (1 - W[t]/e[t])mu[t,w] at the observed entries, mu[t,w] elsewhere
+    out[rows, arms] = balwts * rewards + (1 - balwts) * observed
+    return out
+
+
+# number of [T, K] entries processed at a time when structured scores are densified
+_CHUNK_ELEMENTS = 2 ** 16
+
+
+class AIPWScores:
+    """
+    AIPW scores stored as the plug-in estimator plus a correction at the observed entries,
+    score[t, w] = muhat[t, w] + correction[t] * 1{w = arms[t]}, without a dense [T, K] score matrix.
+    muhat is referenced, not copied, and is None for IPW scores (a zero plug-in).
+    Build it with aw_structured_scores; evaluate_aipw_stats, evaluate_aipw_contrasts and
+    aw_contrast_stderr accept it in place of a dense score array.
+    """
+
+    def __init__(self, muhat, arms, correction, K):
+        self.muhat = muhat
+        self.arms = np.asarray(arms)
+        self.correction = np.asarray(correction, dtype=float)
+        self.K = K
+
+    @property
+    def shape(self):
+        return (len(self.arms), self.K)
+
+    def __len__(self):
+        return len(self.arms)
+
+    def __getitem__(self, key):
+        """ Rows of the scores, e.g. scores[:T] for a shorter horizon. Only slices are supported. """
+        if not isinstance(key, slice):
+            raise TypeError("AIPWScores only supports slicing rows, use np.asarray(scores) for other indexing.")
+        muhat = None if self.muhat is None else self.muhat[key]
+        return AIPWScores(muhat, self.arms[key], self.correction[key], self.K)
+
+    def rows(self, start, end):
+        """ Dense scores of rows [start, end) of shape [end - start, K]. """
+        end = min(end, len(self))
+        if self.muhat is None:
+            block = np.zeros((end - start, self.K))
+        else:
+            block = np.array(self.muhat[start:end], dtype=float)
+        block[np.arange(end - start), self.arms[start:end]] += self.correction[start:end]
+        return block
+
+    def chunks(self):
+        """ Yield (start, end, dense rows) in blocks of bounded size. """
+        step = max(1, _CHUNK_ELEMENTS // self.K)
+        for start in range(0, len(self), step):
+            end = min(start + step, len(self))
+            yield start, end, self.rows(start, end)
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.rows(0, len(self))
+        return out if dtype is None else out.astype(dtype)
+
+    def _observed(self, x):
+        return x[np.arange(len(self)), self.arms]
+
+    def weighted_sum(self, evalwts):
+        """ Sum of evalwts * scores over rows, of shape [K]. """
+        h_obs = self._observed(evalwts)
+        out = np.bincount(self.arms, weights=h_obs * self.correction, minlength=self.K)
+        if self.muhat is not None:
+            out += np.einsum('tk,tk->k', evalwts, self.muhat)
+        return out
+
+    def weighted_squared_deviation(self, evalwts, center):
+        """ Sum of evalwts**2 * (scores - center)**2 over rows, of shape [K]. """
+        out = np.zeros(self.K)
+        step = max(1, _CHUNK_ELEMENTS // self.K)
+        for start in range(0, len(self), step):
+            end = min(start + step, len(self))
+            dev = -center if self.muhat is None else self.muhat[start:end] - center
+            dev = evalwts[start:end] * dev
+            out += np.einsum('tk,tk->k', dev, dev)
+        # the observed entries deviate by correction more: (d + c)^2 - d^2 = c (2d + c)
+        h_obs = self._observed(evalwts)
+        dev_obs = -center[self.arms] if self.muhat is None else self._observed(self.muhat) - center[self.arms]
+        out += np.bincount(self.arms, weights=h_obs ** 2 * self.correction * (2 * dev_obs + self.correction),
+                           minlength=self.K)
+        return out
+
+
+@profiled
+def aw_structured_scores(rewards, arms, assignment_probs, muhat=None):
+    """
+    Compute AIPW scores as an AIPWScores object. Return IPW scores if muhat is None.
+    Same scores as aw_scores, without allocating a [T, K] score matrix.
+
+    INPUT
+        - rewards: observed rewards of shape [T]
+        - arms: pulled arms of shape [T]
+        - assignment_probs: probability of pulling arms of shape [T, K]
+        - muhat: plug-in estimator for arms of shape [T, K]
 
-def aw_contrast_stderr(score, evalwts, estimate):
+    OUTPUT
+        - scores: AIPWScores of shape [T, K]
     """
-    Compute standard error of estimates of arm contrasts between the last arm and the remaining arms
+    T, K = assignment_probs.shape
+    rows = np.arange(T)
+    balwts = 1 / assignment_probs[rows, arms]
+    observed = 0 if muhat is None else muhat[rows, arms]
+    # score - muhat at the observed entries: W[t]/e[t] (Y[t] - mu[t,w])
+    return AIPWScores(muhat, arms, balwts * (rewards - observed), K)
+
+
+def contrast_matrix(K, kind="last_vs_rest", control=0):
+    """
+    Contrast matrix C of shape [J, K]; row j defines the contrast C[j] @ arm values.
 
     INPUT:
-        - score: AIPW scores of shape [T, K]
-        - evalwts: evaluation weights of shape [T]
-        - estimate: weighted estimates of arm values of shape [K] 
+        - K: number of arms
+        - kind: "last_vs_rest" (last arm minus each other arm, J = K-1),
+                "vs_control" (each other arm minus the control arm, J = K-1) or
+                "pairwise" (arm j minus arm i for every i < j, J = K(K-1)/2)
+        - control: control arm of "vs_control"
+
+    OUTPUT:
+        - contrasts: array of shape [J, K]
+    """
+    eye = np.eye(K)
+    if kind == "last_vs_rest":
+        return eye[-1] - eye[:-1]
+    if kind == "vs_control":
+        others = np.delete(np.arange(K), control)
+        return eye[others] - eye[control]
+    if kind == "pairwise":
+        i, j = np.triu_indices(K, k=1)
+        return eye[j] - eye[i]
+    raise ValueError(f"Unknown contrast kind {kind}.")
+
+
+def _score_chunks(score):
+    """ Yield (start, end, dense rows) of dense or structured scores in blocks of bounded size. """
+    if isinstance(score, AIPWScores):
+        yield from score.chunks()
+        return
+    T, K = score.shape
+    step = max(1, _CHUNK_ELEMENTS // K)
+    for start in range(0, T, step):
+        end = min(start + step, T)
+        yield start, end, score[start:end]
+
+
+@profiled
+def aw_contrast_stderr(score, evalwts, estimate, contrasts=None):
+    """
+    Compute standard error of estimates of arm contrasts, by default between the last arm and the remaining arms.
+
+    The influence of observation t on arm estimate k is u[t, k] = evalwts[t, k] (score[t, k] - estimate[k]) / sum_t evalwts[t, k].
+    The K x K Gram matrix G = U^T U is accumulated over blocks of rows, and the variance of every
+    contrast c is c^T G c, so all contrasts (e.g. all pairs) take a single pass over the scores.
+
+    INPUT:
+        - score: AIPW scores of shape [T, K] (array or AIPWScores)
+        - evalwts: evaluation weights of shape [T, K]
+        - estimate: weighted estimates of arm values of shape [K]
+        - contrasts: contrast matrix of shape [J, K] (see contrast_matrix), last arm vs others if None
 
     OUTPUT:
-        - standard error: shape [K-1]
+        - standard error: shape [J]
     """
+    K = len(estimate)
+    if contrasts is None:
+        contrasts = contrast_matrix(K)
     h_sum = evalwts.sum(0)
-    diff = score - estimate
-    numerator = h_sum[:-1] * evalwts[:, -1:] * diff[:, -1:] - h_sum[-1] * evalwts[:, :-1] * diff[:, :-1]
-    numerator = np.sum(numerator ** 2, axis=0)
-    denominator = h_sum[-1]**2 * h_sum[:-1]**2
-    return np.sqrt(numerator / denominator)
+    gram = np.zeros((K, K))
+    for start, end, block in _score_chunks(score):
+        influence = evalwts[start:end] * (block - estimate) / h_sum
+        gram += influence.T @ influence
+    variance = np.einsum('jk,kl,jl->j', contrasts, gram, contrasts)
+    return np.sqrt(np.maximum(variance, 0))
 
 
     
@@ -60,27 +235,93 @@ def get_statistics(estimate, stderr, truth, ci_radius):
     mse = bias ** 2
     return np.stack((estimate, stderr, bias, coverage, relerr, mse, ci_radius, truth))
 
+
+def get_normal_statistics(estimate, stderr, truth, alpha):
+    """
+    Statistics of normal confidence intervals at one or several levels.
+    The radii of all levels are computed from a single pass over stderr.
+
+    INPUT:
+        - estimate, stderr, truth: arrays of shape [K]
+        - alpha: significance level, or a sequence of significance levels
+
+    OUTPUT:
+        - statistics of shape [8, K] if alpha is a scalar, otherwise a dictionary alpha -> statistics
+    """
+    radius = normal_ci_radius(stderr, alpha)
+    if np.ndim(alpha) == 0:
+        return get_statistics(estimate, stderr, truth, radius)
+    return {a: get_statistics(estimate, stderr, truth, r) for a, r in zip(alpha, radius)}
+
     
+@profiled
 def evaluate_aipw_stats(score, evalwts, truth, alpha=.1):
+    if isinstance(score, AIPWScores):
+        estimate = score.weighted_sum(evalwts) / np.sum(evalwts, 0)
+        stderr = np.sqrt(score.weighted_squared_deviation(evalwts, estimate)) / np.sum(evalwts, 0)
+        return get_normal_statistics(estimate, stderr, truth, alpha)
     estimate = np.sum(evalwts * score, 0) / np.sum(evalwts, 0)
     stderr = np.sqrt(np.sum(evalwts ** 2 * (score - estimate)** 2, 0)) / np.sum(evalwts, 0)
-    ci_radius =  norm.ppf(1 - alpha / 2) * stderr
-    return get_statistics(estimate, stderr, truth, ci_radius)
+    return get_normal_statistics(estimate, stderr, truth, alpha)
+
 
+@profiled
+def evaluate_aipw_stats_horizons(score, evalwts, truth, horizons, alpha=.1):
+    """
+    Compute statistics of arm value estimates at several horizons in one pass, as if the experiment
+    had stopped at each horizon. Only valid for evaluation weights that do not depend on the horizon
+    (e.g. uniform, propensity score and constant allocation weights).
 
+    INPUT:
+        - score: AIPW scores of shape [T, K]
+        - evalwts: evaluation weights of shape [T, K]
+        - truth: true arm values of shape [K]
+        - horizons: horizons to evaluate, each at most T
+        - alpha: significance level, or a sequence of significance levels
+
+    OUTPUT:
+        - list of statistics of arm values (as returned by evaluate_aipw_stats), one per horizon
+    """
+    # each distinct horizon is evaluated once and its statistics are shared by its repetitions
+    ends, inverse = np.unique(horizons, return_inverse=True)
+    starts = np.concatenate([[0], ends[:-1]])
+    score, evalwts = score[:ends[-1]], evalwts[:ends[-1]]
+    # sums over each segment [previous horizon, horizon), accumulated over segments;
+    # the scores are centered first so that the variance does not suffer from cancellation
+    center = score.mean(0)
+    hg = evalwts * (score - center)
+
+    def prefix_sums(x):
+        return np.cumsum(np.add.reduceat(x, starts, axis=0), axis=0)
+
+    h_sum = prefix_sums(evalwts)
+    hg_sum = prefix_sums(hg)
+    h2_sum = prefix_sums(evalwts ** 2)
+    h2g_sum = prefix_sums(hg * evalwts)
+    h2g2_sum = prefix_sums(hg ** 2)
+
+    shift = hg_sum / h_sum
+    estimate = center + shift
+    # sum h^2 (score - estimate)^2 = sum h^2 g^2 - 2 shift sum h^2 g + shift^2 sum h^2, with g = score - center
+    variance = np.maximum(h2g2_sum - 2 * shift * h2g_sum + shift ** 2 * h2_sum, 0)
+    stderr = np.sqrt(variance) / h_sum
+    stats = [get_normal_statistics(estimate[i], stderr[i], truth, alpha) for i in range(len(ends))]
+    return [stats[i] for i in np.ravel(inverse)]
+
+
+@profiled
 def evaluate_sample_mean_naive_stats(outcomes, treatments, truth, K, weights=None, alpha=.1):
     estimate = np.empty(K)
     stderr = np.empty(K)
-    ci_radius = np.empty(K)
     for w in range(K):
         y = outcomes[treatments == w]
         Tw = np.sum(treatments == w)
         estimate[w] = np.mean(y)
-        stderr[w] = se = np.std(y) / np.sqrt(Tw)
-        ci_radius[w] = norm.ppf(1 - alpha/2) * se
-    return get_statistics(estimate, stderr, truth, ci_radius)  
+        stderr[w] = np.std(y) / np.sqrt(Tw)
+    return get_normal_statistics(estimate, stderr, truth, alpha)
     
 
+@profiled
 def evaluate_sample_mean_naive_contrasts(outcomes, treatments, arm_truth, K, weights=None, alpha=.1):
     estimate = np.empty(K-1)
     stderr = np.empty(K-1)
@@ -93,9 +334,10 @@ def evaluate_sample_mean_naive_contrasts(outcomes, treatments, arm_truth, K, wei
         Tw = np.sum(treatments == w)
         estimate[w] = np.mean(y) - np.mean(y_comp)
         stderr[w] = se = np.sqrt(np.var(y) / Tw + np.var(y_comp) / Tw_comp)
-        ci_radius[w] = norm.ppf(1 - alpha/2) * se
+        ci_radius[w] = normal_quantile(alpha) * se
     return get_statistics(estimate, stderr, truth, ci_radius)    
 
+@profiled
 def evaluate_sample_mean_naive_contrasts(outcomes, treatments, arm_truth, K, weights=None, alpha=.1):
     T = len(outcomes)
     arm_estimate = np.empty(K)
@@ -109,13 +351,13 @@ def evaluate_sample_mean_naive_contrasts(outcomes, treatments, arm_truth, K, wei
     estimate = arm_estimate[-1] - arm_estimate[:-1]
     stderr = np.sqrt(arm_variances[-1] + arm_variances[:-1])
     truth = arm_truth[-1] - arm_truth[:-1]
-    ci_radius = norm.ppf(1 - alpha/2) * stderr
-    return get_statistics(estimate, stderr, truth, ci_radius)
+    return get_normal_statistics(estimate, stderr, truth, alpha)
     
 
+@profiled
 def evaluate_beta_bernoulli_stats(outcomes, treatments, truth, K, decay_rate, alpha=.1):
     T = len(outcomes)
-    t_opt =  int((1/K) * np.sum(np.arange(1, T+1)**-decay_rate))
+    t_opt = cached_t_opt(T, K, decay_rate)
     estimate = np.empty(K)
     stderr = np.empty(K)
     ci_radius = np.empty(K)
@@ -126,7 +368,7 @@ def evaluate_beta_bernoulli_stats(outcomes, treatments, truth, K, decay_rate, al
         stderr[w] = np.std(y) / np.sqrt(Tw)
         y_min, y_max = np.min(y), np.max(y)
         y_normalized = (y - y_min) / (y_max - y_min) # normalizing to [0, 1]
-        ci_normalized = boundaries.bernoulli_confidence_interval(  
+        ci_normalized = _boundaries().bernoulli_confidence_interval(  
             num_successes=int(np.sum(y_normalized)), 
             num_trials=Tw, 
             t_opt=t_opt, 
@@ -137,9 +379,10 @@ def evaluate_beta_bernoulli_stats(outcomes, treatments, truth, K, decay_rate, al
     return get_statistics(estimate, stderr, truth, ci_radius)    
 
 
+@profiled
 def evaluate_gamma_exponential_stats(outcomes, treatments, truth, K, decay_rate, c, expected_noise_variance, alpha=.1):
     T = len(outcomes)
-    t_opt =  int((1/K) * np.sum(np.arange(1, T+1)**-decay_rate))
+    t_opt = cached_t_opt(T, K, decay_rate)
     v_opt = t_opt * expected_noise_variance
     estimate = np.empty(K)
     stderr = np.empty(K)
@@ -152,7 +395,7 @@ def evaluate_gamma_exponential_stats(outcomes, treatments, truth, K, decay_rate,
         lagged_means = np.roll(np.cumsum(y) / np.arange(1, Tw + 1), 1)
         Vt = np.sum((y - lagged_means)**2)
         ci_radius[w] = (1 / Tw *
-                        boundaries.gamma_exponential_mixture_bound(
+                        _boundaries().gamma_exponential_mixture_bound(
                             v=Vt,
                             v_opt=v_opt, 
                             c=c, 
@@ -161,29 +404,37 @@ def evaluate_gamma_exponential_stats(outcomes, treatments, truth, K, decay_rate,
     return get_statistics(estimate, stderr, truth, ci_radius) 
     
 
-def evaluate_aipw_contrasts(scores, evalwts, arm_truth, alpha=.1):
+@profiled
+def evaluate_aipw_contrasts(scores, evalwts, arm_truth, alpha=.1, contrasts=None):
     """
-    Compute statistics of arm contrast estimations (last arm vs others)
+    Compute statistics of arm contrast estimations (by default last arm vs others)
 
     INPUT:
-        - score: AIPW scores of shape [T, K]
-        - evalwts: evaluation weights of shape [T]
+        - score: AIPW scores of shape [T, K] (array or AIPWScores)
+        - evalwts: evaluation weights of shape [T, K]
         - truth: true arm values of shape [K]
+        - alpha: significance level, or a sequence of significance levels
+        - contrasts: contrast matrix of shape [J, K] (see contrast_matrix), last arm vs others if None
 
     OUTPUT:
-        - statistics of arm contrasts
+        - statistics of arm contrasts (a dictionary alpha -> statistics if alpha is a sequence)
     """
-    arm_estimate = np.sum(evalwts * scores, 0) / np.sum(evalwts, 0)
-    estimate = arm_estimate[-1] - arm_estimate[:-1]
-    stderr = aw_contrast_stderr(scores, evalwts, arm_estimate)
-    truth = arm_truth[-1] - arm_truth[:-1]
-    ci_radius = norm.ppf(1 - alpha / 2) * stderr 
-    return get_statistics(estimate, stderr, truth, ci_radius)
-
-
+    if contrasts is None:
+        contrasts = contrast_matrix(len(arm_truth))
+    if isinstance(scores, AIPWScores):
+        arm_estimate = scores.weighted_sum(evalwts) / np.sum(evalwts, 0)
+    else:
+        arm_estimate = np.sum(evalwts * scores, 0) / np.sum(evalwts, 0)
+    estimate = contrasts @ arm_estimate
+    stderr = aw_contrast_stderr(scores, evalwts, arm_estimate, contrasts)
+    truth = contrasts @ arm_truth
+    return get_normal_statistics(estimate, stderr, truth, alpha)
+
+
+@profiled
 def evaluate_beta_bernoulli_contrasts(outcomes, treatments, arm_truth, K, decay_rate, alpha=.1):
     T = len(outcomes)
-    t_opt =  int((1/K) * np.sum(np.arange(1, T+1)**-decay_rate))
+    t_opt = cached_t_opt(T, K, decay_rate)
     arm_estimate = np.empty(K)
     arm_variances = np.empty(K)
     arm_ci = np.empty((K, 2))
@@ -196,7 +447,7 @@ def evaluate_beta_bernoulli_contrasts(outcomes, treatments, arm_truth, K, decay_
         y_min, y_max = np.min(y), np.max(y)
         y_normalized = (y - y_min) / (y_max - y_min) # normalizing to [0, 1]
         try:
-            ci_normalized = boundaries.bernoulli_confidence_interval(  
+            ci_normalized = _boundaries().bernoulli_confidence_interval(  
                 num_successes=int(np.sum(y_normalized)), 
                 num_trials=Tw, 
                 t_opt=t_opt, 
@@ -219,10 +470,11 @@ def evaluate_beta_bernoulli_contrasts(outcomes, treatments, arm_truth, K, decay_
     return get_statistics(estimate, stderr, truth, ci_radius)
 
 
+@profiled
 def evaluate_gamma_exponential_contrasts(outcomes, treatments, arm_truth, K, decay_rate, c, 
                                              expected_noise_variance, alpha=.1):   
     T = len(outcomes)     
-    t_opt =  int((1/K) * np.sum(np.arange(1, T+1)**-decay_rate))
+    t_opt = cached_t_opt(T, K, decay_rate)
     v_opt = t_opt * expected_noise_variance
     arm_estimate = np.empty(K)
     arm_variances = np.empty(K)
@@ -236,7 +488,7 @@ def evaluate_gamma_exponential_contrasts(outcomes, treatments, arm_truth, K, dec
         lagged_means = np.roll(np.cumsum(y) / np.arange(1, Tw + 1), 1)
         Vt = np.sum((y - lagged_means)**2)
         arm_ci_radius = (1 / Tw *
-                            boundaries.gamma_exponential_mixture_bound(
+                            _boundaries().gamma_exponential_mixture_bound(
                                 v=Vt,
                                 v_opt=v_opt, 
                                 c=c, 
@@ -256,7 +508,8 @@ def evaluate_gamma_exponential_contrasts(outcomes, treatments, arm_truth, K, dec
 
     
 
-def wdecorr_stats(arms, rewards, K, W_lambdas, truth, alpha=0.10):
+@profiled
+def wdecorr_stats(arms, rewards, K, W_lambdas, truth, alpha=0.10, backend=None):
     """
     Compute W-decorrelation estimates of arm values
     Adapted from Multi-armed Bandits.ipynb in https://github.com/yash-deshpande/decorrelating-linear-models.
@@ -268,9 +521,12 @@ def wdecorr_stats(arms, rewards, K, W_lambdas, truth, alpha=0.10):
         - K: number of arms
         - W_lambdas: bias-variance tradeoff parameter lambda in W-decorrelation paper, of shape [T]
         - truth: true arm values of shape [K]
+        - alpha: significance level, or a sequence of significance levels
+        - backend: kernel backend of the recursion, see kernels.py
 
     OUTPUT:
         - W-decorrelation statistics of arm values: [estimate, S.E., bias, (1-alpha)-coverage, t-statistic, MSE, confidence_interval_radius, truth]
+          (a dictionary alpha -> statistics if alpha is a sequence)
     """
     T = len(arms)
 
@@ -281,6 +537,14 @@ def wdecorr_stats(arms, rewards, K, W_lambdas, truth, alpha=0.10):
     samplevars = np.sum(arms_W * (arms_Y - samplemean) ** 2,
                         0) / (np.maximum(np.sum(arms_W, 0), 1))
 
+    estimate, variances = get_kernel("wdecorr", backend)(arms, rewards, samplemean, samplevars, W_lambdas)
+    stderr = np.sqrt(variances)
+    return get_normal_statistics(estimate, stderr, truth, alpha)
+
+
+@register("wdecorr", "numpy")
+def _wdecorr_numpy(arms, rewards, samplemean, samplevars, W_lambdas):
+    T, K = len(arms), len(samplemean)
     # latest parameter estimate vector
     beta = np.copy(samplemean)
     # Latest w_t vector
@@ -305,18 +569,10 @@ def wdecorr_stats(arms, rewards, K, W_lambdas, truth, alpha=0.10):
         WX[:, arm] += w
         # Update marginal variances
         variances += samplevars * w ** 2
-    estimate = beta
-    stderr = np.sqrt(variances)
-    bias = estimate - truth
-    tstat = bias / stderr
-    tstat[stderr == 0] = np.nan
-    quantile = norm.ppf(1 - alpha / 2)
-    cover = (np.abs(tstat) < quantile).astype(np.float_)
-    ci_r = quantile * stderr
-    error = bias ** 2
-    return np.stack((estimate, stderr, bias, cover, tstat, error, ci_r, truth))
+    return beta, variances
 
 
+@profiled
 def sample_mean(rewards, arms, K):
     """
     Compute F_{t} measured sample mean estimator
@@ -331,8 +587,96 @@ def sample_mean(rewards, arms, K):
     """
     # return F_t measured sample mean
     T = len(arms)
-    W = expand(np.ones(T), arms, K)
-    Y = expand(rewards, arms, K)
-    estimate = np.cumsum(W * Y, 0) / np.maximum(np.cumsum(W, 0), 1)
+    estimate = np.zeros((T, K))
+    estimate[np.arange(T), arms] = rewards
+    np.cumsum(estimate, axis=0, out=estimate)
+    counts = np.zeros((T, K))
+    counts[np.arange(T), arms] = 1
+    np.cumsum(counts, axis=0, out=counts)
+    estimate /= np.maximum(counts, 1, out=counts)
     return estimate
-    
+
+
+def _lagged_onehot(values, arms, K, out):
+    """ Fill out[t] with values[t-1] at column arms[t-1] (zero elsewhere, and in row 0). """
+    T = len(arms)
+    if out is None:
+        out = np.zeros((T, K))
+    else:
+        out[...] = 0
+    out[np.arange(1, T), arms[:-1]] = values[:-1]
+    return out
+
+
+@profiled
+def lagged_sample_mean(rewards, arms, K, out=None):
+    """
+    Compute F_{t-1} measured sample mean estimator, i.e. the plug-in muhat used by aw_scores.
+    Equals sample_mean(rewards, arms, K) shifted down by one row, with zeros in the first row.
+
+    INPUT:
+        - rewards: observed rewards of shape [T]
+        - arms: pulled arms of shape [T]
+        - K: number of arms
+        - out: optional preallocated array of shape [T, K] the estimate is written to
+
+    OUTPUT:
+        - estimate: F_{t-1} measured sample mean estimator of shape [T, K]
+    """
+    out = _lagged_onehot(rewards, arms, K, out)
+    np.cumsum(out, axis=0, out=out)
+    counts = _lagged_onehot(np.ones(len(arms)), arms, K, None)
+    np.cumsum(counts, axis=0, out=counts)
+    np.maximum(counts, 1, out=counts)
+    out /= counts
+    return out
+
+
+def _discounted_cumsum(x, discount):
+    """
+    In-place discounted cumulative sum along axis 0: x[t] <- sum_{s<=t} discount^(t-s) x[s].
+    Rows are processed in blocks short enough that rescaling by discount^(-s) within a block
+    neither overflows nor loses precision; the running sum is carried between blocks.
+    """
+    T = len(x)
+    block = T if discount == 1 else max(1, int(np.log(2.0 ** -20) / np.log(discount)))
+    carry = np.zeros(x.shape[1:])
+    for start in range(0, T, block):
+        end = min(start + block, T)
+        powers = discount ** np.arange(end - start)
+        powers = powers.reshape((-1,) + (1,) * (x.ndim - 1))
+        chunk = x[start:end]
+        chunk /= powers
+        np.cumsum(chunk, axis=0, out=chunk)
+        chunk += discount * carry
+        chunk *= powers
+        carry = chunk[-1].copy()
+    return x
+
+
+@profiled
+def lagged_discounted_mean(rewards, arms, K, discount, out=None):
+    """
+    Compute F_{t-1} measured discounted sample mean estimator, an alternative plug-in muhat for aw_scores
+    that tracks drifting arm values. The reward observed s periods ago has weight discount^s.
+    discount=1 gives lagged_sample_mean.
+
+    INPUT:
+        - rewards: observed rewards of shape [T]
+        - arms: pulled arms of shape [T]
+        - K: number of arms
+        - discount: discount factor in (0, 1]
+        - out: optional preallocated array of shape [T, K] the estimate is written to
+
+    OUTPUT:
+        - estimate: F_{t-1} measured discounted sample mean estimator of shape [T, K]
+    """
+    if not 0 < discount <= 1:
+        raise ValueError(f"discount must be in (0, 1], got {discount}.")
+    out = _lagged_onehot(rewards, arms, K, out)
+    _discounted_cumsum(out, discount)
+    counts = _lagged_onehot(np.ones(len(arms)), arms, K, None)
+    _discounted_cumsum(counts, discount)
+    # arms not pulled yet keep a zero estimate, as in lagged_sample_mean
+    np.divide(out, counts, out=out, where=counts > 0)
+    return out
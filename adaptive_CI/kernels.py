@@ -0,0 +1,283 @@
+"""
+This script contains a registry of backends for the sequential kernels that cannot be vectorized over time.
+
+Each kernel has a NumPy reference implementation, registered next to the public function that calls it
+(`stick_breaking` in compute.py, `wdecorr_stats` in inference.py, `run_mab_experiment` in experiments.py),
+and a scalar loop written here that is compiled with numba on first use ("numba" backend) or run by the
+interpreter ("python" backend, only useful to check the loops without numba).
+
+The backend is chosen per call (argument `backend`) or with the environment variable ADAPTIVE_CI_BACKEND:
+"numpy" (default), "numba", or "auto" (numba if it is installed, NumPy otherwise). numba is imported when
+a kernel is first compiled, not when this module is imported.
+
+The numba Thompson sampling loop draws the random numbers of a block of steps at once from the global
+NumPy generator, so for a given seed its trajectories differ from the NumPy reference (they have the same
+distribution); epsilon-greedy and random agents draw the same numbers and give identical trajectories.
+"""
+
+import os
+from functools import lru_cache
+from importlib.util import find_spec
+
+import numpy as np
+
+__all__ = [
+    "BACKENDS",
+    "register",
+    "get_kernel",
+    "resolve_backend",
+    "numba_available",
+]
+
+BACKENDS = ("numpy", "numba", "python")
+BACKEND_VARIABLE = "ADAPTIVE_CI_BACKEND"
+
+# number of bandit steps whose random numbers are drawn at once by the compiled loop
+MAB_BLOCK_STEPS = 4096
+
+_KERNELS = {}
+
+# exploration codes of the compiled bandit loop
+_TS, _TS_EXPLORATION, _EG, _RAN = range(4)
+
+
+def register(kernel, backend):
+    """ Decorator registering `func` as the implementation of `kernel` for `backend`. """
+    def decorator(func):
+        _KERNELS.setdefault(kernel, {})[backend] = func
+        return func
+    return decorator
+
+
+@lru_cache(maxsize=None)
+def numba_available():
+    return find_spec("numba") is not None
+
+
+def resolve_backend(backend=None):
+    """ Name of the backend used for `backend` (None reads ADAPTIVE_CI_BACKEND). """
+    backend = backend or os.environ.get(BACKEND_VARIABLE, "numpy")
+    if backend == "auto":
+        return "numba" if numba_available() else "numpy"
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS} or 'auto'.")
+    if backend == "numba" and not numba_available():
+        raise ImportError("The numba backend requires numba (pip install numba).")
+    return backend
+
+
+def get_kernel(kernel, backend=None):
+    """ Implementation of `kernel` for `backend` (see resolve_backend). """
+    return _KERNELS[kernel][resolve_backend(backend)]
+
+
+@lru_cache(maxsize=None)
+def _jit(loop):
+    import numba
+    # error_model="numpy" keeps NumPy's inf/nan results of divisions by zero instead of raising
+    return numba.njit(cache=True, error_model="numpy")(loop)
+
+
+def _register_loop(kernel, loop, wrap):
+    """ Register the interpreted and the compiled version of `loop`, called through `wrap`. """
+    register(kernel, "python")(wrap(lambda: loop))
+    register(kernel, "numba")(wrap(lambda: _jit(loop)))
+
+
+# -------------------------------------------------------
+# stick breaking
+
+def _stick_breaking_loop(Z, weight_sum):
+    T, K = Z.shape
+    weights = np.empty((T, K))
+    for t in range(T):
+        for k in range(K):
+            weights[t, k] = Z[t, k] * (1 - weight_sum[k])
+            weight_sum[k] += weights[t, k]
+    return weights
+
+
+def _stick_breaking_kernel(get_loop):
+    def stick_breaking(Z, weight_sum):
+        return get_loop()(np.ascontiguousarray(Z, dtype=np.float64), np.array(weight_sum, dtype=np.float64))
+    return stick_breaking
+
+
+_register_loop("stick_breaking", _stick_breaking_loop, _stick_breaking_kernel)
+
+
+# -------------------------------------------------------
+# W-decorrelation
+
+def _wdecorr_loop(arms, rewards, samplemean, samplevars, W_lambdas):
+    T, K = len(arms), len(samplemean)
+    beta = samplemean.copy()
+    w = np.zeros(K)
+    WX = np.zeros((K, K))
+    variances = np.zeros(K)
+    for t in range(T):
+        arm = arms[t]
+        for k in range(K):
+            w[k] = -WX[k, arm]
+        w[arm] += 1
+        residual = rewards[t] - samplemean[arm]
+        for k in range(K):
+            w[k] /= (1.0 + W_lambdas[k, t])
+            beta[k] += w[k] * residual
+            WX[k, arm] += w[k]
+            variances[k] += samplevars[k] * (w[k] * w[k])
+    return beta, variances
+
+
+def _wdecorr_kernel(get_loop):
+    def wdecorr(arms, rewards, samplemean, samplevars, W_lambdas):
+        T, K = len(arms), len(samplemean)
+        return get_loop()(np.asarray(arms, dtype=np.int64), np.asarray(rewards, dtype=np.float64),
+                          np.asarray(samplemean, dtype=np.float64), np.asarray(samplevars, dtype=np.float64),
+                          np.ascontiguousarray(np.broadcast_to(W_lambdas, (K, T)), dtype=np.float64))
+    return wdecorr
+
+
+_register_loop("wdecorr", _wdecorr_loop, _wdecorr_kernel)
+
+
+# -------------------------------------------------------
+# multi-armed bandit experiment
+
+def _mab_loop(ys, start, end, T0, floor_start, floor_decay, mode, epsilon,
+              sums, sums2, neff, normals, uniforms, arms, rewards, probs):
+    """
+    Steps start, ..., end - 1 of run_mab_experiment. normals [n, num_mc, K] (Thompson sampling) and
+    uniforms [n] hold the random numbers of the n steps from max(start, T0) on.
+    """
+    K = ys.shape[1]
+    num_mc = normals.shape[1]
+    first = max(start, T0)
+    p = np.empty(K)
+    posterior_sd = np.empty(K)
+    posterior_mean = np.empty(K)
+    wins = np.zeros(K)
+    for t in range(start, end):
+        if t < T0:
+            for k in range(K):
+                p[k] = 1 / K
+            w = t % K
+        else:
+            j = t - first
+            if mode == _RAN:
+                for k in range(K):
+                    p[k] = 1 / K
+            elif mode == _EG:
+                best = -np.inf
+                for k in range(K):
+                    best = max(best, sums[k] / max(neff[k], 1))
+                num_max = 0
+                for k in range(K):
+                    if sums[k] / max(neff[k], 1) == best:
+                        num_max += 1
+                for k in range(K):
+                    p[k] = epsilon / K + (1 - epsilon) * (sums[k] / max(neff[k], 1) == best) / num_max
+            else:
+                # Thompson sampling with prior N(0, 1), see ts_mab_probs
+                for k in range(K):
+                    mu = sums[k] / max(neff[k], 1)
+                    var = sums2[k] / max(neff[k], 1) - mu * mu
+                    posterior_sd[k] = np.sqrt(1 / (neff[k] / var + 1 / 1.0))
+                    posterior_mean[k] = neff[k] / (var + neff[k]) * mu
+                    wins[k] = 0
+                for m in range(num_mc):
+                    # argmax, returning the first nan like np.argmax
+                    best_arm = 0
+                    best_value = normals[j, m, 0] * posterior_sd[0] + posterior_mean[0]
+                    for k in range(1, K):
+                        if np.isnan(best_value):
+                            break
+                        value = normals[j, m, k] * posterior_sd[k] + posterior_mean[k]
+                        if np.isnan(value) or value > best_value:
+                            best_arm, best_value = k, value
+                    wins[best_arm] += 1
+                # assignment probability floor, see apply_floor
+                amin = floor_start / (t + 1) ** floor_decay
+                total = 0.0
+                slack_sum = 0.0
+                for k in range(K):
+                    p[k] = max(wins[k] / num_mc, amin)
+                    total += p[k]
+                    slack_sum += p[k] - amin
+                c = (total - 1) / slack_sum if slack_sum > 0 else 0.0
+                for k in range(K):
+                    p[k] = p[k] - c * (p[k] - amin)
+                if mode == _TS_EXPLORATION:
+                    total = 0.0
+                    for k in range(K):
+                        p[k] = p[k] * (1 - p[k])
+                        total += p[k]
+                    for k in range(K):
+                        p[k] = p[k] / total
+            # np.random.choice(K, p=p)
+            cdf_total = 0.0
+            for k in range(K):
+                cdf_total += p[k]
+            w = 0
+            cdf = 0.0
+            for k in range(K - 1):
+                cdf += p[k]
+                if cdf / cdf_total <= uniforms[j]:
+                    w = k + 1
+        y = ys[t, w]
+        sums[w] += y
+        sums2[w] += y * y
+        neff[w] += 1
+        arms[t] = w
+        rewards[t] = y
+        for k in range(K):
+            probs[t - start, k] = p[k]
+
+
+def _exploration_mode(exploration):
+    if exploration == 'TS':
+        return _TS, 0.
+    if exploration == 'TS_exploration':
+        return _TS_EXPLORATION, 0.
+    if exploration.startswith('EG'):
+        _, epsilon = exploration.split('_')
+        return _EG, float(epsilon)
+    if exploration == 'RAN':
+        return _RAN, 0.
+    raise NotImplementedError(
+        'Only implement TS(thompson)/TS_exploration(p(1-p)) / EG(epsilon greedy)/ RAN(random) exploration!')
+
+
+def _mab_kernel(get_loop):
+    def mab_steps(ys, T0, floor_start, floor_decay, exploration, sums, sums2, neff, num_mc=20):
+        mode, epsilon = _exploration_mode(exploration)
+        loop = get_loop()
+        ys = np.ascontiguousarray(ys, dtype=np.float64)
+        sums, sums2, neff = (np.asarray(a, dtype=np.float64) for a in (sums, sums2, neff))
+        T, K = ys.shape
+        arms = np.empty(T, dtype=np.int_)
+        rewards = np.empty(T)
+        run_starts, run_values = [np.zeros(0, dtype=np.int64)], [np.zeros((0, K))]
+        for start in range(0, T, MAB_BLOCK_STEPS):
+            end = min(start + MAB_BLOCK_STEPS, T)
+            n = max(0, end - max(start, T0))
+            if mode in (_TS, _TS_EXPLORATION):
+                normals = np.random.normal(size=(n, num_mc, K))
+            else:
+                normals = np.zeros((0, num_mc, K))
+            uniforms = np.random.random_sample(n)
+            probs = np.empty((end - start, K))
+            loop(ys, start, end, T0, floor_start, floor_decay, mode, epsilon,
+                 sums, sums2, neff, normals, uniforms, arms, rewards, probs)
+            # run-length compress, continuing the last run of the previous block
+            new_run = np.ones(len(probs), dtype=bool)
+            new_run[1:] = np.any(probs[1:] != probs[:-1], axis=1)
+            if len(run_values[-1]) and np.array_equal(probs[0], run_values[-1][-1]):
+                new_run[0] = False
+            run_starts.append(start + np.flatnonzero(new_run))
+            run_values.append(probs[new_run])
+        return arms, rewards, np.concatenate(run_starts), np.concatenate(run_values)
+    return mab_steps
+
+
+_register_loop("mab_steps", _mab_loop, _mab_kernel)
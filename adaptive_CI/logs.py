@@ -0,0 +1,259 @@
+"""
+This script contains a streaming loader and evaluator of logged experiments (e.g. production bandit logs) that do not fit in memory.
+
+A log has one row per time step with the pulled arm, the observed reward and the assignment probabilities
+of every arm. `read_log_chunks` reads it from CSV, Parquet or a directory of .npy files in chunks of rows
+with the shapes expected by `aw_scores` and `evaluate_aipw_stats` (arms [n], rewards [n], probs [n, K]).
+`AIPWAccumulator` consumes the chunks in order and keeps O(K^2) running sums, so that the AIPW estimates,
+standard errors and contrasts of the whole log are obtained with memory proportional to the chunk size.
+
+    accumulator = evaluate_log("experiment.csv", K=3, weights="two_point", T=num_rows, floor_decay=.7)
+    stats = accumulator.stats(truth)
+"""
+
+import os
+import numpy as np
+
+from adaptive_CI.compute import stick_breaking
+from adaptive_CI.inference import aw_scores, contrast_matrix, get_normal_statistics
+from adaptive_CI.weights import twopoint_stable_var_ratio
+
+__all__ = [
+    "read_log_chunks",
+    "AIPWAccumulator",
+    "evaluate_log",
+]
+
+LOG_FORMATS = ("csv", "parquet", "npy")
+
+
+def _log_format(path):
+    if os.path.isdir(path):
+        return "npy"
+    name = path.lower()
+    if name.endswith((".csv", ".csv.gz", ".csv.bz2", ".csv.zip")):
+        return "csv"
+    if name.endswith((".parquet", ".pq")):
+        return "parquet"
+    raise ValueError(f"Cannot infer the format of {path}, pass one of {LOG_FORMATS}.")
+
+
+def _prob_columns(columns, prob_cols):
+    """ Probability columns, by default the columns named prob_0, prob_1, ... ordered by arm. """
+    if prob_cols is not None:
+        return list(prob_cols)
+    cols = [c for c in columns if c.startswith("prob_") and c[len("prob_"):].isdigit()]
+    if not cols:
+        raise ValueError("No assignment probability columns (prob_0, prob_1, ...) found, pass prob_cols.")
+    return sorted(cols, key=lambda c: int(c[len("prob_"):]))
+
+
+def _chunk(arms, rewards, probs):
+    arms = np.asarray(arms).astype(np.int64, copy=False)
+    rewards = np.asarray(rewards, dtype=float)
+    probs = np.asarray(probs, dtype=float)
+    if probs.ndim != 2 or len(probs) != len(arms) or len(rewards) != len(arms):
+        raise ValueError(f"Inconsistent chunk shapes: arms {arms.shape}, rewards {rewards.shape}, probs {probs.shape}.")
+    if len(arms) and (arms.min() < 0 or arms.max() >= probs.shape[1]):
+        raise ValueError(f"Arms must be integers in [0, {probs.shape[1]}).")
+    return dict(arms=arms, rewards=rewards, probs=probs)
+
+
+def read_log_chunks(path, arm_col="arm", reward_col="reward", prob_cols=None, chunk_size=1_000_000, format=None):
+    """
+    Read a logged experiment in chunks of rows, in time order.
+
+    INPUT:
+        - path: CSV or Parquet file, or directory with arms.npy [T], rewards.npy [T] and probs.npy [T, K]
+        - arm_col: column of pulled arms (integers 0, ..., K-1)
+        - reward_col: column of observed rewards
+        - prob_cols: columns of assignment probabilities, one per arm in arm order (default prob_0, prob_1, ...)
+        - chunk_size: number of rows per chunk
+        - format: "csv", "parquet" or "npy" (inferred from path if None)
+
+    OUTPUT:
+        - iterator of dictionaries with arms [n], rewards [n] and probs [n, K]
+    """
+    format = _log_format(path) if format is None else format
+    if format == "npy":
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ("arms", "rewards", "probs")}
+        for start in range(0, len(arrays["arms"]), chunk_size):
+            yield _chunk(*(arrays[name][start:start + chunk_size] for name in ("arms", "rewards", "probs")))
+    elif format == "csv":
+        import pandas as pd
+        for df in pd.read_csv(path, chunksize=chunk_size):
+            cols = _prob_columns(df.columns, prob_cols)
+            yield _chunk(df[arm_col].to_numpy(), df[reward_col].to_numpy(), df[cols].to_numpy())
+    elif format == "parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Reading Parquet logs requires pyarrow (pip install pyarrow).")
+        parquet = pq.ParquetFile(path)
+        cols = _prob_columns(parquet.schema_arrow.names, prob_cols)
+        for batch in parquet.iter_batches(batch_size=chunk_size, columns=[arm_col, reward_col] + cols):
+            columns = {name: batch.column(name).to_numpy() for name in [arm_col, reward_col] + cols}
+            yield _chunk(columns[arm_col], columns[reward_col], np.column_stack([columns[c] for c in cols]))
+    else:
+        raise ValueError(f"Unknown log format {format}, expected one of {LOG_FORMATS}.")
+
+
+class AIPWAccumulator:
+    """
+    Streaming AIPW evaluation of arm values and contrasts. Chunks must be fed in time order.
+
+    The plug-in muhat is the F_{t-1} sample mean (lagged_sample_mean), whose running sums and counts are
+    carried between chunks. Scores are centered at the first chunk's mean score g = score - center,
+    and the running sums of h, h g and h^2 (g - shift)^2-type moments, plus the K x K Gram matrices of
+    h g and h, give the estimates, standard errors and contrast covariances of the whole log.
+
+    INPUT:
+        - K: number of arms
+        - weights: evaluation weights, "uniform", "propscore", "lvdl" or "two_point"
+        - T: total number of rows (required by two_point weights)
+        - floor_decay: assignment probability floor decaying rate (required by two_point weights)
+    """
+
+    def __init__(self, K, weights="lvdl", T=None, floor_decay=None):
+        if weights not in ("uniform", "propscore", "lvdl", "two_point"):
+            raise ValueError(f"Unknown evaluation weights {weights}.")
+        if weights == "two_point" and (T is None or floor_decay is None):
+            raise ValueError("two_point weights need the total number of rows T and the floor_decay.")
+        self.K, self.weights, self.T, self.floor_decay = K, weights, T, floor_decay
+        self.num_rows = 0
+        self.reward_sums = np.zeros(K)
+        self.counts = np.zeros(K)
+        self.h2e_sum = np.zeros(K)  # stick-breaking state of two_point weights
+        self.center = None
+        self.h_sum = np.zeros(K)
+        self.h2_sum = np.zeros(K)
+        self.hg_sum = np.zeros(K)
+        self.h2g_sum = np.zeros(K)
+        self.h2g2_sum = np.zeros(K)
+        # Gram matrices sum_t a[t]^T a[t], a[t]^T b[t] and b[t]^T b[t] with a = h g and b = h
+        self.gram_aa = np.zeros((K, K))
+        self.gram_ab = np.zeros((K, K))
+        self.gram_bb = np.zeros((K, K))
+
+    def _muhat(self, arms, rewards):
+        """ F_{t-1} sample mean of the chunk rows, continuing the running sums of earlier chunks. """
+        n = len(arms)
+        rows = np.arange(n)
+        onehot = np.zeros((n, self.K))
+        onehot[rows, arms] = rewards
+        sums = np.cumsum(onehot, axis=0)
+        sums -= onehot
+        sums += self.reward_sums
+        onehot[rows, arms] = 1
+        counts = np.cumsum(onehot, axis=0)
+        counts -= onehot
+        counts += self.counts
+        self.reward_sums = sums[-1] + np.bincount(arms[-1:], weights=rewards[-1:], minlength=self.K)
+        self.counts = counts[-1] + np.bincount(arms[-1:], minlength=self.K)
+        sums /= np.maximum(counts, 1)
+        return sums
+
+    def _evalwts(self, probs):
+        if self.weights == "uniform":
+            return np.ones_like(probs)
+        if self.weights == "propscore":
+            return probs
+        if self.weights == "lvdl":
+            return np.sqrt(probs)
+        ratio = twopoint_stable_var_ratio(probs, self.floor_decay, T=self.T, start=self.num_rows)
+        h2es = stick_breaking(ratio, initial_sum=self.h2e_sum)
+        self.h2e_sum = self.h2e_sum + h2es.sum(0)
+        return np.sqrt(np.maximum(0., h2es * probs))
+
+    def update(self, arms, rewards, probs):
+        """ Add the next chunk of rows: arms [n], rewards [n], probs [n, K]. """
+        if len(arms) == 0:
+            return self
+        if self.T is not None and self.num_rows + len(arms) > self.T:
+            raise ValueError(f"More than T={self.T} rows were fed.")
+        muhat = self._muhat(arms, rewards)
+        scores = aw_scores(rewards, arms, probs, muhat, out=muhat)
+        h = self._evalwts(probs)
+        if self.center is None:
+            self.center = scores.mean(0)
+        a = h * (scores - self.center)
+        self.h_sum += h.sum(0)
+        self.h2_sum += np.einsum('tk,tk->k', h, h)
+        self.hg_sum += a.sum(0)
+        self.h2g_sum += np.einsum('tk,tk->k', a, h)
+        self.h2g2_sum += np.einsum('tk,tk->k', a, a)
+        self.gram_aa += a.T @ a
+        self.gram_ab += a.T @ h
+        self.gram_bb += h.T @ h
+        self.num_rows += len(arms)
+        return self
+
+    def update_chunk(self, chunk):
+        """ Add a chunk as returned by read_log_chunks. """
+        return self.update(chunk["arms"], chunk["rewards"], chunk["probs"])
+
+    def estimate(self):
+        """ Estimates of arm values of shape [K] and the shifts from the center. """
+        shift = self.hg_sum / self.h_sum
+        return self.center + shift, shift
+
+    def stats(self, truth=None, alpha=.1):
+        """
+        Statistics of arm value estimates as returned by evaluate_aipw_stats.
+        Without truth (e.g. for real logs), the bias, coverage, t-stat and mse rows are nan.
+        """
+        estimate, shift = self.estimate()
+        # sum h^2 (score - estimate)^2 = sum h^2 g^2 - 2 shift sum h^2 g + shift^2 sum h^2, with g = score - center
+        variance = np.maximum(self.h2g2_sum - 2 * shift * self.h2g_sum + shift ** 2 * self.h2_sum, 0)
+        stderr = np.sqrt(variance) / self.h_sum
+        truth = np.full(self.K, np.nan) if truth is None else np.asarray(truth, dtype=float)
+        return get_normal_statistics(estimate, stderr, truth, alpha)
+
+    def contrast_covariance(self):
+        """ K x K covariance of the arm value estimates (the Gram matrix of aw_contrast_stderr). """
+        estimate, shift = self.estimate()
+        # sum_t (a_k - shift_k b_k)(a_l - shift_l b_l) expanded in the three Gram matrices
+        gram = (self.gram_aa
+                - self.gram_ab * shift[np.newaxis, :]
+                - self.gram_ab.T * shift[:, np.newaxis]
+                + self.gram_bb * np.outer(shift, shift))
+        return gram / np.outer(self.h_sum, self.h_sum)
+
+    def contrasts(self, truth=None, alpha=.1, contrasts=None):
+        """
+        Statistics of arm contrast estimates as returned by evaluate_aipw_contrasts.
+
+        INPUT:
+            - truth: true arm values of shape [K] (optional)
+            - alpha: significance level, or a sequence of significance levels
+            - contrasts: contrast matrix of shape [J, K] (see contrast_matrix), last arm vs others if None
+        """
+        if contrasts is None:
+            contrasts = contrast_matrix(self.K)
+        estimate, _ = self.estimate()
+        variance = np.einsum('jk,kl,jl->j', contrasts, self.contrast_covariance(), contrasts)
+        stderr = np.sqrt(np.maximum(variance, 0))
+        truth = np.full(self.K, np.nan) if truth is None else np.asarray(truth, dtype=float)
+        return get_normal_statistics(contrasts @ estimate, stderr, contrasts @ truth, alpha)
+
+
+def evaluate_log(path, K=None, weights="lvdl", T=None, floor_decay=None, chunk_size=1_000_000, **read_kwargs):
+    """
+    Evaluate a logged experiment chunk by chunk.
+
+    INPUT:
+        - path, chunk_size, read_kwargs: see read_log_chunks
+        - K: number of arms (inferred from the first chunk if None)
+        - weights, T, floor_decay: see AIPWAccumulator
+
+    OUTPUT:
+        - accumulator: AIPWAccumulator fed with the whole log
+    """
+    accumulator = None
+    for chunk in read_log_chunks(path, chunk_size=chunk_size, **read_kwargs):
+        if accumulator is None:
+            accumulator = AIPWAccumulator(chunk["probs"].shape[1] if K is None else K, weights, T, floor_decay)
+        accumulator.update_chunk(chunk)
+    if accumulator is None:
+        raise ValueError(f"The log {path} is empty.")
+    return accumulator
@@ -0,0 +1,235 @@
+"""
+This script contains a two-stage local pipeline: generator processes run bandit experiments and evaluator processes compute estimates on them.
+
+Trajectories (arms, rewards and assignment probabilities) are passed through a ring of slots in
+`multiprocessing.shared_memory`, so evaluators read them in place, without pickling or copying. Free
+slot indices circulate in a queue: a generator waits for a free slot before writing a trajectory
+(backpressure when evaluators fall behind), and an evaluator returns the slot once it is done with it.
+Only job descriptions, slot indices and the (small) evaluation results go through pickled queues.
+
+    results = run_pipeline(jobs, generate, evaluate, T_max, K, num_generators=2, num_evaluators=6)
+
+`generate(job)` returns a mapping with `arms` [T], `rewards` [T] and `probs` [T, K] (e.g. MabData), and
+`evaluate(job, data)` returns a picklable result, which may hold views of `data`: it is pickled before the
+slot is reused. With the "spawn" or "forkserver" start methods both functions must be importable (defined
+at module level).
+
+When profiling is on (see profiling.py), each worker process records its own profile and sends the records
+of every job back with the results, and `run_pipeline` merges them into the profile of the calling process.
+"""
+
+import multiprocessing
+import pickle
+import queue
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from adaptive_CI.profiling import active_profile, enable_profiling
+
+__all__ = [
+    "TrajectoryRing",
+    "run_pipeline",
+]
+
+
+class TrajectoryRing:
+    """
+    Fixed number of trajectory slots in shared memory, each holding up to T_max rows of K arms.
+
+    INPUT:
+        - num_slots: number of slots
+        - T_max: maximal trajectory length
+        - K: number of arms
+        - names: names of existing shared memory blocks to attach to (None to create them)
+    """
+
+    _fields = ("arms", "rewards", "probs")
+
+    def __init__(self, num_slots, T_max, K, names=None):
+        self.num_slots, self.T_max, self.K = num_slots, T_max, K
+        shapes = dict(arms=(num_slots, T_max), rewards=(num_slots, T_max), probs=(num_slots, T_max, K))
+        dtypes = dict(arms=np.int64, rewards=np.float64, probs=np.float64)
+        self.owner = names is None
+        self.blocks = {}
+        self.arrays = {}
+        for field in self._fields:
+            nbytes = int(np.prod(shapes[field])) * np.dtype(dtypes[field]).itemsize
+            if self.owner:
+                block = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            else:
+                block = shared_memory.SharedMemory(name=names[field])
+            self.blocks[field] = block
+            self.arrays[field] = np.ndarray(shapes[field], dtype=dtypes[field], buffer=block.buf)
+
+    @property
+    def names(self):
+        return {field: block.name for field, block in self.blocks.items()}
+
+    def spec(self):
+        """ Arguments to attach to the same ring from another process. """
+        return self.num_slots, self.T_max, self.K, self.names
+
+    def write(self, slot, data):
+        """ Copy a trajectory into a slot and return its length. """
+        T = len(data["arms"])
+        if T > self.T_max:
+            raise ValueError(f"Trajectory of length {T} does not fit in slots of length {self.T_max}.")
+        self.arrays["arms"][slot, :T] = data["arms"]
+        self.arrays["rewards"][slot, :T] = data["rewards"]
+        self.arrays["probs"][slot, :T] = np.asarray(data["probs"])
+        return T
+
+    def read(self, slot, T):
+        """ Views (no copy) of the trajectory of length T in a slot; only valid until the slot is released. """
+        return {field: self.arrays[field][slot, :T] for field in self._fields}
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = {}
+
+
+_PROFILE = "profile"  # index of the messages carrying profile records instead of a result
+
+
+def _start_profile(memory):
+    # a fresh profile, so that a forked worker does not send back the records it inherited
+    return None if memory is None else enable_profiling(memory=memory)
+
+
+def _send_profile(profile, results, last=False):
+    if profile is not None:
+        results.put((_PROFILE, last, profile.take()))
+
+
+def _generator(ring_spec, jobs, free_slots, filled, results, generate, memory=None):
+    ring = TrajectoryRing(*ring_spec)
+    profile = _start_profile(memory)
+    try:
+        while True:
+            item = jobs.get()
+            if item is None:
+                break
+            index, job = item
+            try:
+                data = generate(job)
+            except Exception:
+                results.put((index, False, traceback.format_exc()))
+                continue
+            slot = free_slots.get()  # blocks while every slot is in use (backpressure)
+            T = ring.write(slot, data)
+            filled.put((index, job, slot, T))
+            _send_profile(profile, results)
+        _send_profile(profile, results, last=True)
+    finally:
+        ring.close()
+
+
+def _evaluator(ring_spec, free_slots, filled, results, evaluate, memory=None):
+    ring = TrajectoryRing(*ring_spec)
+    profile = _start_profile(memory)
+    try:
+        while True:
+            item = filled.get()
+            if item is None:
+                break
+            index, job, slot, T = item
+            try:
+                # pickled here, while the slot is held: Queue.put pickles in a background thread, by
+                # which time a result holding views of the trajectory could see the next one
+                result = (index, True, pickle.dumps(evaluate(job, ring.read(slot, T)), pickle.HIGHEST_PROTOCOL))
+            except Exception:
+                result = (index, False, traceback.format_exc())
+            # records first, so that they are merged before the callback of the result runs
+            _send_profile(profile, results)
+            results.put(result)
+            free_slots.put(slot)
+        _send_profile(profile, results, last=True)
+    finally:
+        ring.close()
+
+
+def run_pipeline(jobs, generate, evaluate, T_max, K, num_generators=1, num_evaluators=1,
+                 num_slots=None, context=None, callback=None):
+    """
+    Generate and evaluate trajectories in separate processes.
+
+    INPUT:
+        - jobs: list of picklable job descriptions
+        - generate: function job -> trajectory (mapping with arms, rewards and probs)
+        - evaluate: function (job, trajectory) -> picklable result
+        - T_max: maximal trajectory length
+        - K: number of arms
+        - num_generators, num_evaluators: number of processes of each stage
+        - num_slots: number of shared memory slots (default 2 per evaluator)
+        - context: multiprocessing start method or context (default: the platform default)
+        - callback: optional function (job, result) called in this process as results arrive
+
+    OUTPUT:
+        - results: list of evaluation results, in the order of jobs
+    """
+    jobs = list(jobs)
+    if isinstance(context, str) or context is None:
+        context = multiprocessing.get_context(context)
+    num_slots = 2 * num_evaluators if num_slots is None else num_slots
+    profile = active_profile()
+    memory = None if profile is None else profile.memory
+
+    ring = TrajectoryRing(num_slots, T_max, K)
+    job_queue, free_slots, filled, results = (context.Queue() for _ in range(4))
+    for slot in range(num_slots):
+        free_slots.put(slot)
+    for item in enumerate(jobs):
+        job_queue.put(item)
+    for _ in range(num_generators):
+        job_queue.put(None)
+
+    processes = [context.Process(target=_generator, args=(ring.spec(), job_queue, free_slots, filled, results, generate, memory),
+                                 daemon=True) for _ in range(num_generators)]
+    processes += [context.Process(target=_evaluator, args=(ring.spec(), free_slots, filled, results, evaluate, memory),
+                                  daemon=True) for _ in range(num_evaluators)]
+    out = [None] * len(jobs)
+    num_results = 0
+    profiles_left = 0 if profile is None else len(processes)  # workers yet to send their last records
+    try:
+        for process in processes:
+            process.start()
+        if len(jobs) == 0:
+            for _ in range(num_evaluators):
+                filled.put(None)
+        while num_results < len(jobs) or profiles_left > 0:
+            try:
+                index, ok, result = results.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() or process.exitcode == 0 for process in processes):
+                    raise RuntimeError("A pipeline worker exited unexpectedly.")
+                continue
+            if index == _PROFILE:
+                profile.merge(result)
+                profiles_left -= ok  # ok is True on the last records of a worker
+                continue
+            if not ok:
+                raise RuntimeError(f"Job {jobs[index]!r} failed:\n{result}")
+            result = pickle.loads(result)
+            out[index] = result
+            if callback is not None:
+                callback(jobs[index], result)
+            num_results += 1
+            if num_results == len(jobs):
+                # clean shutdown: generators have exhausted the jobs, evaluators stop on the sentinels
+                for _ in range(num_evaluators):
+                    filled.put(None)
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        ring.close()
+    return out
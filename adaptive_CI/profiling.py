@@ -0,0 +1,215 @@
+"""
+This script contains opt-in instrumentation to record wall time, number of calls and allocated memory per function.
+
+Functions decorated with `profiled` are recorded only while profiling is switched on, e.g.
+
+    with profiling(memory=True) as profile:
+        ...run simulations...
+    profile.save("profile.json")
+
+When profiling is off, a decorated function costs one extra Python call and a flag check.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+__all__ = [
+    "profiled",
+    "profile_block",
+    "profiling",
+    "enable_profiling",
+    "disable_profiling",
+    "active_profile",
+    "Profile",
+]
+
+
+class Profile:
+    """
+    Per-function records of a profiling session.
+
+    Each record holds the number of calls, total wall time in seconds and, if memory tracing is on,
+    the net allocated bytes and the largest peak allocation of a single call.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, elapsed, allocated=None, peak=None):
+        with self._lock:
+            record = self.records.setdefault(name, dict(calls=0, time_s=0.0, allocated_bytes=0, peak_bytes=0))
+            record["calls"] += 1
+            record["time_s"] += elapsed
+            if allocated is not None:
+                record["allocated_bytes"] += allocated
+                record["peak_bytes"] = max(record["peak_bytes"], peak)
+
+    def merge(self, records):
+        """ Add records of another profile (e.g. one taken in a worker process, see `take`). """
+        with self._lock:
+            for name, other in records.items():
+                record = self.records.setdefault(name, dict(calls=0, time_s=0.0, allocated_bytes=0, peak_bytes=0))
+                record["calls"] += other["calls"]
+                record["time_s"] += other["time_s"]
+                record["allocated_bytes"] += other["allocated_bytes"]
+                record["peak_bytes"] = max(record["peak_bytes"], other["peak_bytes"])
+
+    def take(self):
+        """ Records collected since the last call, which are removed from this profile. """
+        with self._lock:
+            records, self.records = self.records, {}
+        return records
+
+    def as_dict(self):
+        """ Records sorted by decreasing total time. """
+        with self._lock:
+            return dict(sorted(self.records.items(), key=lambda item: -item[1]["time_s"]))
+
+    def save(self, path, **metadata):
+        """
+        Write the records, together with any metadata (e.g. the simulation config), as JSON. The file is
+        replaced atomically, so a profile saved periodically is never left half-written.
+        """
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(dict(metadata, memory=self.memory, records=self.as_dict()), f, indent=2)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def summary(self):
+        lines = [f"{'function':<48}{'calls':>8}{'time [s]':>12}{'peak [MiB]':>12}"]
+        for name, record in self.as_dict().items():
+            peak = f"{record['peak_bytes'] / 2**20:>12.1f}" if self.memory else f"{'-':>12}"
+            lines.append(f"{name:<48}{record['calls']:>8}{record['time_s']:>12.4f}{peak}")
+        return "\n".join(lines)
+
+
+_active = None  # Profile of the running session, None when profiling is off
+_frames = threading.local()  # per-thread stack of [start bytes, running peak bytes]
+
+
+def _start_frame():
+    # tracemalloc keeps a single peak, so the peak reached so far is handed to
+    # the enclosing call before it is reset for this one. Peaks are only exact
+    # when profiled functions do not run concurrently in several threads, and
+    # on Python < 3.9 (no reset_peak) they are peaks since tracing started.
+    stack = getattr(_frames, "stack", None)
+    if stack is None:
+        stack = _frames.stack = []
+    current, peak = tracemalloc.get_traced_memory()
+    if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    stack.append([current, current])
+
+
+def _end_frame():
+    current, peak = tracemalloc.get_traced_memory()
+    stack = _frames.stack
+    start, running_peak = stack.pop()
+    peak = max(peak, running_peak)
+    if stack:
+        stack[-1][1] = max(stack[-1][1], peak)
+    return current - start, peak - start
+
+
+@contextmanager
+def _record(profile, name):
+    if profile.memory:
+        _start_frame()
+    tic = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - tic
+        if profile.memory:
+            allocated, peak = _end_frame()
+            profile.add(name, elapsed, allocated, peak)
+        else:
+            profile.add(name, elapsed)
+
+
+def profiled(func):
+    """ Decorator recording calls of `func` while profiling is switched on. """
+    name = f"{func.__module__.split('.')[-1]}.{func.__qualname__}"
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = _active
+        if profile is None:
+            return func(*args, **kwargs)
+        with _record(profile, name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def profile_block(name):
+    """ Context manager recording a block of code under `name` while profiling is switched on. """
+    profile = _active
+    if profile is None:
+        yield
+    else:
+        with _record(profile, name):
+            yield
+
+
+def enable_profiling(memory=False):
+    """
+    Switch profiling on until `disable_profiling` is called.
+
+    INPUT:
+        - memory: if True, also trace allocations with tracemalloc (slower)
+
+    OUTPUT:
+        - profile: Profile collecting the records
+    """
+    global _active
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _active = Profile(memory=memory)
+    return _active
+
+
+def disable_profiling():
+    """ Switch profiling off and return the Profile of the session (None if it was off). """
+    global _active
+    profile, _active = _active, None
+    if profile is not None and profile.memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profile
+
+
+def active_profile():
+    """ Profile of the running session, or None when profiling is off. """
+    return _active
+
+
+@contextmanager
+def profiling(memory=False):
+    """
+    Switch profiling on for the duration of the block.
+
+    INPUT:
+        - memory: if True, also trace allocations with tracemalloc (slower)
+
+    OUTPUT:
+        - profile: Profile collecting the records
+    """
+    profile = enable_profiling(memory=memory)
+    try:
+        yield profile
+    finally:
+        disable_profiling()
@@ -0,0 +1,58 @@
+"""
+This script contains cached normal quantiles used to compute confidence interval radii.
+"""
+
+import numpy as np
+from functools import lru_cache
+from statistics import NormalDist
+
+__all__ = [
+    "normal_quantile",
+    "normal_quantiles",
+    "normal_ci_radius",
+]
+
+
+@lru_cache(maxsize=None)
+def normal_quantile(alpha):
+    """
+    Two-sided standard normal quantile z_{1-alpha/2}, computed once per alpha.
+
+    INPUT:
+        - alpha: significance level, e.g. 0.1 for a 90% interval
+
+    OUTPUT:
+        - quantile: z such that P(|N(0,1)| < z) = 1 - alpha
+    """
+    return NormalDist().inv_cdf(1 - alpha / 2)
+
+
+def normal_quantiles(alphas):
+    """
+    Two-sided standard normal quantiles of several significance levels.
+
+    INPUT:
+        - alphas: significance levels of shape [L]
+
+    OUTPUT:
+        - quantiles of shape [L]
+    """
+    return np.array([normal_quantile(float(alpha)) for alpha in alphas])
+
+
+def normal_ci_radius(stderr, alpha):
+    """
+    Radius of normal confidence intervals.
+
+    INPUT:
+        - stderr: standard errors of any shape
+        - alpha: significance level, or a sequence of L significance levels
+
+    OUTPUT:
+        - radius of the same shape as stderr, or of shape [L, *stderr.shape] if alpha is a sequence
+    """
+    if np.ndim(alpha) == 0:
+        return normal_quantile(float(alpha)) * stderr
+    stderr = np.asarray(stderr)
+    quantiles = normal_quantiles(alpha).reshape((-1,) + (1,) * stderr.ndim)
+    return quantiles * stderr
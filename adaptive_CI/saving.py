@@ -2,26 +2,102 @@
 This script contains helping functions for better saving format. 
 """
 
-import numpy as np
-import pandas as pd
 import os
+import socket
 import subprocess
+from itertools import count
 from time import time
 from os.path import dirname, realpath, join, exists
 from os import makedirs, chmod
 from getpass import getuser
 
 __all__ = [
+    "RunContext",
+    "run_context",
     "compose_filename",
     'on_sherlock',
     'get_sherlock_dir'
 ]
 
 
+class RunContext:
+    """
+    Identifiers of the running process, resolved once and shared by every
+    file the process saves.
+
+    The commit id is looked up lazily on first use and cached, so `git` is
+    spawned at most once per process. Setting the environment variable
+    ADAPTIVE_CI_COMMIT (e.g. once in a job file) avoids spawning it at all.
+    Unique ids are built from host, pid, process start time and a counter,
+    so concurrent workers never produce the same filename. A process running
+    a task of a task queue (ADAPTIVE_CI_TASK_ID, see taskqueue.py) names its
+    files after the task instead, without the commit id, so that running a
+    task again replaces its files rather than adding new ones, even after a
+    new commit.
+    """
+
+    def __init__(self):
+        self.host = socket.gethostname().split('.')[0]
+        self.start = int(time() * 1e3)
+        self._commit = None
+        self._counter = count()
+
+    @property
+    def commit(self):
+        """ Short commit hash of the working tree, or '' if unavailable. """
+        if self._commit is None:
+            commit = os.environ.get('ADAPTIVE_CI_COMMIT')
+            if commit is None:
+                try:
+                    commit = subprocess\
+                        .check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      stderr=subprocess.DEVNULL)\
+                        .strip()\
+                        .decode('ascii')
+                except (subprocess.CalledProcessError, OSError):
+                    commit = ''
+            self._commit = commit
+        return self._commit
+
+    @property
+    def job_id(self):
+        """ SLURM job (and array task) id, or '' when not running under SLURM. """
+        jid = os.environ.get('SLURM_ARRAY_JOB_ID', os.environ.get('SLURM_JOB_ID', ''))
+        tid = os.environ.get('SLURM_ARRAY_TASK_ID', '')
+        return "-".join(filter(None, [jid, tid]))
+
+    def unique_id(self):
+        """ Identifier that is unique across hosts, processes and calls. """
+        # the pid is read on every call so that forked workers do not collide
+        return f"{self.host}-{os.getpid()}-{self.start:x}-{next(self._counter)}"
+
+    def compose_filename(self, prefix, extension):
+        """
+        Creates a unique filename based on Github commit id, job id and process identifiers,
+        or on the task id alone within a task queue. Useful when running in parallel on server.
+
+        INPUT:
+            - prefix: file name prefix
+            - extension: file extension
+
+        OUTPUT:
+            - fname: unique filename
+        """
+        task_id = os.environ.get('ADAPTIVE_CI_TASK_ID')
+        if task_id:
+            ident = [prefix, f"task-{task_id}"]
+        else:
+            ident = filter(None, [prefix, self.commit, self.job_id, self.unique_id()])
+        basename = "_".join(ident)
+        return f"{basename}.{extension}"
+
+
+run_context = RunContext()
+
+
 def compose_filename(prefix, extension):
     """
-    Creates a unique filename based on Github commit id and time.
-    Useful when running in parallel on server.
+    Creates a unique filename using the process-wide RunContext.
 
     INPUT:
         - prefix: file name prefix
@@ -30,23 +106,7 @@ def compose_filename(prefix, extension):
     OUTPUT:
         - fname: unique filename
     """
-    # Tries to find a commit hash
-    try:
-        commit = subprocess\
-            .check_output(['git', 'rev-parse', '--short', 'HEAD'],
-                          stderr=subprocess.DEVNULL)\
-            .strip()\
-            .decode('ascii')
-    except subprocess.CalledProcessError:
-        commit = ''
-
-    # Other unique identifiers
-    rnd = str(int(time() * 1e8 % 1e8))
-    sid = tid = jid = ''
-    ident = filter(None, [prefix, commit, jid, sid, tid, rnd])
-    basename = "_".join(ident)
-    fname = f"{basename}.{extension}"
-    return fname
+    return run_context.compose_filename(prefix, extension)
 
 def on_sherlock():
     """ Checks if running locally or on sherlock """
@@ -0,0 +1,208 @@
+"""
+This script contains a local asyncio service answering confidence interval queries for running experiments.
+
+The service keeps one AIPWAccumulator (see logs.py) per experiment, so appending a batch of events costs
+time proportional to the batch and a query is answered from the maintained sums, without going over the
+history again. Clients talk to it over TCP or a Unix socket with one JSON object per line:
+
+    {"op": "create", "experiment": "exp1", "K": 3, "weights": "lvdl"}
+    {"op": "append", "experiment": "exp1", "arms": [0, 2], "rewards": [1.0, 0.3], "probs": [[.4, .3, .3], [.2, .2, .6]]}
+    {"op": "ci", "experiment": "exp1", "alpha": 0.1}
+    {"op": "contrasts", "experiment": "exp1", "kind": "pairwise", "alpha": 0.1}
+    {"op": "drop", "experiment": "exp1"}
+    {"op": "list"}
+
+Every request gets one response line, {"ok": true, ...} or {"ok": false, "error": "..."}, in request order.
+
+    python -m adaptive_CI.service --port 8765
+    python -m adaptive_CI.service --unix /tmp/adaptive_ci.sock
+"""
+
+import argparse
+import asyncio
+import json
+
+import numpy as np
+
+from adaptive_CI.inference import contrast_matrix
+from adaptive_CI.logs import AIPWAccumulator
+
+__all__ = [
+    "InferenceService",
+    "InferenceClient",
+    "serve",
+]
+
+# maximal length of a request line (a batch of events)
+LINE_LIMIT = 2 ** 26
+
+
+class InferenceService:
+    """ Per-experiment incremental AIPW state and the request handlers of the service. """
+
+    def __init__(self):
+        self.experiments = {}
+
+    def handle(self, request):
+        """ Answer one request (a dictionary) with a response dictionary. """
+        try:
+            op = request.get("op")
+            handler = getattr(self, f"_op_{op}", None)
+            if handler is None:
+                raise ValueError(f"Unknown op {op!r}.")
+            return dict(ok=True, **handler(request))
+        except Exception as e:
+            return dict(ok=False, error=f"{type(e).__name__}: {e}")
+
+    def _experiment(self, request):
+        name = request["experiment"]
+        if name not in self.experiments:
+            raise KeyError(f"No experiment {name!r}, create it first.")
+        return self.experiments[name]
+
+    def _op_create(self, request):
+        name = request["experiment"]
+        if name in self.experiments and not request.get("replace", False):
+            raise ValueError(f"Experiment {name!r} already exists.")
+        self.experiments[name] = AIPWAccumulator(int(request["K"]), request.get("weights", "lvdl"),
+                                                 request.get("T"), request.get("floor_decay"))
+        return {}
+
+    def _op_append(self, request):
+        accumulator = self._experiment(request)
+        arms = np.asarray(request["arms"], dtype=np.int64)
+        rewards = np.asarray(request["rewards"], dtype=float)
+        probs = np.asarray(request["probs"], dtype=float).reshape(len(arms), accumulator.K)
+        # a bad batch is rejected before it reaches the accumulator, whose sums cannot be rolled back
+        if arms.ndim != 1 or rewards.shape != arms.shape:
+            raise ValueError(f"Got {rewards.size} rewards for {arms.size} arms.")
+        if len(arms) and (arms.min() < 0 or arms.max() >= accumulator.K):
+            raise ValueError(f"Arms must be integers in [0, {accumulator.K}).")
+        if not np.all(np.isfinite(rewards)):
+            raise ValueError("Rewards must be finite.")
+        if not (np.all(probs >= 0) and np.allclose(probs.sum(1), 1, atol=1e-6)):
+            raise ValueError("Each row of probs must be a probability vector.")
+        if not np.all(probs[np.arange(len(arms)), arms] > 0):
+            raise ValueError("The pulled arm must have a positive assignment probability.")
+        accumulator.update(arms, rewards, probs)
+        return dict(num_rows=accumulator.num_rows)
+
+    @staticmethod
+    def _interval(stats):
+        estimate, stderr, radius = stats[0], stats[1], stats[6]
+        return dict(estimate=estimate.tolist(), stderr=stderr.tolist(),
+                    lower=(estimate - radius).tolist(), upper=(estimate + radius).tolist())
+
+    def _op_ci(self, request):
+        accumulator = self._experiment(request)
+        if accumulator.num_rows == 0:
+            raise ValueError("The experiment has no events yet.")
+        return dict(num_rows=accumulator.num_rows,
+                    **self._interval(accumulator.stats(alpha=float(request.get("alpha", .1)))))
+
+    def _op_contrasts(self, request):
+        accumulator = self._experiment(request)
+        if accumulator.num_rows == 0:
+            raise ValueError("The experiment has no events yet.")
+        if "matrix" in request:
+            contrasts = np.asarray(request["matrix"], dtype=float)
+        else:
+            contrasts = contrast_matrix(accumulator.K, request.get("kind", "last_vs_rest"), request.get("control", 0))
+        stats = accumulator.contrasts(alpha=float(request.get("alpha", .1)), contrasts=contrasts)
+        return dict(num_rows=accumulator.num_rows, contrasts=contrasts.tolist(), **self._interval(stats))
+
+    def _op_drop(self, request):
+        self.experiments.pop(request["experiment"], None)
+        return {}
+
+    def _op_list(self, request):
+        return dict(experiments={name: acc.num_rows for name, acc in self.experiments.items()})
+
+    async def _connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = self.handle(json.loads(line))
+                except json.JSONDecodeError as e:
+                    response = dict(ok=False, error=f"JSONDecodeError: {e}")
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host="127.0.0.1", port=8765, path=None, service=None, ready=None):
+    """
+    Run the service until cancelled.
+
+    INPUT:
+        - host, port: TCP address (ignored if path is given)
+        - path: Unix socket path
+        - service: InferenceService holding the state (a new one if None)
+        - ready: optional asyncio.Event set once the server accepts connections
+    """
+    service = InferenceService() if service is None else service
+    if path is not None:
+        server = await asyncio.start_unix_server(service._connection, path=path, limit=LINE_LIMIT)
+    else:
+        server = await asyncio.start_server(service._connection, host, port, limit=LINE_LIMIT)
+    if ready is not None:
+        ready.set()
+    async with server:
+        await server.serve_forever()
+
+
+class InferenceClient:
+    """
+    Asyncio client of the service; requests on one client are answered in order.
+
+        client = await InferenceClient.connect(path="/tmp/adaptive_ci.sock")
+        await client.request(op="ci", experiment="exp1")
+    """
+
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def connect(cls, host="127.0.0.1", port=8765, path=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+        else:
+            reader, writer = await asyncio.open_connection(host, port, limit=LINE_LIMIT)
+        return cls(reader, writer)
+
+    async def request(self, **request):
+        """ Send a request and return its response; raises RuntimeError if the service reports an error. """
+        async with self._lock:
+            self.writer.write(json.dumps(request).encode() + b"\n")
+            await self.writer.drain()
+            response = json.loads(await self.reader.readline())
+        if not response.pop("ok"):
+            raise RuntimeError(response["error"])
+        return response
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix", default=None, help="listen on this Unix socket instead of TCP")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+This script contains an online summary of Monte Carlo results (count, mean and variance per group).
+
+Instead of storing every simulation's statistics and averaging them afterwards, each value is folded
+into a running count/mean/M2 (Welford's algorithm) of its group, e.g. (method, T, dgp, policy, statistic).
+Summaries computed by different workers or stored in different files are merged exactly with the
+parallel update of Chan et al., so the final table needs memory proportional to the number of groups.
+"""
+
+import pickle
+import numpy as np
+
+__all__ = [
+    "MonteCarloSummary",
+]
+
+
+class MonteCarloSummary:
+    """
+    Running count, mean and sum of squared deviations (M2) of values per group.
+    Non-finite values (e.g. t-statistics with zero standard error) are skipped.
+
+    INPUT:
+        - group_names: names of the fields identifying a group
+    """
+
+    def __init__(self, group_names):
+        self.group_names = tuple(group_names)
+        self.groups = {}  # group key -> [count, mean, M2]
+
+    def __len__(self):
+        return len(self.groups)
+
+    def update(self, key, value):
+        """ Fold a single value into the group `key` (a tuple ordered as group_names). """
+        if not np.isfinite(value):
+            return
+        state = self.groups.get(key)
+        if state is None:
+            self.groups[key] = [1, float(value), 0.0]
+            return
+        state[0] += 1
+        delta = value - state[1]
+        state[1] += delta / state[0]
+        state[2] += delta * (value - state[1])
+
+    def update_statistics(self, stats, policies, statistics, **group):
+        """
+        Fold in a statistics array as returned by the evaluators in inference.py.
+
+        INPUT:
+            - stats: array of shape [len(statistics), len(policies)]
+            - policies: policy labels (arms or contrasts), one per column
+            - statistics: statistic names, one per row
+            - group: values of the remaining group fields, e.g. method="two_point", T=1000
+        """
+        for j, policy in enumerate(policies):
+            for i, statistic in enumerate(statistics):
+                fields = dict(group, policy=policy, statistic=statistic)
+                self.update(tuple(fields[name] for name in self.group_names), stats[i, j])
+
+    def merge(self, other):
+        """ Merge another summary into this one (in place) and return self. """
+        if other.group_names != self.group_names:
+            raise ValueError(f"Cannot merge summaries grouped by {other.group_names} and {self.group_names}.")
+        for key, (n_b, mean_b, m2_b) in other.groups.items():
+            state = self.groups.get(key)
+            if state is None:
+                self.groups[key] = [n_b, mean_b, m2_b]
+                continue
+            n_a, mean_a, m2_a = state
+            n = n_a + n_b
+            delta = mean_b - mean_a
+            state[0] = n
+            state[1] = mean_a + delta * n_b / n
+            state[2] = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+        return self
+
+    def to_frame(self):
+        """
+        Summary table with one row per group and columns
+        group_names + [count, mean, var, stderr] (var is the sample variance).
+        """
+        import pandas as pd
+        keys = list(self.groups.keys())
+        count, mean, m2 = np.array([self.groups[key] for key in keys], dtype=float).reshape(-1, 3).T
+        var = np.where(count > 1, m2 / np.maximum(count - 1, 1), np.nan)
+        df = pd.DataFrame(keys, columns=list(self.group_names))
+        df["count"] = count.astype(int)
+        df["mean"] = mean
+        df["var"] = var
+        df["stderr"] = np.sqrt(var / count)
+        return df
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(dict(group_names=self.group_names, groups=self.groups), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        summary = cls(state["group_names"])
+        summary.groups = state["groups"]
+        return summary
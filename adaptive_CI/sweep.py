@@ -0,0 +1,222 @@
+"""
+This script contains a scheduler for Monte Carlo sweeps that stops each configuration once its coverage is precise enough.
+
+Each configuration (e.g. a (T, dgp, floor_decay) tuple) keeps running coverage estimates for every reported
+(method, policy). Its precision is the largest standard error of these coverages. New simulations are only
+allocated to configurations whose precision is still above the target, in proportion to the number of
+simulations they are expected to still need.
+
+Tasks of a sweep that run at the same time share their allocations through `SweepClaims`: a directory in
+which each running task records the simulations it has claimed and not saved yet. Claims are made under
+an exclusive lock file, so that concurrent tasks see each other's claims as pending simulations instead of
+allocating the same configurations from the same snapshot of saved results.
+"""
+
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from os.path import join
+
+import numpy as np
+
+__all__ = [
+    "CoverageSweep",
+    "SweepClaims",
+]
+
+
+class CoverageSweep:
+    """
+    Scheduler allocating simulations to configurations until their coverage standard error reaches a target.
+
+    INPUT:
+        - configs: list of hashable configurations
+        - target_se: target standard error of every coverage estimate
+        - min_sims: number of simulations per configuration before the standard error is trusted
+        - max_sims: optional cap on the number of simulations per configuration
+        - batch_size: number of simulations handed out by `next_batch`
+    """
+
+    def __init__(self, configs, target_se, min_sims=100, max_sims=None, batch_size=10):
+        self.configs = list(configs)
+        self.target_se = target_se
+        self.min_sims = min_sims
+        self.max_sims = max_sims
+        self.batch_size = batch_size
+        self.num_sims = {config: 0 for config in self.configs}
+        self.covered = {config: None for config in self.configs}  # number of covering runs per (method, policy)
+        self.pending = {config: 0 for config in self.configs}  # simulations allocated but not recorded yet
+
+    def record(self, config, coverage):
+        """
+        Record one simulation.
+
+        INPUT:
+            - config: configuration of the simulation
+            - coverage: 0/1 coverage indicators of shape [M], one per reported (method, policy), in a fixed order
+        """
+        coverage = np.nan_to_num(np.asarray(coverage, dtype=float))
+        if self.covered[config] is None:
+            self.covered[config] = np.zeros_like(coverage)
+        self.covered[config] += coverage
+        self.num_sims[config] += 1
+
+    def add_counts(self, config, num_sims, covered):
+        """ Add simulations done elsewhere, e.g. `num_sims` runs with `covered` covering runs per (method, policy). """
+        covered = np.asarray(covered, dtype=float)
+        if self.covered[config] is None:
+            self.covered[config] = np.zeros_like(covered)
+        self.covered[config] += covered
+        self.num_sims[config] += int(num_sims)
+
+    def standard_error(self, config):
+        """
+        Largest standard error of the coverage estimates of a configuration (inf before any run).
+        Uses the Agresti-Coull adjusted proportion so that coverages of exactly 0 or 1 are not
+        mistaken for perfectly precise ones.
+        """
+        n = self.num_sims[config]
+        if n == 0:
+            return np.inf
+        p = (self.covered[config] + 2) / (n + 4)
+        return float(np.max(np.sqrt(p * (1 - p) / n)))
+
+    def add_pending(self, config, num_sims):
+        """ Count `num_sims` simulations of a configuration as running (e.g. claimed by another task). """
+        self.pending[config] += int(num_sims)
+
+    def remaining(self, config):
+        """
+        Estimated number of simulations still needed by a configuration, not counting the pending ones
+        (0 if it is done).
+        """
+        n = self.num_sims[config]
+        if self.max_sims is not None and n >= self.max_sims:
+            return 0
+        if n < self.min_sims:
+            needed = self.min_sims - n
+        elif self.standard_error(config) <= self.target_se:
+            return 0
+        else:
+            # se^2 = p(1-p)/n, so n_needed = n * (se / target)^2
+            needed = int(np.ceil(n * (self.standard_error(config) / self.target_se) ** 2)) - n
+            needed = max(needed, 1)
+        if self.max_sims is not None:
+            needed = min(needed, self.max_sims - n)
+        return max(needed - self.pending[config], 0)
+
+    def done(self):
+        return all(self.remaining(config) == 0 for config in self.configs)
+
+    def next_batch(self, batch_size=None):
+        """
+        Configurations of the next batch of simulations, allocated in proportion to
+        the number of simulations each configuration still needs. Every configuration
+        that is not done gets at least one simulation, so the batch can be larger than
+        batch_size when many configurations are still running.
+
+        OUTPUT:
+            - list of configurations (empty when every configuration is done)
+        """
+        batch_size = self.batch_size if batch_size is None else batch_size
+        remaining = np.array([self.remaining(config) for config in self.configs], dtype=float)
+        if remaining.sum() == 0:
+            return []
+        batch_size = int(min(batch_size, remaining.sum()))
+        share = np.floor(batch_size * remaining / remaining.sum())
+        share = np.minimum(np.maximum(share, remaining > 0), remaining)
+        # hand out what is left of the batch to the configurations needing the most
+        for i in np.argsort(-remaining):
+            if share.sum() >= batch_size:
+                break
+            if share[i] < remaining[i]:
+                share[i] += 1
+        batch = [config for config, k in zip(self.configs, share.astype(int)) for _ in range(k)]
+        return batch
+
+    def report(self):
+        """ One line per configuration with its number of simulations and coverage standard error. """
+        return "\n".join(f"{str(config):<40}{self.num_sims[config]:>8}{self.standard_error(config):>10.4f}"
+                         for config in self.configs)
+
+
+class SweepClaims:
+    """
+    Simulations claimed by the running tasks of a sweep, kept in a shared directory with one JSON file per task.
+
+    A task claims each batch while holding the lock (see `locked`), after counting the claims of the other
+    tasks as pending, and releases its claims once it has saved its results. Claims not refreshed for
+    `stale_after` seconds (the task was killed) are ignored.
+
+    INPUT:
+        - root: claims directory (created if needed), on a file system shared by the tasks
+        - owner: unique name of this task
+        - stale_after: seconds after which the claims of a silent task are ignored
+        - lock_timeout: seconds after which a lock left by a killed task is broken
+    """
+
+    def __init__(self, root, owner, stale_after=3600., lock_timeout=60.):
+        self.root = root
+        self.owner = owner
+        self.stale_after = stale_after
+        self.lock_timeout = lock_timeout
+        self.claimed = {}
+        os.makedirs(root, exist_ok=True)
+
+    @contextmanager
+    def locked(self, poll=.05):
+        """ Hold the lock of the claims directory for the duration of the block. """
+        path = join(self.root, "lock")
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(path).st_mtime > self.lock_timeout:
+                        os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(poll)
+        try:
+            yield
+        finally:
+            os.remove(path)
+
+    def others(self):
+        """ Number of simulations of each configuration claimed by the other running tasks. """
+        counts = {}
+        now = time.time()
+        for name in os.listdir(self.root):
+            if not name.endswith(".json") or name == f"{self.owner}.json":
+                continue
+            try:
+                if now - os.stat(join(self.root, name)).st_mtime > self.stale_after:
+                    continue
+                with open(join(self.root, name)) as f:
+                    claims = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue  # released (or being replaced) in between
+            for config, num_sims in claims:
+                counts[tuple(config)] = counts.get(tuple(config), 0) + num_sims
+        return counts
+
+    def claim(self, configs):
+        """ Add simulations of `configs` to the claims of this task (call while holding the lock). """
+        for config in configs:
+            self.claimed[config] = self.claimed.get(config, 0) + 1
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump([[list(config), num_sims] for config, num_sims in self.claimed.items()], f)
+        os.replace(tmp, join(self.root, f"{self.owner}.json"))
+
+    def release(self):
+        """ Drop the claims of this task, once its results are saved. """
+        try:
+            os.remove(join(self.root, f"{self.owner}.json"))
+        except FileNotFoundError:
+            pass
+        self.claimed = {}
@@ -0,0 +1,146 @@
+"""
+This script contains a compact table of simulation results, in the long format (one row per method, policy and statistic) used by the plotting notebooks.
+
+Instead of building a DataFrame per method and simulation, statistics arrays of all methods are stacked
+into one block of values per simulation, with integer codes for the method, policy, statistic and
+configuration of each row. Subsets are selected with integer masks on the codes, and a DataFrame is
+only built for the rows that are saved.
+"""
+
+import numpy as np
+
+__all__ = [
+    "ResultTable",
+]
+
+
+class _Vocabulary:
+    """ Mapping between values and consecutive integer codes. """
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def matching(self, condition):
+        """ Codes of the values equal to condition, or contained in it if it is a list/tuple/set. """
+        if not isinstance(condition, (list, tuple, set)):
+            condition = [condition]
+        return [self.codes[value] for value in condition if value in self.codes]
+
+    def decode(self, codes):
+        values = np.empty(len(self.values), dtype=object)
+        values[:] = self.values
+        return values[codes]
+
+
+class ResultTable:
+    """
+    Long-format table of statistics arrays as returned by the evaluators in inference.py.
+
+    INPUT:
+        - statistic_names: names of the rows of the statistics arrays
+        - config_names: names of the configuration fields stored with every row (e.g. T, dgp)
+    """
+
+    _coded = ("method", "policy", "statistic")
+
+    def __init__(self, statistic_names, config_names):
+        self.statistic_names = list(statistic_names)
+        self.config_names = list(config_names)
+        self.vocabularies = {name: _Vocabulary() for name in self._coded}
+        for statistic in self.statistic_names:
+            self.vocabularies["statistic"].code(statistic)
+        self.configs = []  # configuration tuples, indexed by config code
+        self._blocks = []
+        self._table = None
+
+    def __len__(self):
+        return sum(len(block["value"]) for block in self._blocks) if self._table is None else len(self._table["value"])
+
+    def add(self, stats, policies, config):
+        """
+        Add the statistics of one simulation.
+
+        INPUT:
+            - stats: dictionary method -> statistics array of shape [len(statistic_names), len(policies)]
+            - policies: policy labels (arms or contrasts), one per column
+            - config: dictionary with a value for every configuration field
+        """
+        if len(stats) == 0:
+            return
+        values = np.stack(list(stats.values()))  # [methods, statistics, policies]
+        M, S, P = values.shape
+        method_codes = np.array([self.vocabularies["method"].code(method) for method in stats], dtype=np.int32)
+        policy_codes = np.array([self.vocabularies["policy"].code(policy) for policy in policies], dtype=np.int32)
+        config_code = len(self.configs)
+        self.configs.append(tuple(config[name] for name in self.config_names))
+        # rows ordered by method, then policy, then statistic
+        self._blocks.append(dict(
+            value=values.transpose(0, 2, 1).ravel(),
+            method=np.repeat(method_codes, P * S),
+            policy=np.tile(np.repeat(policy_codes, S), M),
+            statistic=np.tile(np.arange(S, dtype=np.int32), M * P),
+            config=np.full(M * P * S, config_code, dtype=np.int32),
+        ))
+        self._table = None
+
+    def _columns(self):
+        if self._table is None:
+            names = ("value",) + self._coded + ("config",)
+            if self._blocks:
+                self._table = {name: np.concatenate([block[name] for block in self._blocks]) for name in names}
+            else:
+                self._table = {name: np.empty(0, dtype=float if name == "value" else np.int32) for name in names}
+            self._blocks = [self._table]
+        return self._table
+
+    def mask(self, **conditions):
+        """
+        Boolean mask of the rows satisfying every condition, e.g. mask(method=["uniform", "lvdl"], T=1000).
+        A condition is a value or a list of accepted values of a column.
+        """
+        table = self._columns()
+        mask = np.ones(len(table["value"]), dtype=bool)
+        for name, condition in conditions.items():
+            if name in self._coded:
+                codes = self.vocabularies[name].matching(condition)
+                mask &= np.isin(table[name], codes)
+            elif name in self.config_names:
+                accepted = condition if isinstance(condition, (list, tuple, set)) else [condition]
+                i = self.config_names.index(name)
+                codes = [code for code, config in enumerate(self.configs) if config[i] in accepted]
+                mask &= np.isin(table["config"], codes)
+            else:
+                raise KeyError(f"Unknown column {name}.")
+        return mask
+
+    def to_frame(self, mask=None):
+        """
+        DataFrame of the (selected) rows with columns statistic, policy, value, method and the configuration fields.
+        """
+        import pandas as pd
+        table = self._columns()
+        index = slice(None) if mask is None else mask
+        config_codes = table["config"][index]
+        configs = np.empty((len(self.configs), len(self.config_names)), dtype=object)
+        configs[:] = self.configs if self.configs else np.empty((0, len(self.config_names)))
+        columns = dict(
+            statistic=self.vocabularies["statistic"].decode(table["statistic"][index]),
+            policy=self.vocabularies["policy"].decode(table["policy"][index]),
+            value=table["value"][index],
+            method=self.vocabularies["method"].decode(table["method"][index]),
+        )
+        for i, name in enumerate(self.config_names):
+            columns[name] = pd.Series(configs[config_codes, i]).infer_objects()
+        return pd.DataFrame(columns)
+
+    def select(self, **conditions):
+        """ DataFrame of the rows satisfying every condition (see mask). """
+        return self.to_frame(self.mask(**conditions))
@@ -0,0 +1,227 @@
+"""
+This script contains a work-stealing task queue kept in a shared directory, to run simulations as cluster array jobs.
+
+Tasks are JSON files that move between the subdirectories pending/, claimed/, done/ and failed/ of the
+queue directory with os.rename, which is atomic within a file system: concurrent workers on any number of
+nodes never claim the same task, and a worker that finishes early simply claims the next pending one.
+Tasks are claimed in the order of their "order" field (then id), so give the most expensive ones the
+smallest order.
+
+While it runs a task, a worker refreshes the modification time of the claimed file. Claims that have not
+been refreshed for `stale_after` seconds (the worker died or was preempted) are put back in pending/ by
+the other workers.
+"""
+
+import json
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import threading
+import traceback
+from os.path import join
+from time import time, sleep
+
+__all__ = [
+    "TaskQueue",
+    "CommandTask",
+    "run_worker",
+    "run_workers",
+]
+
+STATES = ("pending", "claimed", "done", "failed")
+
+
+class TaskQueue:
+    """
+    Directory of tasks, each a JSON dictionary with a unique string "id".
+
+    A task may also have an "order" string: tasks are claimed in the order of their file names
+    "<order>~<id>.json", so the order sets the claiming priority without being part of the
+    identity of the task (put skips tasks whose id is already in the queue, whatever their order).
+
+    INPUT:
+        - root: queue directory (created if needed), on a file system shared by the workers
+    """
+
+    def __init__(self, root):
+        self.root = root
+        for state in STATES:
+            os.makedirs(join(root, state), exist_ok=True)
+
+    @staticmethod
+    def name(task):
+        """ File name (without extension) of a task. """
+        return f"{task['order']}~{task['id']}" if "order" in task else task["id"]
+
+    def _path(self, state, name):
+        return join(self.root, state, f"{name}.json")
+
+    def names(self, state):
+        """ Sorted file names (without extension) of the tasks in `state`, in claiming order. """
+        return sorted(name[:-5] for name in os.listdir(join(self.root, state)) if name.endswith(".json"))
+
+    def ids(self, state):
+        """ Ids of the tasks in `state`, in claiming order. """
+        return [name.split("~")[-1] for name in self.names(state)]
+
+    def counts(self):
+        return {state: len(self.names(state)) for state in STATES}
+
+    def put(self, tasks):
+        """ Add tasks to pending/, skipping the ids already in the queue (in any state). Returns the number added. """
+        existing = {task_id for state in STATES for task_id in self.ids(state)}
+        added = 0
+        for task in tasks:
+            if "~" in task["id"] or "~" in task.get("order", ""):
+                raise ValueError(f"Task ids and orders cannot contain '~': {task}.")
+            if task["id"] in existing:
+                continue
+            # written aside and renamed, so workers never read a partial file
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(task, f)
+            os.replace(tmp, self._path("pending", self.name(task)))
+            existing.add(task["id"])
+            added += 1
+        return added
+
+    def _move(self, name, source, target):
+        """ Atomically move a task; False if it is no longer in `source` (another worker moved it). """
+        try:
+            os.rename(self._path(source, name), self._path(target, name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def claim(self):
+        """ Claim the first pending task and return it, or None if no task is pending. """
+        for name in self.names("pending"):
+            if self._move(name, "pending", "claimed"):
+                path = self._path("claimed", name)
+                try:
+                    os.utime(path)  # rename keeps the modification time of the pending file
+                    with open(path) as f:
+                        return json.load(f)
+                except FileNotFoundError:
+                    continue  # requeued as stale in between
+        return None
+
+    def heartbeat(self, task):
+        """ Refresh a claim; False if it was requeued in the meantime. """
+        try:
+            os.utime(self._path("claimed", self.name(task)))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def complete(self, task):
+        # a claim requeued while its worker was still running is completed from pending/
+        name = self.name(task)
+        return self._move(name, "claimed", "done") or self._move(name, "pending", "done")
+
+    def fail(self, task):
+        return self._move(self.name(task), "claimed", "failed")
+
+    def requeue_stale(self, stale_after):
+        """ Put back in pending/ the claims not refreshed for `stale_after` seconds. Returns their number. """
+        requeued = 0
+        now = time()
+        for name in self.names("claimed"):
+            try:
+                status = os.stat(self._path("claimed", name))
+            except FileNotFoundError:
+                continue
+            # the change time is also updated by the rename of the claim
+            if now - max(status.st_mtime, status.st_ctime) > stale_after:
+                requeued += self._move(name, "claimed", "pending")
+        return requeued
+
+    def retry_failed(self):
+        """ Put the failed tasks back in pending/. Returns their number. """
+        return sum(self._move(name, "failed", "pending") for name in self.names("failed"))
+
+
+class CommandTask:
+    """
+    Run a task as a command, with the task in the environment variables ADAPTIVE_CI_TASK (JSON)
+    and ADAPTIVE_CI_TASK_ID. A non-zero exit status fails the task.
+
+    INPUT:
+        - command: list of program arguments
+        - cwd: working directory of the command
+    """
+
+    def __init__(self, command, cwd=None):
+        self.command = list(command)
+        self.cwd = cwd
+
+    def __call__(self, task):
+        env = dict(os.environ, ADAPTIVE_CI_TASK=json.dumps(task), ADAPTIVE_CI_TASK_ID=task["id"])
+        subprocess.run(self.command, cwd=self.cwd, env=env, check=True)
+
+
+def _keep_alive(queue, task, stop, interval):
+    while not stop.wait(interval):
+        if not queue.heartbeat(task):
+            return
+
+
+def run_worker(queue, run, stale_after=600., heartbeat_interval=30., wait=False):
+    """
+    Claim and run tasks until none is pending.
+
+    INPUT:
+        - queue: TaskQueue
+        - run: function of a task; tasks whose run raises an exception are moved to failed/
+        - stale_after: seconds after which the claims of other workers are considered abandoned
+        - heartbeat_interval: seconds between refreshes of the claim of the running task
+        - wait: when no task is pending, wait for the claimed ones to be done (and take over those
+          that become stale) instead of returning
+
+    OUTPUT:
+        - number of tasks completed by this worker
+    """
+    completed = 0
+    while True:
+        queue.requeue_stale(stale_after)
+        task = queue.claim()
+        if task is None:
+            if not wait or not queue.names("claimed"):
+                return completed
+            sleep(heartbeat_interval)
+            continue
+        stop = threading.Event()
+        keep_alive = threading.Thread(target=_keep_alive, args=(queue, task, stop, heartbeat_interval),
+                                      daemon=True)
+        keep_alive.start()
+        try:
+            run(task)
+        except Exception:
+            traceback.print_exc()
+            queue.fail(task)
+        else:
+            queue.complete(task)
+            completed += 1
+        finally:
+            stop.set()
+            keep_alive.join()
+
+
+def _worker_process(root, run, kwargs):
+    run_worker(TaskQueue(root), run, **kwargs)
+
+
+def run_workers(root, run, num_workers, **kwargs):
+    """
+    Run `num_workers` worker processes on the queue in `root` on this machine, as a stand-in for a cluster
+    array job, and wait for them. `run` must be picklable (e.g. a CommandTask); other keyword arguments
+    are passed to run_worker.
+    """
+    TaskQueue(root)
+    workers = [multiprocessing.Process(target=_worker_process, args=(root, run, kwargs)) for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return [worker.exitcode for worker in workers]
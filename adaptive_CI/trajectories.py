@@ -0,0 +1,130 @@
+"""
+This script contains a content-addressed cache of bandit trajectories.
+
+Trajectories (arms, rewards and run-length compressed assignment probabilities) are stored as .npy files
+in a directory named after a hash of the experiment configuration and the random seed. Cached trajectories
+are loaded memory-mapped, so a new estimator can be evaluated on existing data without re-running
+`run_mab_experiment`.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from os.path import join, exists
+
+from adaptive_CI.experiments import MabData, RunLengthProbs
+
+__all__ = [
+    "trajectory_key",
+    "TrajectoryCache",
+]
+
+
+def _to_json(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Cannot hash configuration value {obj!r}")
+
+
+def trajectory_key(config, seed):
+    """
+    Hash identifying a trajectory.
+
+    INPUT:
+        - config: dictionary of JSON-serializable values (numpy arrays are allowed) fully describing the experiment
+        - seed: random seed the trajectory is generated with
+
+    OUTPUT:
+        - key: hexadecimal string
+    """
+    payload = json.dumps(dict(config=config, seed=seed), sort_keys=True, default=_to_json)
+    return hashlib.sha256(payload.encode()).hexdigest()[:24]
+
+
+class TrajectoryCache:
+    """
+    Directory of cached trajectories keyed by configuration and seed.
+
+    INPUT:
+        - root: cache directory, created if needed
+    """
+
+    _arrays = ("arms", "rewards", "probs_starts", "probs_values")
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, config, seed):
+        return join(self.root, trajectory_key(config, seed))
+
+    def __contains__(self, config_seed):
+        config, seed = config_seed
+        return exists(join(self.path(config, seed), "config.json"))
+
+    def load(self, config, seed, mmap_mode="r"):
+        """
+        Load a cached trajectory.
+
+        OUTPUT:
+            - data: MabData backed by memory-mapped arrays, or None if the trajectory is not cached
+        """
+        path = self.path(config, seed)
+        if not exists(join(path, "config.json")):
+            return None
+        arrays = {name: np.load(join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in self._arrays}
+        probs = RunLengthProbs(arrays["probs_starts"], arrays["probs_values"], len(arrays["arms"]))
+        return MabData(arrays["arms"], arrays["rewards"], probs)
+
+    def save(self, config, seed, data):
+        """
+        Store a trajectory. The files are written to a temporary directory that is then
+        renamed into place, so concurrent workers never see a partially written entry.
+        """
+        path = self.path(config, seed)
+        if exists(path):
+            return
+        tmp = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        try:
+            probs = data["probs"]
+            if not isinstance(probs, RunLengthProbs):
+                probs = RunLengthProbs.from_array(probs)
+            np.save(join(tmp, "arms.npy"), np.asarray(data["arms"]))
+            np.save(join(tmp, "rewards.npy"), np.asarray(data["rewards"]))
+            np.save(join(tmp, "probs_starts.npy"), probs.starts)
+            np.save(join(tmp, "probs_values.npy"), probs.values)
+            # config.json is written last: its presence marks a complete entry
+            with open(join(tmp, "config.json"), "w") as f:
+                json.dump(dict(config=config, seed=seed), f, default=_to_json)
+            os.rename(tmp, path)
+        except OSError:
+            # another worker stored the same trajectory first
+            if not exists(path):
+                raise
+        finally:
+            if exists(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    def get_or_run(self, config, seed, run):
+        """
+        Load a trajectory, or generate and store it if it is not cached.
+
+        INPUT:
+            - config: dictionary describing the experiment
+            - seed: random seed; np.random is seeded with it before calling `run`
+            - run: function without arguments returning the experiment data (e.g. MabData)
+
+        OUTPUT:
+            - data: MabData
+        """
+        data = self.load(config, seed)
+        if data is None:
+            np.random.seed(seed)
+            data = run()
+            self.save(config, seed, data)
+        return data
@@ -1,21 +1,27 @@
 from adaptive_CI.compute import *
+from adaptive_CI.profiling import profiled
+from adaptive_CI.horizons import twopoint_lambdas, twopoint_lambdas_range
 import numpy as np
 
 
-def twopoint_stable_var_ratio(e, alpha):
-    T, K = e.shape
-    t = np.arange(1, T + 1)[:, np.newaxis]
-    
-    # bad arm, e small
-    # this rearranging of the formula in the paper seems to be slightly more
-    # numerically accurate. the exact formula in the paper occasionally produces 
-    # weights that are just a little over 1 (which is impossible).
-    bad_lambda = (1 - alpha) / ((1 - alpha) + T*(t/T)**alpha - t)
-
-    # good arm, e large 
-    good_lambda = 1 / (1 + T - t)                        
-
-    assert np.all(bad_lambda + 1e-7 >= good_lambda) # the 1e-7 is for numerical issues
+@profiled
+def twopoint_stable_var_ratio(e, alpha, T=None, start=0):
+    """
+    Compute lambda of two-point allocation rate weights.
+    INPUT:
+        - e: arm assignment probabilities of shape [n, K] at times start+1, ..., start+n
+        - alpha: assignment probability floor decaying rate
+        - T: experiment horizon (n if None); set T and start to process a long experiment in chunks
+        - start: number of rows of the experiment before e
+    OUTPUT:
+        - ratio: lambda of shape [n, K]
+    """
+    n, K = e.shape
+    if T is None and start == 0:
+        # allocation rates of the bad arm (e small) and good arm (e large), cached per (T, alpha)
+        bad_lambda, good_lambda = twopoint_lambdas(n, alpha)
+    else:
+        bad_lambda, good_lambda = twopoint_lambdas_range(n if T is None else T, alpha, start, start + n)
         
     # weighted average of both
     lamb = (1 - e) * bad_lambda + e * good_lambda
@@ -28,6 +34,7 @@ def twopoint_stable_var_ratio(e, alpha):
     return lamb
 
 
+@profiled
 def twopoint_stable_var_ratio_old(probs, floor_start, floor_decay):
     """
     Compute lambda of two-point allocation rate weights
@@ -0,0 +1,66 @@
+"""
+This script measures the throughput of the multiplier bootstrap in adaptive_CI/bootstrap.py in replicates per second.
+
+For every (T, K) in the grid, it simulates one bandit experiment, computes AIPW scores and evaluation
+weights, and times `aipw_bootstrap` with B replicates for each weighting scheme and multiplier distribution.
+The bootstrap standard errors are compared with the normal-approximation ones as a sanity check, including
+at a small horizon where some multiplier draws leave an arm without weight.
+
+Usage (from the repository root):
+    python benchmarks/bench_bootstrap.py --T 5 1000 10000 100000 --K 3 10 --B 1000
+"""
+
+import argparse
+import sys
+from itertools import product
+from os.path import abspath, dirname
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from adaptive_CI.experiments import run_mab_experiment
+from adaptive_CI.compute import stick_breaking
+from adaptive_CI.inference import lagged_sample_mean, aw_scores, evaluate_aipw_stats
+from adaptive_CI.weights import twopoint_stable_var_ratio
+from adaptive_CI.bootstrap import aipw_bootstrap, MULTIPLIERS
+
+FLOOR_DECAY = .7
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--T", type=int, nargs="+", default=[5, 1_000, 10_000, 100_000], help="experiment horizons")
+    parser.add_argument("--K", type=int, nargs="+", default=[3, 10], help="numbers of arms")
+    parser.add_argument("--B", type=int, default=1000, help="bootstrap replicates")
+    parser.add_argument("--multipliers", nargs="+", default=list(MULTIPLIERS), choices=list(MULTIPLIERS))
+    parser.add_argument("--block-elements", type=int, default=2 ** 22, help="multipliers drawn at once")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'config':<20}{'weights':<12}{'multipliers':<13}{'time [s]':>10}{'replicates/s':>14}{'kept':>7}"
+          f"{'max |se_boot/se - 1|':>22}")
+    for T in args.T:
+        for K in args.K:
+            np.random.seed(args.seed)
+            truth = np.linspace(.9, 1.1, K)
+            data = run_mab_experiment(truth + np.random.uniform(-1, 1, size=(T, K)),
+                                      initial=5, floor_start=1 / K, floor_decay=FLOOR_DECAY)
+            probs, rewards, arms = np.asarray(data['probs']), data['rewards'], data['arms']
+            scores = aw_scores(rewards, arms, probs, lagged_sample_mean(rewards, arms, K))
+            h2es = stick_breaking(twopoint_stable_var_ratio(probs, FLOOR_DECAY))
+            weights = dict(uniform=np.ones_like(probs), propscore=probs, lvdl=np.sqrt(probs),
+                           two_point=np.sqrt(np.maximum(0., h2es * probs)))
+            for (name, evalwts), multipliers in product(weights.items(), args.multipliers):
+                tic = perf_counter()
+                replicates = aipw_bootstrap(scores, evalwts, args.B, multipliers, args.block_elements, args.seed)
+                elapsed = perf_counter() - tic
+                stderr = evaluate_aipw_stats(scores, evalwts, truth)[1]
+                ratio = np.max(np.abs(replicates.std(0) / stderr - 1))
+                print(f"{f'T={T},K={K}':<20}{name:<12}{multipliers:<13}{elapsed:>10.3f}{args.B / elapsed:>14,.0f}"
+                      f"{len(replicates):>7}{ratio:>22.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+This script checks and times the backends of the sequential kernels in adaptive_CI/kernels.py.
+
+Equivalence: for every kernel it compares the numba (or, without numba, the interpreted) loops with the
+NumPy reference on the same inputs. stick_breaking, wdecorr_stats and the epsilon-greedy and random bandit
+agents must agree exactly. The Thompson sampling loop draws its random numbers in blocks, so the normals
+and uniforms drawn by the NumPy reference are recorded and fed to the loop, which must then reproduce the
+reference trajectory (arms and rewards exactly, probabilities up to rounding). The script exits with
+status 1 on a mismatch.
+
+Timing: for every T in the grid, it times each kernel with the NumPy and numba backends (after a first
+call that compiles the loops, whose time is reported separately) and prints the speedup.
+
+Usage (from the repository root):
+    python benchmarks/bench_kernels.py --T 1000 10000 100000 --K 3 10
+"""
+
+import argparse
+import sys
+import warnings
+from os.path import abspath, dirname
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from adaptive_CI.experiments import run_mab_experiment
+from adaptive_CI.compute import stick_breaking
+from adaptive_CI.inference import wdecorr_stats
+from adaptive_CI.weights import twopoint_stable_var_ratio
+from adaptive_CI import kernels
+from adaptive_CI.kernels import numba_available
+
+FLOOR_DECAY = .7
+INITIAL = 2
+EXPLORATIONS = ('TS', 'TS_exploration', 'EG_0.1', 'RAN')
+
+
+def outcomes(T, K, seed):
+    np.random.seed(seed)
+    return np.linspace(.9, 1.1, K) + np.random.uniform(-1, 1, size=(T, K))
+
+
+def simulate(T, K, seed, exploration='TS', backend=None):
+    ys = outcomes(T, K, seed)
+    return run_mab_experiment(ys, initial=INITIAL, floor_start=1 / K, floor_decay=FLOOR_DECAY,
+                              exploration=exploration, backend=backend)
+
+
+def kernel_calls(T, K, seed):
+    """ The kernels called on one simulated experiment, as functions of the backend. """
+    data = simulate(T, K, seed)
+    ratio = twopoint_stable_var_ratio(np.asarray(data['probs']), FLOOR_DECAY)
+    W_lambda = np.ones((K, T)) * (T / K) / np.log(T)
+    return dict(
+        run_mab_experiment=lambda backend: simulate(T, K, seed, backend=backend),
+        stick_breaking=lambda backend: stick_breaking(ratio, backend=backend),
+        wdecorr_stats=lambda backend: wdecorr_stats(data['arms'], data['rewards'], K, W_lambda,
+                                                    np.zeros(K), backend=backend),
+    )
+
+
+def same_trajectory(a, b, atol=0.):
+    return (np.array_equal(a['arms'], b['arms']) and np.array_equal(a['rewards'], b['rewards'])
+            and np.allclose(np.asarray(a['probs']), np.asarray(b['probs']), rtol=0., atol=atol))
+
+
+def recorded_reference(T, K, seed, exploration):
+    """
+    Run the NumPy reference, recording the normals of the Thompson sampling agent and the uniform
+    drawn by each np.random.choice.
+    """
+    normals, uniforms = [], []
+    normal, choice = np.random.normal, np.random.choice
+
+    def recording_normal(*args, **kwargs):
+        normals.append(normal(*args, **kwargs))
+        return normals[-1]
+
+    def recording_choice(*args, **kwargs):
+        state = np.random.get_state()
+        arm = choice(*args, **kwargs)
+        replay = np.random.RandomState()
+        replay.set_state(state)
+        uniforms.append(replay.random_sample())  # the number choice drew
+        return arm
+
+    np.random.normal, np.random.choice = recording_normal, recording_choice
+    try:
+        data = simulate(T, K, seed, exploration, 'numpy')
+    finally:
+        np.random.normal, np.random.choice = normal, choice
+    return data, np.array(normals), np.array(uniforms)
+
+
+def replayed(T, K, seed, exploration, normals, uniforms, backend):
+    """ Trajectory of the `backend` bandit loop fed the given random numbers. """
+    loop = kernels._jit(kernels._mab_loop) if backend == 'numba' else kernels._mab_loop
+    mode, epsilon = kernels._exploration_mode(exploration)
+    arms, rewards, probs = np.empty(T, dtype=np.int_), np.empty(T), np.empty((T, K))
+    loop(outcomes(T, K, seed), 0, T, INITIAL * K, 1 / K, FLOOR_DECAY, mode, epsilon,
+         np.zeros(K), np.zeros(K), np.zeros(K), normals, uniforms, arms, rewards, probs)
+    return dict(arms=arms, rewards=rewards, probs=probs)
+
+
+def check(T, K, seed, backend):
+    """ Names of the kernels whose `backend` implementation does not match the reference. """
+    failures = []
+    calls = kernel_calls(T, K, seed)
+    for name in ('stick_breaking', 'wdecorr_stats'):
+        if not np.array_equal(calls[name]('numpy'), calls[name](backend), equal_nan=True):
+            failures.append(name)
+    for exploration in EXPLORATIONS:
+        if exploration.startswith('TS'):
+            reference, normals, uniforms = recorded_reference(T, K, seed, exploration)
+            trajectory = replayed(T, K, seed, exploration, normals, uniforms, backend)
+            # np.sum adds K >= 8 probabilities pairwise, the loop sequentially
+            atol = 1e-12
+        else:
+            reference, trajectory = simulate(T, K, seed, exploration, 'numpy'), simulate(T, K, seed, exploration, backend)
+            atol = 0.
+        if not same_trajectory(reference, trajectory, atol):
+            failures.append(f'run_mab_experiment[{exploration}]')
+    return failures
+
+
+def timed(func, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        tic = perf_counter()
+        func()
+        best = min(best, perf_counter() - tic)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--T", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="experiment horizons")
+    parser.add_argument("--K", type=int, nargs="+", default=[3, 10], help="numbers of arms")
+    parser.add_argument("--check-T", type=int, default=2_000, help="horizon of the equivalence checks")
+    parser.add_argument("--repeat", type=int, default=3, help="timing repetitions (best is reported)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    warnings.simplefilter("ignore", RuntimeWarning)  # 0/0 of the agent before the first draws
+
+    backend = "numba" if numba_available() else "python"
+    failures = []
+    for K in args.K:
+        failures += [f"K={K}: {name}" for name in check(args.check_T, K, args.seed, backend)]
+    print(f"equivalence of the {backend} backend (T={args.check_T}):", "ok" if not failures else "FAILED")
+    for failure in failures:
+        print("  mismatch:", failure)
+    if backend != "numba":
+        print("numba is not installed, skipping the timings")
+        sys.exit(1 if failures else 0)
+
+    tic = perf_counter()
+    for call in kernel_calls(100, 3, args.seed).values():
+        call("numba")
+    print(f"compilation (or loading from cache): {perf_counter() - tic:.2f} s\n")
+
+    print(f"{'config':<20}{'kernel':<22}{'numpy [s]':>12}{'numba [s]':>12}{'speedup':>10}")
+    for T in args.T:
+        for K in args.K:
+            for name, call in kernel_calls(T, K, args.seed).items():
+                numpy_time = timed(lambda: call("numpy"), args.repeat)
+                numba_time = timed(lambda: call("numba"), args.repeat)
+                print(f"{f'T={T},K={K}':<20}{name:<22}{numpy_time:>12.4f}{numba_time:>12.4f}"
+                      f"{numpy_time / numba_time:>9.0f}x")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+This script benchmarks each stage of the simulation pipeline in experiments/main/simulations.py:
+
+    run_mab_experiment -> lagged_sample_mean -> aw_scores -> twopoint_stable_var_ratio -> stick_breaking
+    -> evaluate_* -> wdecorr_stats -> DataFrame tabulation
+
+For every (T, K) in the grid, it records the best wall time over a few repetitions and the peak
+memory allocated by the stage (measured with tracemalloc in a separate run, so that tracing does
+not distort the timings). Results can be saved as a JSON baseline and compared against one later;
+stages that got slower or use more memory than the tolerance allows are flagged as regressions.
+Timings depend on the machine, so no baseline is committed: save one on the machine that runs the
+comparison, from the commit to compare against.
+
+Usage (from the repository root):
+    git checkout <reference commit>
+    python benchmarks/bench_pipeline.py --T 1000 10000 --K 3 10 --save baseline.json
+    git checkout -
+    python benchmarks/bench_pipeline.py --T 1000 10000 --K 3 10 --compare baseline.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import tracemalloc
+from collections import OrderedDict
+from os.path import abspath, dirname
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from adaptive_CI.experiments import run_mab_experiment
+from adaptive_CI.compute import stick_breaking
+from adaptive_CI.inference import *
+from adaptive_CI.weights import twopoint_stable_var_ratio
+from adaptive_CI.tabulation import ResultTable
+
+FLOOR_DECAY = .7
+INITIAL = 5
+STATISTIC_NAMES = ["estimate", "stderr", "bias", "90% coverage of t-stat", "t-stat", "mse", "CI_width", "truth"]
+
+
+def has_confseq():
+    try:
+        import confseq
+        return True
+    except ImportError:
+        return False
+
+
+def tabulate(stats, config):
+    """ Result tabulation as done in experiments/main/simulations.py. """
+    table = ResultTable(STATISTIC_NAMES, list(config))
+    K = next(iter(stats.values())).shape[1]
+    table.add(stats, range(K), config)
+    return table.to_frame()
+
+
+def make_stages(T, K):
+    """
+    Stages of the pipeline as an ordered dictionary name -> function(state).
+    Each function reads its inputs from `state` and stores its outputs there.
+    """
+    stages = OrderedDict()
+
+    def experiment(s):
+        truth = np.linspace(.9, 1.1, K)
+        ys = truth + np.random.uniform(-1, 1, size=(T, K))
+        data = run_mab_experiment(ys, initial=INITIAL, floor_start=1 / K, floor_decay=FLOOR_DECAY)
+        s.update(truth=truth, arms=data['arms'], rewards=data['rewards'], probs=np.asarray(data['probs']))
+    stages['run_mab_experiment'] = experiment
+
+    def muhat(s):
+        s['muhat'] = lagged_sample_mean(s['rewards'], s['arms'], K)
+    stages['lagged_sample_mean'] = muhat
+
+    def scores(s):
+        s['scores'] = aw_scores(s['rewards'], s['arms'], s['probs'], s['muhat'])
+    stages['aw_scores'] = scores
+
+    def ratio(s):
+        s['ratio'] = twopoint_stable_var_ratio(e=s['probs'], alpha=FLOOR_DECAY)
+    stages['twopoint_stable_var_ratio'] = ratio
+
+    def weights(s):
+        s['wts_twopoint'] = np.sqrt(np.maximum(0., stick_breaking(s['ratio']) * s['probs']))
+    stages['stick_breaking'] = weights
+
+    def aipw_stats(s):
+        s['stats'] = {name: evaluate_aipw_stats(s['scores'], wts, s['truth'])
+                      for name, wts in [('uniform', np.ones_like(s['probs'])),
+                                        ('propscore', s['probs']),
+                                        ('lvdl', np.sqrt(s['probs'])),
+                                        ('two_point', s['wts_twopoint'])]}
+    stages['evaluate_aipw_stats'] = aipw_stats
+
+    def aipw_contrasts(s):
+        evaluate_aipw_contrasts(s['scores'], s['wts_twopoint'], s['truth'])
+    stages['evaluate_aipw_contrasts'] = aipw_contrasts
+
+    def naive(s):
+        s['stats']['sample_mean_naive'] = evaluate_sample_mean_naive_stats(s['rewards'], s['arms'], s['truth'], K)
+        evaluate_sample_mean_naive_contrasts(s['rewards'], s['arms'], s['truth'], K)
+    stages['evaluate_sample_mean_naive'] = naive
+
+    if has_confseq():
+        def gamma_exponential(s):
+            s['stats']['gamma_exponential'] = evaluate_gamma_exponential_stats(
+                s['rewards'], s['arms'], s['truth'], K, FLOOR_DECAY, c=2, expected_noise_variance=1/3)
+        stages['evaluate_gamma_exponential_stats'] = gamma_exponential
+
+        def beta_bernoulli(s):
+            s['stats']['beta_bernoulli'] = evaluate_beta_bernoulli_stats(
+                s['rewards'], s['arms'], s['truth'], K, FLOOR_DECAY)
+        stages['evaluate_beta_bernoulli_stats'] = beta_bernoulli
+
+    def wdecorr(s):
+        W_lambda = np.ones((K, T)) * (T / K) / np.log(T)
+        s['stats']['W-decorrelation'] = wdecorr_stats(s['arms'], s['rewards'], K, W_lambda, s['truth'])
+    stages['wdecorr_stats'] = wdecorr
+
+    def tabulation(s):
+        tabulate(s['stats'], dict(T=T, K=K, floor_decay=FLOOR_DECAY))
+    stages['tabulation'] = tabulation
+
+    return stages
+
+
+def run_grid(Ts, Ks, repeat, memory, seed):
+    """
+    Time every stage for every (T, K).
+
+    OUTPUT:
+        - results: dictionary "T=..,K=.." -> stage -> {"time_s": best time, "peak_bytes": peak memory}
+    """
+    results = OrderedDict()
+    for T in Ts:
+        for K in Ks:
+            key = f"T={T},K={K}"
+            results[key] = OrderedDict()
+            stages = make_stages(T, K)
+            state = {}
+            np.random.seed(seed)
+            for name, stage in stages.items():
+                times = []
+                for _ in range(repeat):
+                    tic = perf_counter()
+                    stage(state)
+                    times.append(perf_counter() - tic)
+                peak = None
+                if memory:
+                    tracemalloc.start()
+                    stage(state)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                results[key][name] = dict(time_s=min(times), peak_bytes=peak)
+                print(f"{key:<20}{name:<36}{min(times):>10.4f} s" +
+                      (f"{peak / 2**20:>10.1f} MiB" if peak is not None else ""))
+    return results
+
+
+def compare(results, baseline, tolerance, min_time=1e-3):
+    """
+    Compare results with a baseline. Timing differences below `min_time`
+    seconds are ignored since they are dominated by noise.
+
+    OUTPUT:
+        - regressions: list of (configuration, stage, metric, baseline value, new value)
+    """
+    regressions = []
+    for key, stages in results.items():
+        for name, metrics in stages.items():
+            old = baseline.get(key, {}).get(name)
+            if old is None:
+                continue
+            for metric in ["time_s", "peak_bytes"]:
+                if old.get(metric) is None or metrics.get(metric) is None:
+                    continue
+                if metric == "time_s" and metrics[metric] - old[metric] < min_time:
+                    continue
+                if metrics[metric] > old[metric] * (1 + tolerance):
+                    regressions.append((key, name, metric, old[metric], metrics[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--T", type=int, nargs="+", default=[1_000, 10_000, 100_000], help="experiment horizons")
+    parser.add_argument("--K", type=int, nargs="+", default=[3, 10, 100], help="numbers of arms")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions per stage, the best time is kept")
+    parser.add_argument("--no-memory", action="store_true", help="skip peak memory measurement")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", default=None, help="save results as a JSON baseline")
+    parser.add_argument("--compare", default=None, help="compare results with a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=.2, help="allowed relative slowdown before flagging")
+    parser.add_argument("--min-time", type=float, default=1e-3, help="ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args()
+
+    # tabulate once up front, so that the first timed tabulation does not include the lazy pandas import
+    tabulate(dict(warmup=np.zeros((len(STATISTIC_NAMES), 1))), dict(T=0))
+    results = run_grid(args.T, args.K, args.repeat, not args.no_memory, args.seed)
+
+    if args.save is not None:
+        with open(args.save, "w") as f:
+            json.dump(dict(machine=platform.node(), python=platform.python_version(),
+                           numpy=np.__version__, results=results), f, indent=2)
+        print(f"Saved baseline to {args.save}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance, args.min_time)
+        for key, name, metric, old, new in regressions:
+            print(f"REGRESSION {key} {name} {metric}: {old:.4g} -> {new:.4g} ({new / old - 1:+.0%})")
+        if regressions:
+            sys.exit(1)
+        print("No regressions.")
+
+
+if __name__ == "__main__":
+    main()
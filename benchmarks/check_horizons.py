@@ -0,0 +1,51 @@
+"""
+This script checks that `evaluate_aipw_stats_horizons` agrees with `evaluate_aipw_stats` run on each prefix of the scores.
+
+Horizon lists include unsorted, repeated and full-length horizons. The script exits with status 1 on a mismatch.
+
+Usage (from the repository root):
+    python benchmarks/check_horizons.py --T 1000 --K 3
+"""
+
+import argparse
+import sys
+from os.path import abspath, dirname
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from adaptive_CI.experiments import run_mab_experiment
+from adaptive_CI.inference import lagged_sample_mean, aw_scores, evaluate_aipw_stats, evaluate_aipw_stats_horizons
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--T", type=int, default=1000, help="experiment horizon")
+    parser.add_argument("--K", type=int, default=3, help="number of arms")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    T, K = args.T, args.K
+
+    np.random.seed(args.seed)
+    truth = np.linspace(.9, 1.1, K)
+    data = run_mab_experiment(truth + np.random.uniform(-1, 1, size=(T, K)), initial=5, floor_start=1 / K, floor_decay=.7)
+    probs, rewards, arms = np.asarray(data['probs']), data['rewards'], data['arms']
+    scores = aw_scores(rewards, arms, probs, lagged_sample_mean(rewards, arms, K))
+    horizon_lists = [[T], [T // 10, T // 2, T], [T, T // 4, T // 2], [T, T], [T // 2, T // 2], [T // 2, T, T],
+                     [T // 4, T // 2, T // 4]]
+
+    failures = 0
+    for horizons in horizon_lists:
+        for name, evalwts in dict(uniform=np.ones_like(probs), propscore=probs, lvdl=np.sqrt(probs)).items():
+            stats = evaluate_aipw_stats_horizons(scores, evalwts, truth, horizons)
+            expected = [evaluate_aipw_stats(scores[:h], evalwts[:h], truth) for h in horizons]
+            error = max(np.max(np.abs(a - b)) for a, b in zip(stats, expected))
+            ok = len(stats) == len(horizons) and error < 1e-10
+            failures += not ok
+            print(f"{str(horizons):<28}{name:<12}{error:>12.2e}  {'ok' if ok else 'MISMATCH'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+This script checks the confidence interval service of adaptive_CI/service.py against the in-memory evaluators.
+
+It runs `serve` in-process on a Unix socket and drives it with an `InferenceClient`. The client appends a
+simulated bandit experiment in batches and compares the intervals and contrasts answered by the service
+with `evaluate_aipw_stats` and `evaluate_aipw_contrasts` on the whole experiment. It also sends malformed
+batches, checks that they are rejected, and checks that the experiment's state is unchanged. The script
+exits with status 1 on a mismatch.
+
+Usage (from the repository root):
+    python benchmarks/check_service.py --T 2000 --K 3 --batch-size 100
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from os.path import abspath, dirname
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from adaptive_CI.experiments import run_mab_experiment
+from adaptive_CI.inference import lagged_sample_mean, aw_scores, evaluate_aipw_stats, evaluate_aipw_contrasts, \
+    contrast_matrix
+from adaptive_CI.service import InferenceClient, serve
+
+WEIGHTS = dict(uniform=np.ones_like, propscore=lambda probs: probs, lvdl=np.sqrt)
+
+
+def bad_batches(arms, rewards, probs):
+    """ Malformed versions of a valid batch, each of which must be rejected. """
+    zero_prob = probs.copy()
+    zero_prob[0] = 0
+    zero_prob[0, (arms[0] + 1) % probs.shape[1]] = 1
+    return dict(
+        missing_reward=dict(arms=arms, rewards=rewards[:-1], probs=probs),
+        nan_reward=dict(arms=arms, rewards=np.r_[np.nan, rewards[1:]], probs=probs),
+        unknown_arm=dict(arms=np.r_[probs.shape[1], arms[1:]], rewards=rewards, probs=probs),
+        zero_probability=dict(arms=arms, rewards=rewards, probs=zero_prob),
+        unnormalized_probs=dict(arms=arms, rewards=rewards, probs=2 * probs),
+    )
+
+
+async def check(args):
+    np.random.seed(args.seed)
+    T, K = args.T, args.K
+    truth = np.linspace(.9, 1.1, K)
+    data = run_mab_experiment(truth + np.random.uniform(-1, 1, size=(T, K)), initial=5, floor_start=1 / K, floor_decay=.7)
+    probs, rewards, arms = np.asarray(data['probs']), data['rewards'], data['arms']
+    scores = aw_scores(rewards, arms, probs, lagged_sample_mean(rewards, arms, K))
+    contrasts = contrast_matrix(K, "pairwise")
+
+    path = os.path.join(tempfile.mkdtemp(), "adaptive_ci.sock")
+    ready = asyncio.Event()
+    server = asyncio.create_task(serve(path=path, ready=ready))
+    await ready.wait()
+    client = await InferenceClient.connect(path=path)
+    failures = []
+    try:
+        for name, evalwts in WEIGHTS.items():
+            await client.request(op="create", experiment=name, K=K, weights=name)
+            for start in range(0, T, args.batch_size):
+                batch = slice(start, start + args.batch_size)
+                await client.request(op="append", experiment=name, arms=arms[batch].tolist(),
+                                     rewards=rewards[batch].tolist(), probs=probs[batch].tolist())
+            ci = await client.request(op="ci", experiment=name)
+            diff = await client.request(op="contrasts", experiment=name, kind="pairwise")
+
+            stats = evaluate_aipw_stats(scores, evalwts(probs), truth)
+            contrast_stats = evaluate_aipw_contrasts(scores, evalwts(probs), truth, contrasts=contrasts)
+            error = max(np.max(np.abs(np.array(ci["estimate"]) - stats[0])),
+                        np.max(np.abs(np.array(ci["stderr"]) - stats[1])),
+                        np.max(np.abs(np.array(diff["estimate"]) - contrast_stats[0])),
+                        np.max(np.abs(np.array(diff["stderr"]) - contrast_stats[1])))
+            print(f"{name:<12}max error vs in-memory evaluators {error:.2e}")
+            if ci["num_rows"] != T or error > 1e-8:
+                failures.append(f"{name}: results differ from the in-memory evaluators")
+
+        for case, batch in bad_batches(arms[:10], rewards[:10], probs[:10]).items():
+            batch = {key: np.asarray(value).tolist() for key, value in batch.items()}
+            try:
+                await client.request(op="append", experiment="lvdl", **batch)
+                failures.append(f"{case}: batch accepted")
+            except RuntimeError as e:
+                print(f"{case:<20}rejected ({e})")
+        if await client.request(op="ci", experiment="lvdl") != ci:
+            failures.append("rejected batches changed the experiment")
+    finally:
+        await client.close()
+        server.cancel()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--T", type=int, default=2000, help="experiment horizon")
+    parser.add_argument("--K", type=int, default=3, help="number of arms")
+    parser.add_argument("--batch-size", type=int, default=100, help="events per appended batch")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    failures = asyncio.run(check(args))
+    for failure in failures:
+        print("FAILED:", failure)
+    print("ok" if not failures else f"{len(failures)} failures")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+This script measures the import time of the adaptive_CI modules using `python -X importtime`.
+
+Each module is imported in a fresh interpreter. The script reports the cumulative import time
+of the module and checks that none of the heavy optional dependencies (scipy, pandas, confseq, ...)
+are loaded at import time. It exits with status 1 if one of them is.
+
+Usage (from the repository root):
+    python benchmarks/import_time.py [--repeat 5] [--json out.json]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from os.path import abspath, dirname
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+MODULES = [
+    "adaptive_CI.compute",
+    "adaptive_CI.experiments",
+    "adaptive_CI.weights",
+    "adaptive_CI.inequalities",
+    "adaptive_CI.inference",
+    "adaptive_CI.saving",
+]
+
+# dependencies that must only be imported on first use
+HEAVY = ["scipy", "pandas", "confseq", "matplotlib", "seaborn", "sklearn"]
+
+
+def import_profile(module):
+    """
+    Import `module` in a fresh interpreter with -X importtime.
+
+    OUTPUT:
+        - total: cumulative import time of the statement in microseconds
+        - cumulative: dictionary of module name -> cumulative import time in microseconds
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    total = 0
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cum, name = line[len("import time:"):].split("|")
+        depth = len(name) - len(name.lstrip()) - 1  # nested imports are indented
+        name = name.strip()
+        cumulative[name] = int(cum)
+        if depth == 0:
+            total += int(cum)
+    return total, cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="number of fresh imports per module")
+    parser.add_argument("--json", default=None, help="write results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    failed = False
+    print(f"{'module':<28}{'median [ms]':>12}{'numpy [ms]':>12}  heavy imports")
+    for module in MODULES:
+        profiles = [import_profile(module) for _ in range(args.repeat)]
+        totals = sorted(total / 1e3 for total, _ in profiles)
+        numpy_ms = sorted(p.get("numpy", 0) / 1e3 for _, p in profiles)
+        heavy = sorted({name.split(".")[0] for _, p in profiles for name in p if name.split(".")[0] in HEAVY})
+        failed |= len(heavy) > 0
+        results[module] = dict(median_ms=totals[len(totals) // 2],
+                               numpy_ms=numpy_ms[len(numpy_ms) // 2],
+                               heavy_imports=heavy)
+        print(f"{module:<28}{results[module]['median_ms']:>12.1f}{results[module]['numpy_ms']:>12.1f}  {', '.join(heavy) or '-'}")
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        print("Heavy dependencies are imported at module load.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+This script load-tests the confidence interval service of adaptive_CI/service.py.
+
+It starts the service in a subprocess on a Unix socket (or connects to a running one), creates a number
+of experiments, and lets concurrent clients append batches of simulated bandit events and query
+confidence intervals and contrasts. It reports the p50/p99 latency of each request type and the number
+of events appended per second.
+
+Usage (from the repository root):
+    python benchmarks/load_service.py --clients 8 --experiments 8 --batches 200 --batch-size 100
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+from os.path import abspath, dirname
+from time import perf_counter
+
+import numpy as np
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from adaptive_CI.service import InferenceClient
+
+
+def simulated_batch(rng, K, batch_size):
+    """ Events of a bandit with random assignment probabilities. """
+    probs = rng.dirichlet(np.ones(K), size=batch_size)
+    arms = (probs.cumsum(1) > rng.random((batch_size, 1))).argmax(1)
+    rewards = np.linspace(.9, 1.1, K)[arms] + rng.uniform(-1, 1, batch_size)
+    return dict(arms=arms.tolist(), rewards=rewards.tolist(), probs=probs.tolist())
+
+
+async def run_client(client_id, args, latencies):
+    rng = np.random.default_rng(client_id)
+    client = await InferenceClient.connect(host=args.host, port=args.port, path=args.unix)
+    experiments = [f"exp{e}" for e in range(client_id % args.experiments, args.experiments, args.clients)] \
+        or [f"exp{client_id % args.experiments}"]
+    for b in range(args.batches):
+        experiment = experiments[b % len(experiments)]
+        batch = simulated_batch(rng, args.K, args.batch_size)
+        tic = perf_counter()
+        await client.request(op="append", experiment=experiment, **batch)
+        latencies["append"].append(perf_counter() - tic)
+        if rng.random() < args.query_ratio:
+            op = "ci" if rng.random() < .5 else "contrasts"
+            tic = perf_counter()
+            await client.request(op=op, experiment=experiment, alpha=.1)
+            latencies[op].append(perf_counter() - tic)
+    await client.close()
+
+
+async def wait_for_socket(path, process, timeout=30):
+    tic = perf_counter()
+    while not os.path.exists(path):
+        if process.returncode is not None:
+            raise RuntimeError("The service exited before listening.")
+        if perf_counter() - tic > timeout:
+            raise TimeoutError(f"The service did not create {path}.")
+        await asyncio.sleep(.05)
+
+
+async def main_async(args):
+    process = None
+    if args.unix is None and args.port is None:
+        args.unix = os.path.join(tempfile.mkdtemp(), "adaptive_ci.sock")
+        process = await asyncio.create_subprocess_exec(sys.executable, "-m", "adaptive_CI.service", "--unix", args.unix,
+                                                       cwd=dirname(dirname(abspath(__file__))))
+        await wait_for_socket(args.unix, process)
+    try:
+        admin = await InferenceClient.connect(host=args.host, port=args.port, path=args.unix)
+        for e in range(args.experiments):
+            await admin.request(op="create", experiment=f"exp{e}", K=args.K, weights=args.weights, replace=True)
+        latencies = dict(append=[], ci=[], contrasts=[])
+        tic = perf_counter()
+        await asyncio.gather(*(run_client(c, args, latencies) for c in range(args.clients)))
+        elapsed = perf_counter() - tic
+        await admin.close()
+    finally:
+        if process is not None:
+            process.terminate()
+            await process.wait()
+
+    num_events = len(latencies["append"]) * args.batch_size
+    print(f"{'request':<12}{'count':>8}{'p50 [ms]':>12}{'p99 [ms]':>12}")
+    for op, values in latencies.items():
+        if values:
+            p50, p99 = np.percentile(values, [50, 99]) * 1e3
+            print(f"{op:<12}{len(values):>8}{p50:>12.3f}{p99:>12.3f}")
+    print(f"{num_events} events in {elapsed:.2f} s: {num_events / elapsed:,.0f} events/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=8, help="number of concurrent clients")
+    parser.add_argument("--experiments", type=int, default=8, help="number of experiments")
+    parser.add_argument("--batches", type=int, default=200, help="appended batches per client")
+    parser.add_argument("--batch-size", type=int, default=100, help="events per batch")
+    parser.add_argument("--K", type=int, default=3, help="number of arms")
+    parser.add_argument("--weights", default="lvdl", help="evaluation weights of the experiments")
+    parser.add_argument("--query-ratio", type=float, default=.5, help="probability of a query after each append")
+    parser.add_argument("--unix", default=None, help="Unix socket of a running service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None, help="TCP port of a running service")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
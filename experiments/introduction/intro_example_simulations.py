@@ -11,6 +11,7 @@ import seaborn as sns
 
 from scipy.stats import norm
 from time import time
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 
 from adaptive_CI.saving import *
@@ -38,106 +39,130 @@ T = 1_000_000
 # Number of replications
 num_sims = 1000
 
+# Simulations are run in chunks of vectorized draws; each chunk holds at most this many [sims, T] entries
+max_chunk_elements = 2 ** 23
 
-# In[1]:
+# Number of worker processes running chunks in parallel
+num_workers = int(os.environ.get('SLURM_CPUS_ON_NODE', os.cpu_count() or 1))
+
+
+# The constant allocation rates lambda_t = 1/(T-t+1) make the stick-breaking recurrence h2e_t = lambda_t (1 - sum_{s<t} h2e_s)
+# equal to 1/T at every t, so the LvdL evaluation weights are sqrt(e_t/T) in every simulation. Since the assignment
+# probability e_t is constant within each half of the experiment, all estimators only depend on per-half sums
+# over the draws of the arm of interest: its number of pulls n, sum of outcomes S and sum of squared outcomes Q.
 
+# In[4]:
 
-avg_estimate = np.empty(num_sims, dtype=float)
-aw_estimate = np.empty(num_sims, dtype=float)
-ipw_estimate = np.empty(num_sims, dtype=float)
 
-avg_stderr = np.empty(num_sims, dtype=float)
-aw_stderr = np.empty(num_sims, dtype=float)
-ipw_stderr = np.empty(num_sims, dtype=float)
+def simulate_chunk(num_chunk_sims, seed):
+    """
+    Run a batch of simulations with vectorized draws.
 
-avg_student = np.empty(num_sims, dtype=float)
-aw_student = np.empty(num_sims, dtype=float)
-ipw_student = np.empty(num_sims, dtype=float)
+    INPUT:
+        - num_chunk_sims: number of simulations in the batch
+        - seed: seed (or SeedSequence) of the batch's random generator
 
-Tw = np.empty(num_sims, dtype=int)
+    OUTPUT:
+        - dictionary of result arrays of shape [num_chunk_sims]
+    """
+    rng = np.random.default_rng(seed)
+    half = T // 2
+    m = num_chunk_sims
+
+    def half_sums(e):
+        # y: potential outcomes of the first arm, pulled: whether the first arm (w == 0) is pulled
+        y = rng.normal(loc=0, scale=1, size=(m, half))
+        pulled = rng.random(size=(m, half)) < np.reshape(e, (-1, 1))
+        y *= pulled
+        return pulled.sum(1), y.sum(1), np.einsum('st,st->s', y, y)
 
-for s in range(num_sims):
-    
-    print(f'Simulation {s}')
-    
-    # potential outcomes for first arm
-    y = np.random.normal(loc=0, scale=1, size=T)
-    
     # first half
-    e1 = .5
-    w1 = np.random.choice([0, 1], p=[e1, 1 - e1], size=T//2)
-  
+    e1 = np.full(m, .5)
+    n1, S1, Q1 = half_sums(e1)
+
     # first arm mean at T/2
-    muhat0 = np.mean(y[:T//2][w1 == 0])
+    muhat0 = S1 / n1
 
-    # second arm mean at T/2 
+    # second arm mean at T/2
     # drawn from is from its asymptotic sampling distribution N(0, 1/(T/4))
-    muhat1 = np.random.normal(loc=0, scale=1/np.sqrt(T/4), size=1) 
-  
+    muhat1 = rng.normal(loc=0, scale=1/np.sqrt(T/4), size=m)
+
     # select arm of interest more often if its point estimate is larger
-    e2 = .9 if muhat0 > muhat1 else .1
-    w2 = np.random.choice([0, 1], p=[e2, 1 - e2], size=T//2)
-  
-    # concatenate first and second halves
-    w = np.hstack([w1, w2])
-    e = np.array([e1]*(T//2) + [e2]*(T//2))
-    
+    e2 = np.where(muhat0 > muhat1, .9, .1)
+    n2, S2, Q2 = half_sums(e2)
+
     # ---- estimates: sample mean -----
-    avg_estimate[s] = np.mean(y[w == 0])
-    avg_stderr[s] = np.std(y[w == 0]) / np.sqrt(np.sum(w == 0))
-    avg_student[s] = avg_estimate[s] / avg_stderr[s]
-    Tw[s] = np.sum(w == 0)
-    
-    # ---- estimates: ipw ---- 
-    ipw_estimate[s] = np.mean(y * (w == 0) / e)
-    ipw_stderr[s] = np.std(y * (w == 0) / e) / np.sqrt(T)
-    ipw_student[s] = ipw_estimate[s] / ipw_stderr[s]
-    
-    # ---- estimates: aw (constant-allocation) ----
-    scores = muhat1 + (w == 0)/e * (y - muhat1)
-    lambda_alloc = 1 / (T - np.arange(1, T + 1) + 1)  # constant allocation rates
-    
-    # evaluation weights
-    h2e = np.zeros(T)  # h^2/e
-    h2e_sum = 0
-    for t in range(T):
-        h2e[t] = lambda_alloc[t] * (1 - h2e_sum)
-        h2e_sum += h2e[t]
-    evaluation_weights = np.sqrt(np.maximum(0., h2e * e))
-        
-    # statistics
-    aw_estimate[s] = np.sum(evaluation_weights * scores, 0)  / np.sum(evaluation_weights, 0)
-    aw_stderr[s] = np.sqrt(np.sum(evaluation_weights ** 2 * (scores - aw_estimate[s])** 2, 0)) / np.sum(evaluation_weights, 0)
-    aw_student[s] = aw_estimate[s] / aw_stderr[s]
+    Tw = n1 + n2
+    avg_estimate = (S1 + S2) / Tw
+    avg_stderr = np.sqrt(np.maximum((Q1 + Q2) / Tw - avg_estimate ** 2, 0)) / np.sqrt(Tw)
 
+    # ---- estimates: ipw ----
+    # ipw scores are y * (w == 0) / e
+    ipw_estimate = (S1 / e1 + S2 / e2) / T
+    ipw_stderr = np.sqrt(np.maximum((Q1 / e1 ** 2 + Q2 / e2 ** 2) / T - ipw_estimate ** 2, 0)) / np.sqrt(T)
 
-# In[ ]:
+    # ---- estimates: aw (constant-allocation) ----
+    # scores are muhat1 + (w == 0)/e * (y - muhat1), evaluation weights sqrt(e/T)
+    aw_num = aw_den = aw_h2 = 0
+    score_sums, square_sums = [], []
+    for n, S, Q, e in [(n1, S1, Q1, e1), (n2, S2, Q2, e2)]:
+        h = np.sqrt(e / T)
+        resid = S - n * muhat1  # sum over pulls of (y - muhat1)
+        resid2 = Q - 2 * muhat1 * S + n * muhat1 ** 2  # sum over pulls of (y - muhat1)^2
+        score_sum = half * muhat1 + resid / e
+        square_sum = half * muhat1 ** 2 + 2 * muhat1 * resid / e + resid2 / e ** 2
+        score_sums.append((h, score_sum, square_sum))
+        aw_num = aw_num + h * score_sum
+        aw_den = aw_den + h * half
+    aw_estimate = aw_num / aw_den
+    for h, score_sum, square_sum in score_sums:
+        aw_h2 = aw_h2 + h ** 2 * (square_sum - 2 * aw_estimate * score_sum + half * aw_estimate ** 2)
+    aw_stderr = np.sqrt(np.maximum(aw_h2, 0)) / aw_den
+
+    return dict(
+        Tw=Tw,
+        avg_estimate=avg_estimate,
+        avg_student=avg_estimate / avg_stderr,
+        ipw_estimate=ipw_estimate,
+        ipw_student=ipw_estimate / ipw_stderr,
+        aw_estimate=aw_estimate,
+        aw_student=aw_estimate / aw_stderr,
+    )
+
+
+# In[5]:
+
+
+def run_simulations(num_sims, seed=None):
+    """ Run num_sims simulations in memory-bounded chunks on a process pool. """
+    chunk_sims = max(1, max_chunk_elements // T)
+    sizes = [min(chunk_sims, num_sims - start) for start in range(0, num_sims, chunk_sims)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if num_workers > 1 and len(sizes) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            results = list(executor.map(simulate_chunk, sizes, seeds))
+    else:
+        results = [simulate_chunk(size, seed) for size, seed in zip(sizes, seeds)]
+    return {key: np.concatenate([result[key] for result in results]) for key in results[0]}
 
 
-data = pd.DataFrame({
-    "T":T,
-    "Tw": Tw,
-    "avg_estimate": avg_estimate,
-    "avg_student": avg_student,
-    "ipw_estimate": ipw_estimate,
-    "ipw_student": ipw_student,
-    "aw_estimate": aw_estimate,
-    "aw_student": aw_student,
-})
+# In[ ]:
 
-if on_sherlock():
-    write_dir = get_sherlock_dir('adaptive-confidence-intervals', 'simulations', create=True)
-else:
-    write_dir = os.path.join(os.getcwd(), 'results')
-filename = compose_filename('intro', 'pkl')
-write_path = os.path.join(write_dir, filename)
-print(f"Saving {write_path}")
-data.to_pickle(write_path)
 
+if __name__ == "__main__":
+    results = run_simulations(num_sims)
 
-# In[ ]:
+    data = pd.DataFrame({"T": T, **results})
 
+    if on_sherlock():
+        write_dir = get_sherlock_dir('adaptive-confidence-intervals', 'simulations', create=True)
+    else:
+        write_dir = os.path.join(os.getcwd(), 'results')
+    filename = compose_filename('intro', 'pkl')
+    write_path = os.path.join(write_dir, filename)
+    print(f"Saving {write_path}")
+    data.to_pickle(write_path)
 
-end_time = time()
-print("Total time: {:1.1f} seconds.".format(end_time - begin_time))
+    end_time = time()
+    print("Total time: {:1.1f} seconds.".format(end_time - begin_time))
 
@@ -6,50 +6,11 @@ import pickle
 from pickle import UnpicklingError
 from glob import glob
 import os
-from os.path import dirname, realpath, join, exists
-from os import makedirs, chmod
-from getpass import getuser
+from os.path import join
 
+from adaptive_CI.saving import on_sherlock, get_sherlock_dir
+from adaptive_CI.summary import MonteCarloSummary
 
-def on_sherlock():
-    """ 
-    Note: This can be ignored by non-Stanford members.
-
-    Checks if running on Stanford's Sherlock cluster
-    """
-    return 'GROUP_SCRATCH' in os.environ
-
-
-def get_sherlock_dir(project, *tail, create=True):
-    """
-    Note: This can be ignored by non-Stanford members.
-    
-    Output consistent folder name in Sherlock.
-    If create=True and on Sherlock, also makes folder with group permissions.
-    If create=True and not on Sherlock, does not create anything.
-
-    '/scratch/groups/athey/username/project/tail1/tail2/.../tailn'.
-
-    >>> get_sherlock_dir('adaptive-inference')
-    '/scratch/groups/athey/adaptive-inference/vitorh'
-
-    >>> get_sherlock_dir('toronto')
-    '/scratch/groups/athey/toronto/vitorh/'
-
-    >>> get_sherlock_dir('adaptive-inference', 'experiments', 'exp_out')
-    '/scratch/groups/athey/adaptive-inference/vitorh/experiments/exp_out'
-    """
-    base = join("/", "scratch", "groups", "athey", project, getuser())
-    path = join(base, *tail)
-    if not exists(path) and create and on_sherlock():
-        makedirs(path, exist_ok=True)
-        # Correct permissions for the whole directory branch
-        chmod_path = base
-        chmod(base, 0o775)
-        for child in tail:
-            chmod_path = join(chmod_path, child)
-            chmod(chmod_path, 0o775)
-    return path
 
 if on_sherlock():
     base_dir = get_sherlock_dir('adaptive-confidence-intervals')
@@ -57,59 +18,84 @@ else:
     base_dir = "results"
     
     
-contrast_files = glob(join(f"{base_dir}", "*contrast*.pkl"))
-arm_files = glob(join(f"{base_dir}", "*arm*.pkl"))
-lambda_files = glob(join(f"{base_dir}", "*lambda*.pkl"))
-tstat_files = glob(join(f"{base_dir}", "*tstat*.pkl"))
+# the per-simulation tables, not the aggregated ones written below
+contrast_files = [file for file in glob(join(f"{base_dir}", "contrast_*.pkl"))
+                  if os.path.basename(file) not in ('contrast_results.pkl', 'contrast_simulations.pkl')]
+arm_files = [file for file in glob(join(f"{base_dir}", "arm_*.pkl"))
+             if os.path.basename(file) not in ('arm_results.pkl', 'arm_simulations.pkl')]
+lambda_files = glob(join(f"{base_dir}", "lambdas_*.pkl"))
+tstat_files = glob(join(f"{base_dir}", "tstat_*.pkl"))
+summary_files = [file for file in glob(join(f"{base_dir}", "summary_*.pkl"))
+                 if os.path.basename(file) not in ('summary_state.pkl', 'summary_results.pkl')]
 
 print(f"Found {len(contrast_files)} contrast files.")
 print(f"Found {len(arm_files)} arm files.")
 print(f"Found {len(lambda_files)} lambda files.")
 print(f"Found {len(tstat_files)} t-stat files.")
+print(f"Found {len(summary_files)} summary files.")
 
 
-# CONTRASTS
-print("Aggregating contrast information.")
-df = []
-for k, file in enumerate(contrast_files):
+# SUMMARY
+# Merging the running summaries only needs memory proportional to the number of
+# (method, T, dgp, floor_decay, policy, statistic) groups.
+print("Aggregating summaries.")
+summary = None
+for k, file in enumerate(summary_files):
     if k % 100 == 0:
-        print(f"\tReading contrasts file {k}.")
+        print(f"\tReading summary file {k}.")
     try:
-        df_tmp = pd.read_pickle(file)
-        df_tmp = df_tmp.query(
-            "method == ['uniform', 'lvdl', 'two_point',  'sample_mean_naive', 'gamma_exponential', 'W-decorrelation_15']"
-        )
-        df_tmp['value'] = df_tmp['value'].astype(float)
-        df.append(df_tmp)
+        summary_tmp = MonteCarloSummary.load(file)
     except Exception as e:
         print(f"\tError when reading file {file}.")
-
-print('\tConcatenating.')
-df = pd.concat(df, ignore_index=True, verify_integrity=False, sort=False, copy=False)
-df.to_pickle(join(base_dir, f'contrast_results.pkl'))
-print("\tDone aggregating contrasts.\n")
-    
-            
-# ARMS
-print("Aggregating arms information.")
-df = []
-for k, file in enumerate(arm_files):
-    if k % 100 == 0:
-        print(f"\tReading arm file {k}.")
-    try:
-        df_tmp = pd.read_pickle(file)
-        df_tmp = df_tmp.query(
-            "method == ['uniform', 'lvdl', 'two_point',  'sample_mean_naive', 'gamma_exponential', 'W-decorrelation_15']"
-        )
-        df_tmp['value'] = df_tmp['value'].astype(float)
-        df.append(df_tmp)
-    except Exception as e:
-        print(f"\tError when reading file {file}.")
-
-print('\tConcatenating.')
-df = pd.concat(df, ignore_index=True, verify_integrity=False, sort=False, copy=False)
-df.to_pickle(join(base_dir, f'arm_results.pkl'))
-print("\tDone aggregating arms.\n")
+        continue
+    summary = summary_tmp if summary is None else summary.merge(summary_tmp)
+
+if summary is not None:
+    summary.save(join(base_dir, 'summary_state.pkl'))
+    summary.to_frame().to_pickle(join(base_dir, 'summary_results.pkl'))
+print("\tDone aggregating summaries.\n")
+
+
+# CONTRASTS AND ARMS
+# Both tables are read off the merged summary of every run: one row per (method, T, dgp, floor_decay, policy,
+# statistic) with the average over simulations as its value, and its count, variance and standard error for
+# Monte Carlo intervals. Per-simulation tables, saved by simulations.py with ADAPTIVE_CI_SIMULATION_TABLES=1
+# (by some runs only), are concatenated separately into *_simulations.pkl and never mixed with the summary.
+saved_statistics = ["mse", "bias", "90% coverage of t-stat", "CI_width"]
+saved_methods = ['uniform', 'lvdl', 'two_point',  'sample_mean_naive', 'gamma_exponential', 'W-decorrelation_15']
+
+
+def concatenate_tables(files, name):
+    df = []
+    for k, file in enumerate(files):
+        if k % 100 == 0:
+            print(f"\tReading {name} file {k}.")
+        try:
+            df_tmp = pd.read_pickle(file)
+            df_tmp = df_tmp.query("method == @saved_methods")
+            df_tmp['value'] = df_tmp['value'].astype(float)
+            df.append(df_tmp)
+        except Exception as e:
+            print(f"\tError when reading file {file}.")
+    print('\tConcatenating.')
+    return pd.concat(df, ignore_index=True, verify_integrity=False, sort=False, copy=False)
+
+
+def summary_table(policies):
+    df = summary.to_frame().query("method == @saved_methods and statistic == @saved_statistics")
+    df = df[df['policy'].isin(policies)]
+    return df.rename(columns={'mean': 'value'}).reset_index(drop=True)
+
+
+for name, files, policies in [('contrast', contrast_files, ["(0,2)"]), ('arm', arm_files, [0, 1, 2])]:
+    print(f"Aggregating {name} information.")
+    if summary is not None:
+        summary_table(policies).to_pickle(join(base_dir, f'{name}_results.pkl'))
+    else:
+        print(f"\tNo summary files.")
+    if len(files) > 0:
+        concatenate_tables(files, name).to_pickle(join(base_dir, f'{name}_simulations.pkl'))
+    print(f"\tDone aggregating {name}s.\n")
 
 
 # LAMBDA
@@ -10,14 +10,14 @@ import numpy as np
 from time import time
 
 from adaptive_CI.experiments import run_mab_experiment
+from adaptive_CI.saving import on_sherlock
+from adaptive_CI.trajectories import TrajectoryCache
 
+# simulations.py uses seeds SLURM_ARRAY_TASK_ID * num_sims + s, far below this offset
+SEED_OFFSET = 2 ** 31
 
-def on_sherlock():
-    """ Checks if running locally or on sherlock """
-    return 'GROUP_SCRATCH' in os.environ
-    
-    
-def calculate_W_lambda(config, pcts, TT, num_sims, verbose=True):
+
+def calculate_W_lambda(config, pcts, TT, num_sims, verbose=True, trajectory_cache=None, seed_offset=SEED_OFFSET):
     """
     Compute bias-variance tradeoff parameter W_lambda in W-decorrelation.
 
@@ -33,6 +33,9 @@ def calculate_W_lambda(config, pcts, TT, num_sims, verbose=True):
         - TT: a list of sample sizes 
         - num_sims: number of simulations to run. A larger number (>1000) recommended.
         - verbose: if True prints out progress
+        - trajectory_cache: optional TrajectoryCache; simulation s then uses seed seed_offset + s and
+          trajectories already generated with the same configuration are reused
+        - seed_offset: first seed, by default above the seeds of simulations.py
 
     OUTPUT:
         - W_lambdas: a list of W_lambda for sample size in TT
@@ -50,21 +53,31 @@ def calculate_W_lambda(config, pcts, TT, num_sims, verbose=True):
         
     for s in range(num_sims):
         message(f"Simulation {s+1}/{num_sims}")
-        
-        # Draw potential outcomes.
-        if noise_func == 'uniform':
-            noise = np.random.uniform(-noise_scale, noise_scale, size=(T, K))
-        else:
-            noise = np.random.exponential(noise_scale, size=(T, K)) - noise_scale
-        ys = noise + config["truth"]
 
-        # Run the experiment.
-        data = run_mab_experiment(
-            ys,
-            initial=config["initial"],
-            floor_start=config["floor_start"],
-            floor_decay=config["floor_decay"],
-            exploration=config["exploration"])
+        def generate():
+            # Draw potential outcomes.
+            if noise_func == 'uniform':
+                noise = np.random.uniform(-noise_scale, noise_scale, size=(T, K))
+            else:
+                noise = np.random.exponential(noise_scale, size=(T, K)) - noise_scale
+            ys = noise + config["truth"]
+
+            # Run the experiment.
+            return run_mab_experiment(
+                ys,
+                initial=config["initial"],
+                floor_start=config["floor_start"],
+                floor_decay=config["floor_decay"],
+                exploration=config["exploration"])
+
+        if trajectory_cache is None:
+            data = generate()
+        else:
+            # same keys as in simulations.py
+            trajectory_config = dict(T=T, truth=config["truth"], noise_func=noise_func, noise_scale=noise_scale,
+                                     initial=config["initial"], floor_start=config["floor_start"],
+                                     floor_decay=config["floor_decay"], exploration=config["exploration"])
+            data = trajectory_cache.get_or_run(trajectory_config, seed_offset + s, generate)
 
         arms.append(data['arms'])
 
@@ -118,6 +131,8 @@ noise_scale = 1.0
 noise_func = "uniform"
 num_sims = 200 if on_sherlock() else 1
 save = on_sherlock()
+cache_dir = os.environ.get('ADAPTIVE_CI_TRAJECTORY_CACHE')
+trajectory_cache = None if cache_dir is None else TrajectoryCache(cache_dir)
 
 for experiment in experiments:
     print(f"Running experiment {experiment}")
@@ -135,7 +150,8 @@ for experiment in experiments:
             floor_decay=floor_decay,
             exploration=exploration,
         )
-        W_lambdas = calculate_W_lambda(config, percentiles, TT, num_sims=num_sims)
+        W_lambdas = calculate_W_lambda(config, percentiles, TT, num_sims=num_sims,
+                                       trajectory_cache=trajectory_cache)
         for t, W_lam in zip(TT, W_lambdas):
             name = f'W_lambdas_{experiment}-{noise_func}-{t}-{floor_decay}.npz'
             np.savez(name, percentiles=percentiles, W_lambdas=W_lam)
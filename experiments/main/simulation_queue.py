@@ -0,0 +1,105 @@
+"""
+This script runs the simulations of simulations.py from a task queue instead of random configurations.
+
+`init` enumerates every (configuration, block of seeds) of the grid as a task in a shared queue directory,
+the largest horizons first, so each configuration gets the same number of simulations. Running `init`
+again with a larger `--sims` adds only the missing blocks; the block size of a queue cannot change. Each `work`
+process (e.g. one per task of a SLURM array job, see jobfile-queue.job) then claims tasks one at a time
+and runs simulations.py on them until none is left; `local` runs N such workers on this machine.
+
+    python simulation_queue.py init --queue queue --sims 10000 --block 200
+    python simulation_queue.py work --queue queue
+    python simulation_queue.py local --queue queue -n 8
+    python simulation_queue.py status --queue queue --requeue-stale --retry-failed
+"""
+
+import argparse
+import sys
+import zlib
+from itertools import product
+from os.path import abspath, dirname, exists, join
+
+sys.path.insert(0, dirname(dirname(dirname(abspath(__file__)))))
+
+from adaptive_CI.taskqueue import TaskQueue, CommandTask, run_worker, run_workers
+
+# grid of simulations.py on the cluster
+TS = [1_000, 5_000, 10_000, 50_000, 100_000]
+DGPS = ['nosignal', 'lowSNR', 'highSNR']
+FLOOR_DECAYS = [.7]
+MAX_T = 10 ** 12  # orders are zero-padded MAX_T - T
+
+
+def simulation_tasks(Ts, dgps, floor_decays, sims_per_config, block_size):
+    """
+    Tasks of `block_size` simulations covering at least `sims_per_config` simulations of every configuration.
+
+    A task is identified by its configuration and block index only, and its seeds are
+    [seed_key, block * block_size + s] with a seed_key hashed from the configuration, so enqueueing the
+    grid again with a larger `sims_per_config` adds only the new blocks. The tasks are ordered by
+    decreasing cost (T) and, within equal costs, by block, so that the configurations fill up evenly
+    while the queue is being worked through.
+    """
+    num_blocks = -(-sims_per_config // block_size)
+    tasks = []
+    for T, dgp, floor_decay in product(Ts, dgps, floor_decays):
+        config = f"T{T}-{dgp}-{floor_decay}"
+        for b in range(num_blocks):
+            tasks.append(dict(id=f"{config}-b{b}", order=f"{MAX_T - T:012d}-b{b:06d}", T=T, dgp=dgp,
+                              floor_decay=floor_decay, block=b, num_sims=block_size,
+                              seed_key=zlib.crc32(config.encode()), first_seed=b * block_size))
+    return tasks
+
+
+def check_block_size(root, block_size):
+    """ Record the block size of the queue in `root`, or check that it is the recorded one. """
+    path = join(root, "block_size")
+    if exists(path):
+        with open(path) as f:
+            recorded = int(f.read())
+        if recorded != block_size:
+            raise ValueError(f"The tasks of {root} have blocks of {recorded} simulations, not {block_size}.")
+    else:
+        with open(path, "w") as f:
+            f.write(str(block_size))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["init", "work", "local", "status"])
+    parser.add_argument("--queue", default="queue", help="queue directory, shared by the workers")
+    parser.add_argument("--Ts", type=int, nargs="+", default=TS)
+    parser.add_argument("--dgps", nargs="+", default=DGPS)
+    parser.add_argument("--floor-decays", type=float, nargs="+", default=FLOOR_DECAYS)
+    parser.add_argument("--sims", type=int, default=10_000,
+                        help="simulations per configuration, rounded up to whole blocks")
+    parser.add_argument("--block", type=int, default=200, help="simulations per task")
+    parser.add_argument("-n", "--num-workers", type=int, default=1, help="local worker processes")
+    parser.add_argument("--stale-after", type=float, default=600., help="seconds before a silent claim is requeued")
+    parser.add_argument("--wait", action="store_true", help="wait for the running tasks of other workers")
+    parser.add_argument("--requeue-stale", action="store_true", help="(status) requeue stale claims")
+    parser.add_argument("--retry-failed", action="store_true", help="(status) requeue failed tasks")
+    args = parser.parse_args()
+
+    queue = TaskQueue(args.queue)
+    run = CommandTask([sys.executable, "simulations.py"], cwd=dirname(abspath(__file__)))
+    worker_kwargs = dict(stale_after=args.stale_after, heartbeat_interval=min(30., args.stale_after / 4),
+                         wait=args.wait)
+    if args.command == "init":
+        check_block_size(args.queue, args.block)
+        tasks = simulation_tasks(args.Ts, args.dgps, args.floor_decays, args.sims, args.block)
+        print(f"Added {queue.put(tasks)} of {len(tasks)} tasks to {args.queue}.")
+    elif args.command == "work":
+        print(f"Completed {run_worker(queue, run, **worker_kwargs)} tasks.")
+    elif args.command == "local":
+        run_workers(args.queue, run, args.num_workers, **worker_kwargs)
+    elif args.command == "status":
+        if args.requeue_stale:
+            print(f"Requeued {queue.requeue_stale(args.stale_after)} stale tasks.")
+        if args.retry_failed:
+            print(f"Requeued {queue.retry_failed()} failed tasks.")
+    print(", ".join(f"{state}: {count}" for state, count in queue.counts().items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,8 @@ This script runs simulations reported in our paper Confidence Intervals for Poli
 """
 
 import sys
-import subprocess
+import json
+import signal
 import pickle
 import os
 import numpy as np
@@ -18,15 +19,22 @@ import pandas as pd
 from time import time
 from sys import argv
 from random import choice
-from time import time
-from os.path import dirname, realpath, join, exists
-from os import makedirs, chmod
-from getpass import getuser
+from itertools import product, islice
+from glob import glob
+from os.path import join
 
 from adaptive_CI.experiments import run_mab_experiment
 from adaptive_CI.compute import stick_breaking
 from adaptive_CI.inference import *
 from adaptive_CI.weights import *
+from adaptive_CI.saving import *
+from adaptive_CI.profiling import enable_profiling, disable_profiling, profile_block
+from adaptive_CI.summary import MonteCarloSummary
+from adaptive_CI.tabulation import ResultTable
+from adaptive_CI.estimators import EstimatorRegistry, thread_pool, default_num_threads
+from adaptive_CI.pipeline import run_pipeline
+from adaptive_CI.sweep import CoverageSweep, SweepClaims
+from adaptive_CI.trajectories import TrajectoryCache
 
 # magics removed
 # magics removed
@@ -57,82 +65,44 @@ from adaptive_CI.weights import *
 
 start_time = time()
 
+# Opt-in instrumentation: ADAPTIVE_CI_PROFILE=1 records wall time and call counts of
+# each pipeline stage, ADAPTIVE_CI_PROFILE=memory also records allocated memory.
+# The profile is saved next to the results every `profile_every` simulations and when the
+# script is terminated (SLURM sends SIGTERM at the time limit), each time replacing the same
+# file, so that a task killed before the end still leaves its profile.
+profile_mode = os.environ.get('ADAPTIVE_CI_PROFILE', '')
+profile = enable_profiling(memory=(profile_mode == 'memory')) if profile_mode else None
+profile_every = 10
+profile_path = None
+num_recorded = 0  # simulations recorded so far
+main_pid = os.getpid()
 
-# In[3]:
-
-
-def on_sherlock():
-    """ 
-    Note: This can be ignored by non-Stanford members.
 
-    Checks if running on Stanford's Sherlock cluster
-    """
-    return 'GROUP_SCRATCH' in os.environ
+def save_profile():
+    """ Save the profile of the simulations recorded so far (in the main process only). """
+    global profile_path
+    if profile is None or os.getpid() != main_pid:
+        return
+    if profile_path is None:
+        profile_path = os.path.join(write_dir, compose_filename('profile', 'json'))
+    profile.save(profile_path, num_sims=num_sims, recorded_sims=num_recorded, Ts=Ts,
+                 total_time_s=time() - start_time)
 
 
-def get_sherlock_dir(project, *tail, create=True):
-    """
-    Note: This can be ignored by non-Stanford members.
-    
-    Output consistent folder name in Sherlock.
-    If create=True and on Sherlock, also makes folder with group permissions.
-    If create=True and not on Sherlock, does not create anything.
-
-    '/scratch/groups/athey/username/project/tail1/tail2/.../tailn'.
-
-    >>> get_sherlock_dir('adaptive-inference')
-    '/scratch/groups/athey/adaptive-inference/vitorh'
-
-    >>> get_sherlock_dir('toronto')
-    '/scratch/groups/athey/toronto/vitorh/'
-
-    >>> get_sherlock_dir('adaptive-inference', 'experiments', 'exp_out')
-    '/scratch/groups/athey/adaptive-inference/vitorh/experiments/exp_out'
-    """
-    base = join("/", "scratch", "groups", "athey", project, getuser())
-    path = join(base, *tail)
-    if not exists(path) and create and on_sherlock():
-        makedirs(path, exist_ok=True)
-        # Correct permissions for the whole directory branch
-        chmod_path = base
-        chmod(base, 0o775)
-        for child in tail:
-            chmod_path = join(chmod_path, child)
-            chmod(chmod_path, 0o775)
-    return path
-
-
-def compose_filename(prefix, extension):
-    """
-    Creates a unique filename based on Github commit id and time.
-    Useful when running in parallel on server.
+def terminate(signum, frame):
+    if os.getpid() == main_pid:
+        save_profile()
+        sys.exit(128 + signum)
+    # worker processes forked by the pipeline keep the default behavior
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
 
-    INPUT:
-        - prefix: file name prefix
-        - extension: file extension
 
-    OUTPUT:
-        - fname: unique filename
-    """
-    # Tries to find a commit hash
-    try:
-        commit = subprocess            .check_output(['git', 'rev-parse', '--short', 'HEAD'],
-                          stderr=subprocess.DEVNULL)\
-            .strip()\
-            .decode('ascii')
-    except subprocess.CalledProcessError:
-        commit = ''
-
-    # Other unique identifiers
-    rnd = str(int(time() * 1e8 % 1e8))
-    sid = tid = jid = ''
-    ident = filter(None, [prefix, commit, jid, sid, tid, rnd])
-    basename = "_".join(ident)
-    fname = f"{basename}.{extension}"
-    return fname
+if profile is not None:
+    signal.signal(signal.SIGTERM, terminate)
 
 
-# In[4]:
+# In[3]:
 
 
 num_sims = 200 if on_sherlock() else 1
@@ -155,154 +125,393 @@ exploration = 'TS'
 noise_scale = 1.
 
 
+# **Task queue (optional).** When the script is run by a worker of `simulation_queue.py`, ADAPTIVE_CI_TASK
+# holds its task: a configuration (T, dgp, floor_decay) and a block of seeds. The script then runs exactly
+# these simulations, seeded with [seed_key, first_seed + s] for s < num_sims (seed_key identifies the
+# configuration), and names its result files after the task (see adaptive_CI/saving.py), so a task that
+# is run again replaces its results.
+
+# In[4]:
+
+
+task = os.environ.get('ADAPTIVE_CI_TASK')
+if task is not None:
+    task = json.loads(task)
+    num_sims = task['num_sims']
+    Ts = [task['T']]
+    floor_decays = [task['floor_decay']]
+
+
 # In[5]:
 
 
-df_stats = []
 df_lambdas = []
 
+# running mean/variance of every statistic per configuration (see aggregate.py)
+statistic_names = ["estimate", "stderr", "bias", "90% coverage of t-stat", "t-stat", "mse", "CI_width", "truth"]
+summary = MonteCarloSummary(['method', 'T', 'dgp', 'floor_decay', 'policy', 'statistic'])
+stats_table = ResultTable(statistic_names, ['T', 'K', 'noise_func', 'noise_scale', 'floor_start', 'floor_decay', 'initial', 'dgp'])
+
+
+# Get the directory (the first statement here is specific to the Stanford cluster).
 
 # In[6]:
 
 
-# Run simulations
-for s in range(num_sims):
-    if (s+1) % 10 == 0:
-        print(f'Running simulation {s+1}/{num_sims}')
+if on_sherlock():
+    write_dir = get_sherlock_dir('adaptive-confidence-intervals', 'simulations', create=True)
+    print(f"saving at {write_dir}")
+else:
+     write_dir = join(os.getcwd(), 'results')
+
+
+# **Early stopping (optional).** By default each simulation draws a random configuration.
+# Setting ADAPTIVE_CI_SWEEP_SE (e.g. to 0.005) instead hands out simulations only to the
+# configurations whose coverage standard error is still above that target. Each batch is allocated
+# from the summaries saved in `write_dir` so far, the simulations of this task, and the simulations
+# that the other running tasks have claimed in `write_dir`/sweep_claims (see adaptive_CI/sweep.py),
+# so that tasks running at the same time do not all pick the same configurations.
+
+# In[7]:
+
+
+sweep_methods = ['uniform', 'lvdl', 'two_point', 'sample_mean_naive', 'gamma_exponential']
+sweep_se = os.environ.get('ADAPTIVE_CI_SWEEP_SE')
+sweep_batch_size = 10
+sweep_configs = list(product(Ts, truths.keys(), floor_decays))
+saved_counts = {}  # coverage counts of each summary file in write_dir, by (file, modification time)
+recorded_counts = {config: 0 for config in sweep_configs}  # simulations recorded by this task
+
+
+def coverage_counts(done):
+    """ Number of simulations and of covering runs per (method, policy) of each configuration of a summary. """
+    counts = {}
+    coverage = done.to_frame().query('statistic == "90% coverage of t-stat" and method == @sweep_methods')
+    for (T, experiment, floor_decay), df in coverage.groupby(['T', 'dgp', 'floor_decay']):
+        if (T, experiment, floor_decay) not in recorded_counts:
+            continue
+        # same order for every summary, so that the counts of different files add up
+        K = len(truths[experiment])
+        order = [(m, k) for m in sweep_methods for k in range(K)] + \
+                [(m, f"(0,{k})") for m in sweep_methods for k in range(1, K)]
+        df = df.set_index(['method', 'policy']).reindex(order)
+        if df['count'].notna().all():
+            counts[T, experiment, floor_decay] = df['count'].min(), df['mean'] * df['count']
+    return counts
+
+
+def sweep_state():
+    """ CoverageSweep holding every simulation saved, recorded by this task or claimed by a running task. """
+    state = CoverageSweep(sweep_configs, target_se=float(sweep_se), batch_size=sweep_batch_size)
+    files = [file for file in glob(join(write_dir, 'summary_*.pkl'))
+             if os.path.basename(file) not in ('summary_state.pkl', 'summary_results.pkl')]
+    for file in files:
+        key = file, os.path.getmtime(file)
+        if key not in saved_counts:
+            saved_counts[key] = coverage_counts(MonteCarloSummary.load(file))
+        for config, (n, covered) in saved_counts[key].items():
+            state.add_counts(config, n, covered)
+    for config, (n, covered) in coverage_counts(summary).items():
+        state.add_counts(config, n, covered)
+    for config, n in sweep_claims.others().items():
+        if config in state.pending:
+            state.add_pending(config, n)
+    for config, n in sweep_claims.claimed.items():
+        state.add_pending(config, n - recorded_counts[config])
+    return state
+
+
+sweep_claims = None
+if sweep_se is not None:
+    sweep_claims = SweepClaims(join(write_dir, 'sweep_claims'),
+                               os.path.splitext(compose_filename('claims', 'json'))[0])
+    print(sweep_state().report())
+
+
+# **Trajectory cache (optional).** Setting ADAPTIVE_CI_TRAJECTORY_CACHE to a directory stores every
+# generated trajectory there, keyed by its configuration and seed (see compute_wdecorrelation_lambda.py,
+# which uses the same keys). Re-running the script, e.g. after adding an estimator, then evaluates the
+# cached trajectories instead of re-running the bandit experiment. Seeds are derived from the array
+# task id so that each task reproduces its own configurations and trajectories (without a cache or an
+# array task id, configurations are drawn without a seed). The seeds are disjoint from those of
+# compute_wdecorrelation_lambda.py, so W_lambda is not tuned on the evaluated trajectories.
+
+# In[8]:
+
+
+cache_dir = os.environ.get('ADAPTIVE_CI_TRAJECTORY_CACHE')
+trajectory_cache = None if cache_dir is None else TrajectoryCache(cache_dir)
+seed_offset = task['first_seed'] if task is not None else int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)) * num_sims
+# without a cache or an array task id, nothing asks for reproducible simulations: configurations are then
+# drawn without a seed, so that repeated local runs cover the whole grid
+seeds_pinned = trajectory_cache is not None or 'SLURM_ARRAY_TASK_ID' in os.environ
+
+
+def trajectory_seed(s):
+    """ Seed of simulation s of this task. """
+    if task is not None:
+        return [task['seed_key'], seed_offset + s]
+    return seed_offset + s
+
+
+# **All horizons from one trajectory (optional).** Setting ADAPTIVE_CI_ALL_HORIZONS=1 runs each
+# simulation once at the longest horizon max(Ts) and evaluates every horizon in Ts on prefixes of it.
+# The AIPW scores and the horizon-independent weights are shared across horizons; only the two-point
+# weights, which depend on the horizon, are recomputed for each prefix.
 
-    """ Experiment configuration """
-    T = choice(Ts)  # number of samples
-    experiment = choice(list(truths.keys()))
+# In[9]:
+
+
+all_horizons = os.environ.get('ADAPTIVE_CI_ALL_HORIZONS', '') not in ('', '0')
+
+# Estimators of a simulation run in a pool of ADAPTIVE_CI_THREADS threads (sequentially by default)
+num_threads = default_num_threads()
+
+
+def configurations():
+    """ (T, experiment, floor_decay) of each simulation run by this task. """
+    if task is not None:
+        for _ in range(num_sims):
+            yield task['T'], task['dgp'], task['floor_decay']
+        return
+    if sweep_se is None:
+        if not seeds_pinned:
+            for _ in range(num_sims):
+                yield choice(Ts), choice(list(truths.keys())), choice(floor_decays)
+            return
+        # each configuration is drawn with the seed of its simulation, so a re-run draws the same ones
+        experiments = list(truths.keys())
+        for s in range(num_sims):
+            rng = np.random.RandomState(trajectory_seed(s))
+            yield Ts[rng.randint(len(Ts))], experiments[rng.randint(len(experiments))], \
+                floor_decays[rng.randint(len(floor_decays))]
+        return
+    count = 0
+    while count < num_sims:
+        # allocate and claim the batch at once, so that no other task allocates from the same state
+        with sweep_claims.locked():
+            batch = sweep_state().next_batch()[:num_sims - count]
+            sweep_claims.claim(batch)
+        if len(batch) == 0:
+            print("Every configuration reached the target coverage precision.")
+            return
+        for config in batch:
+            yield config
+            count += 1
+
+
+# In[10]:
+
+
+def experiment_setup(T, experiment):
+    """ Truth, number of arms, floor start, horizons evaluated and length of the generated trajectory. """
+    # T: number of samples, experiment: signal strength
     truth = truths[experiment]
     K = len(truth)  # number of arms
     floor_start = 1/K
-    floor_decay = choice(floor_decays)
-
-    """ Generate data """
-    noise = np.random.uniform(-noise_scale, noise_scale, size=(T, K))
-    ys = truth + noise
-
-    """ Run experiment """
-    data = run_mab_experiment(
-        ys,
-        initial=initial,
-        floor_start=floor_start,
-        floor_decay=floor_decay,
-        exploration=exploration)
+    if all_horizons:
+        # one trajectory of length max(Ts), evaluated at every horizon in Ts
+        return truth, K, floor_start, sorted(Ts), max(Ts)
+    return truth, K, floor_start, [T], T
+
+
+def generate_trajectory(job):
+    """ Generate data and run experiment """
+    s, T, experiment, floor_decay = job
+    truth, K, floor_start, horizons, T = experiment_setup(T, experiment)
+
+    def generate():
+        noise = np.random.uniform(-noise_scale, noise_scale, size=(T, K))
+        ys = truth + noise
+        return run_mab_experiment(
+            ys,
+            initial=initial,
+            floor_start=floor_start,
+            floor_decay=floor_decay,
+            exploration=exploration)
+
+    if task is not None:
+        np.random.seed(trajectory_seed(s))
+    elif pipeline_seed is not None:
+        # worker processes start with copies of the same random state
+        np.random.seed([pipeline_seed, s])
+    if trajectory_cache is None:
+        return generate()
+    trajectory_config = dict(T=T, truth=truth, noise_func=noise_func, noise_scale=noise_scale, initial=initial,
+                             floor_start=floor_start, floor_decay=floor_decay, exploration=exploration)
+    return trajectory_cache.get_or_run(trajectory_config, trajectory_seed(s), generate)
+
+
+def evaluate_trajectory(job, data):
+    """
+    Estimate arm values and contrasts of a trajectory at each horizon.
+    Returns a list of dictionaries with the horizon T, stats, contrasts and the two-point ratio.
+    """
+    s, T, experiment, floor_decay = job
+    truth, K, floor_start, horizons, T = experiment_setup(T, experiment)
 
-    probs = data['probs']
-    rewards = data['rewards']
-    arms = data['arms']
+    full_probs = np.asarray(data['probs'])  # decompress for evaluation
+    full_rewards = data['rewards']
+    full_arms = data['arms']
 
     """ Compute AIPW scores """
-    muhat = np.row_stack([np.zeros(K), sample_mean(rewards, arms, K)[:-1]])
-    scores = aw_scores(rewards, arms, probs, muhat)
-
-    """ Compute weights """
-    # Two-point allocation rate
-    twopoint_ratio = twopoint_stable_var_ratio(e=probs, alpha=floor_decay)
-    twopoint_ratio_old = twopoint_stable_var_ratio_old(probs, floor_start, floor_decay)
-    twopoint_h2es = stick_breaking(twopoint_ratio)
-    twopoint_h2es_old = stick_breaking(twopoint_ratio_old)
-    wts_twopoint = np.sqrt(np.maximum(0., twopoint_h2es * probs))
-
-    # Other weights: lvdl(constant allocation rate), propscore and uniform
-    wts_lvdl = np.sqrt(probs)
-    wts_propscore = probs
-    wts_uniform = np.ones_like(probs)
-
-    """ Estimate arm values """
-    # for each weighting scheme, return [estimate, S.E, bias, 90%-coverage, t-stat, mse, truth]
-    stats = dict(
-        uniform=evaluate_aipw_stats(scores, wts_uniform, truth),
-        propscore=evaluate_aipw_stats(scores, wts_propscore, truth),
-        lvdl=evaluate_aipw_stats(scores, wts_lvdl, truth),
-        two_point=evaluate_aipw_stats(scores, wts_twopoint, truth),
-        beta_bernoulli=evaluate_beta_bernoulli_stats(rewards, arms, truth, K, floor_decay, alpha=.1),
-        gamma_exponential=evaluate_gamma_exponential_stats(rewards, arms, truth, K, floor_decay, c=2, expected_noise_variance=1/3, alpha=.1),
-        sample_mean_naive=evaluate_sample_mean_naive_stats(rewards, arms, truth, K, alpha=.1)
-    )
-    
-    # # add estimates of W_decorrelation
-    W_name = f'wdecorr_results/W_lambdas_{experiment}-{noise_func}-{T}-{floor_decay}.npz'
-    try:
-        W_save = np.load(W_name)  # load presaved W-lambdas
-        for percentile, W_lambda in zip(W_save['percentiles'], W_save['W_lambdas']):
-            stats[f'W-decorrelation_{percentile}'] = wdecorr_stats(arms, rewards, K, W_lambda, truth)
-    except FileNotFoundError:
-        print(f'Could not find relevant w-decorrelation file {W_name}. Ignoring.')
-        
-    
-    """ Estimate contrasts """
-    contrasts = dict(
-        uniform=evaluate_aipw_contrasts(scores, wts_uniform, truth),
-        propscore=evaluate_aipw_contrasts(scores, wts_propscore, truth),
-        lvdl=evaluate_aipw_contrasts(scores, wts_lvdl, truth),
-        two_point=evaluate_aipw_contrasts(scores, wts_twopoint, truth),
-        beta_bernoulli=evaluate_beta_bernoulli_contrasts(rewards, arms, truth, K, floor_decay, alpha=.1),
-        gamma_exponential=evaluate_gamma_exponential_contrasts(rewards, arms, truth, K, floor_decay, c=2, expected_noise_variance=1/3, alpha=.1),
-        sample_mean_naive=evaluate_sample_mean_naive_contrasts(rewards, arms, truth, K, alpha=.1)
+    # muhat and the scores only depend on the past, so prefixes of them are valid for shorter horizons
+    full_muhat = lagged_sample_mean(full_rewards, full_arms, K)
+    full_scores = aw_scores(full_rewards, full_arms, full_probs, full_muhat, out=full_muhat)  # muhat is not needed afterwards
+
+    # Weights that do not depend on the horizon: all horizons from one pass of cumulative sums
+    horizon_stats = dict(
+        uniform=evaluate_aipw_stats_horizons(full_scores, np.ones_like(full_probs), truth, horizons),
+        propscore=evaluate_aipw_stats_horizons(full_scores, full_probs, truth, horizons),
+        lvdl=evaluate_aipw_stats_horizons(full_scores, np.sqrt(full_probs), truth, horizons),
     )
 
-    
-    """ Save results """
-    config = dict(
-        T=T,
-        K=K,
-        noise_func=noise_func,
-        noise_scale=noise_scale,
-        floor_start=floor_start,
-        floor_decay=floor_decay,
-        initial=initial,
-        dgp=experiment,
-    )
+    evaluations = []
+    for h, T in enumerate(horizons):
+        probs = full_probs[:T]
+        rewards = full_rewards[:T]
+        arms = full_arms[:T]
+        scores = full_scores[:T]
+
+        """ Compute weights """
+        # Two-point allocation rate (depends on the horizon T, so recomputed for each prefix)
+        twopoint_ratio = twopoint_stable_var_ratio(e=probs, alpha=floor_decay)
+        twopoint_ratio_old = twopoint_stable_var_ratio_old(probs, floor_start, floor_decay)
+        twopoint_h2es = stick_breaking(twopoint_ratio)
+        twopoint_h2es_old = stick_breaking(twopoint_ratio_old)
+        wts_twopoint = np.sqrt(np.maximum(0., twopoint_h2es * probs))
+
+        # Other weights: lvdl(constant allocation rate), propscore and uniform
+        wts_lvdl = np.sqrt(probs)
+        wts_propscore = probs
+        wts_uniform = np.ones_like(probs)
+
+        """ Estimate arm values and contrasts """
+        # the estimators are independent of each other and run concurrently if ADAPTIVE_CI_THREADS > 1
+        estimators = EstimatorRegistry()
+        # for each weighting scheme, return [estimate, S.E, bias, 90%-coverage, t-stat, mse, truth]
+        estimators.add(('stats', 'two_point'), evaluate_aipw_stats, scores, wts_twopoint, truth)
+        estimators.add(('stats', 'beta_bernoulli'), evaluate_beta_bernoulli_stats, rewards, arms, truth, K, floor_decay, alpha=.1)
+        estimators.add(('stats', 'gamma_exponential'), evaluate_gamma_exponential_stats, rewards, arms, truth, K, floor_decay, c=2, expected_noise_variance=1/3, alpha=.1)
+        estimators.add(('stats', 'sample_mean_naive'), evaluate_sample_mean_naive_stats, rewards, arms, truth, K, alpha=.1)
+
+        # # add estimates of W_decorrelation
+        W_name = f'wdecorr_results/W_lambdas_{experiment}-{noise_func}-{T}-{floor_decay}.npz'
+        try:
+            W_save = np.load(W_name)  # load presaved W-lambdas
+            for percentile, W_lambda in zip(W_save['percentiles'], W_save['W_lambdas']):
+                estimators.add(('stats', f'W-decorrelation_{percentile}'), wdecorr_stats, arms, rewards, K, W_lambda, truth)
+        except FileNotFoundError:
+            print(f'Could not find relevant w-decorrelation file {W_name}. Ignoring.')
+
+        estimators.add(('contrasts', 'uniform'), evaluate_aipw_contrasts, scores, wts_uniform, truth)
+        estimators.add(('contrasts', 'propscore'), evaluate_aipw_contrasts, scores, wts_propscore, truth)
+        estimators.add(('contrasts', 'lvdl'), evaluate_aipw_contrasts, scores, wts_lvdl, truth)
+        estimators.add(('contrasts', 'two_point'), evaluate_aipw_contrasts, scores, wts_twopoint, truth)
+        estimators.add(('contrasts', 'beta_bernoulli'), evaluate_beta_bernoulli_contrasts, rewards, arms, truth, K, floor_decay, alpha=.1)
+        estimators.add(('contrasts', 'gamma_exponential'), evaluate_gamma_exponential_contrasts, rewards, arms, truth, K, floor_decay, c=2, expected_noise_variance=1/3, alpha=.1)
+        estimators.add(('contrasts', 'sample_mean_naive'), evaluate_sample_mean_naive_contrasts, rewards, arms, truth, K, alpha=.1)
+
+        results = estimators.run(thread_pool(num_threads))
+        stats = dict(
+            uniform=horizon_stats['uniform'][h],
+            propscore=horizon_stats['propscore'][h],
+            lvdl=horizon_stats['lvdl'][h],
+            **{name: result for (kind, name), result in results.items() if kind == 'stats'}
+        )
+        contrasts = {name: result for (kind, name), result in results.items() if kind == 'contrasts'}
+
+        """ Relevant lambda weights, if applicable """
+        lambdas = None
+        if T == max(Ts):
+            saved_timepoints = list(range(0, T, T // 500))
+            lambdas = twopoint_ratio[saved_timepoints] * (T - np.array(saved_timepoints)[:,np.newaxis])
+
+        evaluations.append(dict(T=T, stats=stats, contrasts=contrasts, lambdas=lambdas))
+    return evaluations
+
+
+def record(job, evaluations):
+    """ Tabulate and summarize the evaluations of a trajectory. """
+    s, T, experiment, floor_decay = job
+    truth, K, floor_start, horizons, T = experiment_setup(T, experiment)
+    for evaluation in evaluations:
+        T, stats, contrasts, lambdas = (evaluation[key] for key in ['T', 'stats', 'contrasts', 'lambdas'])
+
+        """ Save results """
+        config = dict(
+            T=T,
+            K=K,
+            noise_func=noise_func,
+            noise_scale=noise_scale,
+            floor_start=floor_start,
+            floor_decay=floor_decay,
+            initial=initial,
+            dgp=experiment,
+        )
+
+        with profile_block("tabulation"):
+            # tabulate arm values and arm contrasts
+            stats_table.add(stats, range(K), config)
+            stats_table.add(contrasts, [f"(0,{k})" for k in range(1, K)], config)
+
+        with profile_block("summary"):
+            group = dict(T=T, dgp=experiment, floor_decay=floor_decay)
+            for method, stat in stats.items():
+                summary.update_statistics(stat, range(K), statistic_names, method=method, **group)
+            for method, contrast in contrasts.items():
+                summary.update_statistics(contrast, [f"(0,{k})" for k in range(1, K)], statistic_names, method=method, **group)
+
+        if (T, experiment, floor_decay) in recorded_counts:
+            recorded_counts[T, experiment, floor_decay] += 1
+
+
+        """ Save relevant lambda weights, if applicable """
+        if lambdas is not None:
+            saved_timepoints = list(range(0, T, T // 500))
+            lambdas = {key: value for key, value in enumerate(lambdas.T)}
+            dfl = pd.DataFrame({**lambdas, **config, 'time': saved_timepoints})
+            dfl = pd.melt(dfl, id_vars=list(config.keys()) + ['time'], var_name='policy', value_vars=list(range(K)))
+            df_lambdas.append(dfl)
+
+    global num_recorded
+    num_recorded += 1
+    if num_recorded % profile_every == 0:
+        save_profile()
+
+
+# **Parallel pipeline (optional).** Setting ADAPTIVE_CI_PIPELINE to "G,E" (e.g. "2,6") runs the bandit
+# experiments in G generator processes and their evaluation in E evaluator processes. Trajectories are
+# passed through shared memory (see adaptive_CI/pipeline.py). With early stopping, the pipeline runs one
+# batch of the sweep at a time, so that each batch is allocated after the previous one is recorded.
 
-    ratios = dict(
-        lvdl=np.ones((T, K)) / np.arange(T, 0, -1)[:, np.newaxis],
-        two_point=twopoint_ratio,
-    )
-    
-    # save lambda values at selected timepoints
-    saved_timepoints = list(range(0, T, T // 250)) + [T-1]
-    for ratio in ratios:
-        ratios[ratio] = ratios[ratio][saved_timepoints, :]
-    
-    # tabulate arm values
-    tabs_stats = []
-    for method, stat in stats.items():
-        tab_stats = pd.DataFrame({"statistic": ["estimate", "stderr", "bias", "90% coverage of t-stat", "t-stat", "mse", "CI_width", "truth"] * stat.shape[1],
-                                  "policy": np.repeat(np.arange(K), stat.shape[0]),
-                                  "value":  stat.flatten(order='F'),
-                                  "method": method,
-                                 **config})
-        tabs_stats.append(tab_stats)
-
-
-    # tabulate arm contrasts
-    tabs_contrasts = []
-    for method, contrast in contrasts.items():
-        tabs_contrast = pd.DataFrame({"statistic": ["estimate", "stderr", "bias", "90% coverage of t-stat", "t-stat", "mse", "CI_width", "truth"] * contrast.shape[1],
-                                      "policy": np.repeat([f"(0,{k})" for k in np.arange(1, K)], contrast.shape[0]),
-                                      "value": contrast.flatten(order='F'),
-                                      "method": method,
-                                     **config})
-        tabs_contrasts.append(tabs_contrast)
-
-    
-    df_stats.extend(tabs_stats)
-    df_stats.extend(tabs_contrasts)
-    
-    
-    """ Save relevant lambda weights, if applicable """
-    if T == max(Ts):
-        saved_timepoints = list(range(0, T, T // 500))
-        lambdas = twopoint_ratio[saved_timepoints] * (T - np.array(saved_timepoints)[:,np.newaxis])
-        lambdas = {key: value for key, value in enumerate(lambdas.T)}
-        dfl = pd.DataFrame({**lambdas, **config, 'time': saved_timepoints})
-        dfl = pd.melt(dfl, id_vars=list(config.keys()) + ['time'], var_name='policy', value_vars=list(range(K)))
-        df_lambdas.append(dfl)
-        
-    print(f"Time passed {time()-start_time}s")
+# In[11]:
+
+
+pipeline_workers = os.environ.get('ADAPTIVE_CI_PIPELINE')
+pipeline_seed = None
+if pipeline_workers is None:
+    # Run simulations
+    for s, (T, experiment, floor_decay) in enumerate(configurations()):
+        if (s+1) % 10 == 0:
+            print(f'Running simulation {s+1}/{num_sims}')
+        job = (s, T, experiment, floor_decay)
+        record(job, evaluate_trajectory(job, generate_trajectory(job)))
+else:
+    num_generators, num_evaluators = (int(n) for n in pipeline_workers.split(','))
+    pipeline_seed = np.random.randint(2**31)
+    jobs = ((s, T, experiment, floor_decay) for s, (T, experiment, floor_decay) in enumerate(configurations()))
+    round_size = num_sims if sweep_se is None else sweep_batch_size
+    while True:
+        batch = list(islice(jobs, round_size))
+        if len(batch) == 0:
+            break
+        run_pipeline(batch, generate_trajectory, evaluate_trajectory,
+                     T_max=max(Ts), K=max(len(truth) for truth in truths.values()),
+                     num_generators=num_generators, num_evaluators=num_evaluators,
+                     context='fork', callback=record)
+
+print(f"Time passed {time()-start_time}s")
 
 
 # ----
@@ -311,75 +520,61 @@ for s in range(num_sims):
 
 # Break down the output into different chunks, so it will be easier to pick what to load and plot.
 
-# Get the directory (the first statement here is specific to the Stanford cluster).
-
-# In[7]:
-
-
-if on_sherlock():
-    write_dir = get_sherlock_dir('adaptive-confidence-intervals', 'simulations', create=True)
-    print(f"saving at {write_dir}")
-else:
-     write_dir = join(os.getcwd(), 'results')
-        
-
+# In[12]:
 
-# In[8]:
 
+saved_statistics = ["mse", "bias", "90% coverage of t-stat", "CI_width"]
+saved_methods = ['uniform', 'lvdl', 'two_point',  'sample_mean_naive', 'gamma_exponential', 'W-decorrelation_15']
 
-df_stats = pd.concat(df_stats, ignore_index=True, sort=False)
 
+# Saving the running summary (count, mean and variance of every statistic per configuration).
 
-# Saving information about contrasts.
+# In[13]:
 
-# In[9]:
 
+summary.save(os.path.join(write_dir, compose_filename('summary', 'pkl')))
+if sweep_claims is not None:
+    sweep_claims.release()  # the saved summary now holds the simulations claimed by this task
 
-filename_contrast = compose_filename(f'contrast', 'pkl')
-write_path_contrast = os.path.join(write_dir, filename_contrast)
 
-df_contrast = df_stats.query(
-            'policy == "(0,2)" and '
-            'statistic == ["mse", "bias", "90% coverage of t-stat", "CI_width"] and '
-            "method == ['uniform', 'lvdl', 'two_point',  'sample_mean_naive', 'gamma_exponential', 'W-decorrelation_15']")
-df_contrast.to_pickle(write_path_contrast)
+# The running summary above holds the averages of every statistic; aggregate.py reads them from it. Setting
+# ADAPTIVE_CI_SIMULATION_TABLES=1 also saves the statistics of every simulation for contrasts and arms,
+# one row per simulation, statistic and method (large for many simulations), which aggregate.py keeps
+# apart from the summary.
 
+# In[14]:
 
-# Save information about arms.
 
-# In[10]:
+if os.environ.get('ADAPTIVE_CI_SIMULATION_TABLES', '') not in ('', '0'):
+    filename_contrast = compose_filename(f'contrast', 'pkl')
+    write_path_contrast = os.path.join(write_dir, filename_contrast)
 
+    df_contrast = stats_table.select(policy="(0,2)", statistic=saved_statistics, method=saved_methods)
+    df_contrast.to_pickle(write_path_contrast)
 
-filename_arms = compose_filename(f'arm', 'pkl')
-write_path_arms = os.path.join(write_dir, filename_arms)
+    filename_arms = compose_filename(f'arm', 'pkl')
+    write_path_arms = os.path.join(write_dir, filename_arms)
 
-df_arms = df_stats.query(
-            'policy == [0, 1, 2] and '
-            'statistic == ["mse", "bias", "90% coverage of t-stat", "CI_width"] and '
-            "method == ['uniform', 'lvdl', 'two_point',  'sample_mean_naive', 'gamma_exponential', 'W-decorrelation_15']")
-df_arms.to_pickle(write_path_arms)
+    df_arms = stats_table.select(policy=[0, 1, 2], statistic=saved_statistics, method=saved_methods)
+    df_arms.to_pickle(write_path_arms)
 
 
 # Save information about "t-stats" (i.e., our studentized 'statistics').
 
-# In[11]:
+# In[15]:
 
 
 filename_tstats = compose_filename(f'tstat', 'pkl')
 write_path_tstats = os.path.join(write_dir, filename_tstats)
 
 T_max = max(Ts)
-df_tstats = df_stats.query(
-    "method == ['uniform', 'lvdl', 'two_point',  'sample_mean_naive', 'gamma_exponential', 'W-decorrelation_15'] and "
-    "T == @T_max and "
-    "statistic == 't-stat'"
-)
+df_tstats = stats_table.select(method=saved_methods, T=T_max, statistic='t-stat')
 df_tstats.to_pickle(write_path_tstats)
 
 
 # Save information about $\lambda$ behavior, if appropriate.
 
-# In[12]:
+# In[16]:
 
 
 filename_lambdas = compose_filename(f'lambdas', 'pkl')
@@ -388,7 +583,16 @@ if len(df_lambdas) > 0:
     df_lambdas = pd.concat(df_lambdas)
 
 
-# In[13]:
+# In[17]:
+
+
+disable_profiling()
+if profile is not None:
+    save_profile()
+    print(profile.summary())
+
+
+# In[18]:
 
 
 print("All done.")